@@ -0,0 +1,73 @@
+# flake8: noqa: E501
+import json
+import os
+import sys
+import time
+
+from locallm import InferenceParams, LmParams, LocalLm, LocalPoolLm
+
+# measure the batch throughput of one local model against a pool of worker
+# processes sharing the cores
+# > python -m benchmarks.local_pool --models-dir /tmp/models --model tiny.gguf
+# > python -m benchmarks.local_pool --models-dir ~/models --model m.gguf --workers 2,4,8 --queries 64
+
+
+def measure(lm, queries: int, max_tokens: int, concurrency: int) -> dict:
+    params = InferenceParams(max_tokens=max_tokens, temperature=0.8, stream=False)
+    prompts = [f"Tell the story number {i}" for i in range(queries)]
+    start = time.perf_counter()
+    results = lm.infer_many(prompts, params, max_concurrency=concurrency)
+    elapsed = time.perf_counter() - start
+    tokens = sum(r["stats"].get("generated_tokens", 0) for r in results)
+    return {
+        "total_s": elapsed,
+        "queries_per_second": queries / elapsed,
+        "tokens_per_second": tokens / elapsed,
+    }
+
+
+def main(models_dir: str, model: str, workers: list, queries: int, max_tokens: int):
+    threads = os.cpu_count() or 1
+    base = {"models_dir": models_dir, "threads": threads, "cache_policy": "never", "on_token": lambda t: None}
+    lm = LocalLm(LmParams(**base))
+    lm.load_model(model, 1024)
+    results = {"local": measure(lm, queries, max_tokens, 1)}
+    for n in workers:
+        pool = LocalPoolLm(LmParams(**base, workers=n))
+        pool.load_model(model, 1024)
+        try:
+            res = measure(pool, queries, max_tokens, n)
+            res["utilization"] = [round(s["utilization"], 3) for s in pool.stats]
+        finally:
+            pool.close()
+        res["speedup"] = res["tokens_per_second"] / results["local"]["tokens_per_second"]
+        results[f"pool_{n}"] = res
+    print(
+        json.dumps(
+            {
+                "benchmark": "local_pool",
+                "model": model,
+                "threads": threads,
+                "queries": queries,
+                "max_tokens": max_tokens,
+                "results": results,
+            },
+            indent=2,
+        )
+    )
+
+
+def arg(name: str, default: str) -> str:
+    if name in sys.argv:
+        return sys.argv[sys.argv.index(name) + 1]
+    return default
+
+
+if __name__ == "__main__":
+    main(
+        arg("--models-dir", "/tmp/models"),
+        arg("--model", "tiny.gguf"),
+        [int(n) for n in arg("--workers", "2,4").split(",")],
+        int(arg("--queries", "32")),
+        int(arg("--max-tokens", "64")),
+    )
@@ -0,0 +1,111 @@
+# flake8: noqa: E501
+import json
+import sys
+import time
+from typing import Any, Callable, Dict
+
+from locallm.providers.koboldcpp import KoboldcppLm
+from locallm.providers.ollama import OllamaLm
+from locallm.schemas import InferenceParams
+
+# measure the per call cost of the conversion of the inference params to the
+# backend api formats: the previous model_dump and dict edits, and the compiled
+# translation tables of the providers
+# > python -m benchmarks.params
+# > python -m benchmarks.params --calls 100000
+
+N_CALLS = 100000
+
+
+def dump_ollama(params: InferenceParams) -> Dict[str, Any]:
+    final_params = params.model_dump(exclude_none=True, exclude_unset=True)
+    for name in ("template", "variables", "truncate", "stop_regex", "max_time", "grammar"):
+        if name in final_params:
+            del final_params[name]
+    if "threads" in final_params:
+        final_params["num_threads"] = final_params["threads"]
+        del final_params["threads"]
+    if "stop" in final_params:
+        final_params["options"] = {"stop": final_params["stop"]}
+        del final_params["stop"]
+    if "json_schema" in final_params:
+        final_params["format"] = final_params["json_schema"]
+        del final_params["json_schema"]
+    if "tfs" in final_params:
+        final_params["tfs_z"] = final_params["tfs"]
+        del final_params["tfs"]
+    if "max_tokens" in final_params:
+        final_params["num_predict"] = final_params["max_tokens"]
+        del final_params["max_tokens"]
+    return final_params
+
+
+def dump_koboldcpp(params: InferenceParams) -> Dict[str, Any]:
+    final_params = params.model_dump(exclude_none=True, exclude_unset=True)
+    if "stop" in final_params:
+        final_params["stop_sequence"] = final_params["stop"]
+        del final_params["stop"]
+    if "repeat_penalty" in final_params:
+        final_params["rep_pen"] = final_params["repeat_penalty"]
+        del final_params["repeat_penalty"]
+    for name in (
+        "presence_penalty",
+        "frequency_penalty",
+        "threads",
+        "stream",
+        "variables",
+        "model",
+        "truncate",
+        "stop_regex",
+        "max_time",
+    ):
+        if name in final_params:
+            del final_params[name]
+    if "max_tokens" in final_params:
+        final_params["max_length"] = final_params["max_tokens"]
+        del final_params["max_tokens"]
+    return final_params
+
+
+def measure(fn: Callable[[InferenceParams], Any], params: InferenceParams, calls: int) -> dict:
+    samples = []
+    for _ in range(5):
+        start = time.perf_counter()
+        for _ in range(calls):
+            fn(params)
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    return {
+        "total_ms_median": samples[len(samples) // 2] * 1000,
+        "per_call_us": samples[0] / calls * 1e6,
+    }
+
+
+def main(calls: int):
+    params = InferenceParams(
+        stream=True,
+        template="<s>[INST] {prompt} [/INST]",
+        max_tokens=256,
+        temperature=0.2,
+        top_p=0.9,
+        stop=["</s>", "[INST]"],
+        repeat_penalty=1.1,
+    )
+    results = {
+        "ollama": {
+            "model_dump": measure(dump_ollama, params, calls),
+            "translator": measure(OllamaLm._translate, params, calls),
+        },
+        "koboldcpp": {
+            "model_dump": measure(dump_koboldcpp, params, calls),
+            "translator": measure(KoboldcppLm._translate, params, calls),
+        },
+    }
+    print(json.dumps({"benchmark": "params", "calls": calls, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    calls = N_CALLS
+    if "--calls" in sys.argv:
+        calls = int(sys.argv[sys.argv.index("--calls") + 1])
+    main(calls)
@@ -0,0 +1,196 @@
+# flake8: noqa: E501
+import asyncio
+import json
+import resource
+import subprocess
+import sys
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+from locallm import KoboldcppLm, LmParams, OllamaLm
+from locallm.provider import LmProvider
+
+# measure the http providers against the replay servers of benchmarks.servers,
+# run in a subprocess to keep the client cpu time apart: time to first token,
+# tokens per second, client cpu time per token, memory and the concurrency
+# scaling of infer, generate, infer_many and ainfer
+# > python -m benchmarks.providers
+# > python -m benchmarks.providers --rate 200 --latency 0.05 --queries 20 --concurrency 1,2,4,8
+# > python -m benchmarks.providers --stream recorded.ndjson
+
+
+def start_server(rate: float, latency: float, stream: str) -> Tuple[subprocess.Popen, str]:
+    cmd = [
+        sys.executable,
+        "-m",
+        "benchmarks.servers",
+        "--port",
+        "0",
+        "--rate",
+        str(rate),
+        "--latency",
+        str(latency),
+    ]
+    if stream:
+        cmd += ["--stream", stream]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True)
+    info = json.loads(proc.stdout.readline())  # type: ignore
+    return proc, f"http://127.0.0.1:{info['port']}"
+
+
+def make_lm(ptype: str, url: str) -> LmProvider:
+    params = LmParams(server_url=url, on_token=lambda t: None, cache_policy="never")
+    lm: LmProvider = KoboldcppLm(params) if ptype == "koboldcpp" else OllamaLm(params)
+    lm.load_model("replay", 4096)
+    return lm
+
+
+def median(values: List[float]) -> float:
+    values = sorted(values)
+    return values[len(values) // 2] if values else 0.0
+
+
+def measure(fn: Callable[[], int]) -> Dict[str, Any]:
+    # run a scenario that returns the number of generated tokens
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    cpu = time.process_time()
+    start = time.perf_counter()
+    tokens = fn()
+    wall = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+    return {
+        "tokens": tokens,
+        "wall_s": wall,
+        "tokens_per_second": tokens / wall if wall > 0 else 0,
+        "cpu_us_per_token": cpu / tokens * 1e6 if tokens > 0 else 0,
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "max_rss_growth_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss,
+    }
+
+
+def bench_infer(lm: LmProvider, queries: int) -> Dict[str, Any]:
+    ttft: List[float] = []
+
+    def run() -> int:
+        n = 0
+        for _ in range(queries):
+            res = lm.infer("List the planets")
+            ttft.append(res["stats"]["time_to_first_token"])
+            n += res["stats"]["generated_tokens"]
+        return n
+
+    res = measure(run)
+    res["ttft_ms_median"] = median(ttft) * 1000
+    return res
+
+
+def bench_generate(lm: LmProvider, queries: int, raw: bool = False) -> Dict[str, Any]:
+    ttft: List[float] = []
+
+    def run() -> int:
+        n = 0
+        for _ in range(queries):
+            start = time.perf_counter()
+            for i, _ in enumerate(lm.generate("List the planets", raw=raw)):
+                if i == 0:
+                    ttft.append(time.perf_counter() - start)
+                n += 1
+        return n
+
+    res = measure(run)
+    res["ttft_ms_median"] = median(ttft) * 1000
+    return res
+
+
+def bench_infer_many(lm: LmProvider, queries: int, concurrency: int) -> Dict[str, Any]:
+    def run() -> int:
+        results = lm.infer_many(["List the planets"] * queries, max_concurrency=concurrency)
+        return sum(r["stats"]["generated_tokens"] for r in results)
+
+    return measure(run)
+
+
+def bench_ainfer(lm: LmProvider, queries: int, concurrency: int) -> Dict[str, Any]:
+    from locallm.connection import aclose_sessions
+
+    async def main() -> int:
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one() -> int:
+            async with semaphore:
+                res = await lm.ainfer("List the planets")
+                return res["stats"]["generated_tokens"]
+
+        counts = await asyncio.gather(*[one() for _ in range(queries)])
+        await aclose_sessions()
+        return sum(counts)
+
+    return measure(lambda: asyncio.run(main()))
+
+
+def with_scaling(results: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    base = results[min(results, key=int)]["tokens_per_second"]
+    for res in results.values():
+        res["scaling"] = res["tokens_per_second"] / base if base > 0 else 0
+    return results
+
+
+def main(rate: float, latency: float, stream: str, queries: int, levels: List[int]):
+    proc, url = start_server(rate, latency, stream)
+    try:
+        try:
+            import aiohttp  # noqa: F401
+
+            has_async = True
+        except ImportError:
+            has_async = False
+        results: Dict[str, Any] = {}
+        for ptype in ["koboldcpp", "ollama"]:
+            lm = make_lm(ptype, url)
+            # warm up the connection pool
+            lm.infer("Hello")
+            res: Dict[str, Any] = {
+                "infer": bench_infer(lm, queries),
+                "generate": bench_generate(lm, queries),
+                "generate_raw": bench_generate(lm, queries, raw=True),
+                "infer_many": with_scaling(
+                    {str(c): bench_infer_many(lm, queries, c) for c in levels}
+                ),
+            }
+            if has_async:
+                res["ainfer"] = with_scaling(
+                    {str(c): bench_ainfer(lm, queries, c) for c in levels}
+                )
+            results[ptype] = res
+    finally:
+        proc.terminate()
+        proc.wait()
+    print(
+        json.dumps(
+            {
+                "benchmark": "providers",
+                "rate": rate,
+                "latency": latency,
+                "stream": stream or "default",
+                "queries": queries,
+                "results": results,
+            },
+            indent=2,
+        )
+    )
+
+
+def arg(name: str, default: str) -> str:
+    if name in sys.argv:
+        return sys.argv[sys.argv.index(name) + 1]
+    return default
+
+
+if __name__ == "__main__":
+    main(
+        float(arg("--rate", "0")),
+        float(arg("--latency", "0")),
+        arg("--stream", ""),
+        int(arg("--queries", "10")),
+        [int(c) for c in arg("--concurrency", "1,2,4").split(",")],
+    )
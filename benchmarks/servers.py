@@ -0,0 +1,162 @@
+# flake8: noqa: E501
+import json
+import sys
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+
+# a stand-in server for the Koboldcpp and Ollama apis that replays a recorded
+# token stream at a given rate, after a given latency
+# > python -m benchmarks.servers --port 5001 --rate 50 --latency 0.2
+# > python -m benchmarks.servers --stream recorded.ndjson
+
+DEFAULT_TOKENS = 256
+
+WORDS = ["The", " planets", " of", " the", " solar", " system", " are", ",", " and", "\n"]
+
+
+def default_tokens(n_tokens: int = DEFAULT_TOKENS) -> List[str]:
+    return [WORDS[i % len(WORDS)] for i in range(n_tokens)]
+
+
+def read_tokens(path: str) -> List[str]:
+    """
+    Read a recorded stream: an Ollama ndjson recording, a Koboldcpp sse recording
+    or a json list of tokens
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        content = f.read()
+    if content.lstrip().startswith("["):
+        return json.loads(content)
+    tokens = []
+    for line in content.splitlines():
+        if line.startswith("data:"):
+            tokens.append(json.loads(line[5:])["token"])
+        elif line.strip().startswith("{"):
+            token = json.loads(line).get("response", "")
+            if token:
+                tokens.append(token)
+    return tokens
+
+
+class ReplayServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port: int, tokens: List[str], rate: float, latency: float):
+        super().__init__(("127.0.0.1", port), ReplayHandler)
+        self.tokens = tokens
+        self.rate = rate
+        self.latency = latency
+        self.last_count = 0
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: ReplayServer
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _stream(self, content_type: str, chunks):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        time.sleep(self.server.latency)
+        delay = 1 / self.server.rate if self.server.rate > 0 else 0
+        start = time.perf_counter()
+        for i, data in enumerate(chunks):
+            # keep the rate steady whatever the time spent writing
+            wait = start + i * delay - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.flush()
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path == "/api/extra/true_max_context_length":
+            self._send_json({"value": 4096})
+        elif self.path == "/api/v1/model":
+            self._send_json({"result": "koboldcpp/replay"})
+        elif self.path == "/api/extra/perf":
+            n = self.server.last_count
+            self._send_json(
+                {
+                    "last_process": self.server.latency,
+                    "last_eval": n / self.server.rate if self.server.rate > 0 else 0,
+                    "last_token_count": n,
+                }
+            )
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        tokens = self.server.tokens
+        max_tokens = payload.get("max_length") or payload.get("options", {}).get(
+            "num_predict"
+        )
+        if max_tokens:
+            tokens = tokens[:max_tokens]
+        self.server.last_count = len(tokens)
+        if self.path == "/api/extra/generate/stream":
+            chunks = (
+                b"event: message\ndata: %s\n\n" % json.dumps({"token": t}).encode("utf-8")
+                for t in tokens
+            )
+            self._stream("text/event-stream", chunks)
+        elif self.path == "/api/extra/abort":
+            self._send_json({"success": True})
+        elif self.path == "/api/generate":
+            model = payload.get("model", "")
+
+            def lines():
+                for t in tokens:
+                    line = {"model": model, "response": t, "done": False}
+                    yield json.dumps(line).encode("utf-8") + b"\n"
+                final = {
+                    "model": model,
+                    "response": "",
+                    "done": True,
+                    "prompt_eval_count": len(payload.get("prompt", "")),
+                    "prompt_eval_duration": int(self.server.latency * 1e9),
+                    "eval_count": len(tokens),
+                    "eval_duration": int(len(tokens) / self.server.rate * 1e9)
+                    if self.server.rate > 0
+                    else 0,
+                }
+                yield json.dumps(final).encode("utf-8") + b"\n"
+
+            self._stream("application/x-ndjson", lines())
+        else:
+            self.send_error(404)
+
+
+def arg(name: str, default: str) -> str:
+    if name in sys.argv:
+        return sys.argv[sys.argv.index(name) + 1]
+    return default
+
+
+if __name__ == "__main__":
+    stream = arg("--stream", "")
+    tokens = read_tokens(stream) if stream else default_tokens()
+    server = ReplayServer(
+        int(arg("--port", "5001")),
+        tokens,
+        float(arg("--rate", "0")),
+        float(arg("--latency", "0")),
+    )
+    print(json.dumps({"port": server.server_address[1], "tokens": len(tokens)}), flush=True)
+    server.serve_forever()
@@ -0,0 +1,105 @@
+# flake8: noqa: E501
+import json
+import sys
+import time
+from typing import Optional
+
+from locallm import InferenceParams, LmParams, LocalLm
+
+# measure the greedy generation speed of the local provider without and with the
+# speculative decoding: with a draft model, and with the prompt lookup that
+# drafts from the prompt n-grams. The greedy outputs must be identical to the
+# plain decoding
+# > python -m benchmarks.speculative --models-dir /tmp/models --model tiny.gguf --draft tiny-draft.gguf
+# > python -m benchmarks.speculative --models-dir ~/models --model m.gguf --draft d.gguf --draft-tokens 4 --max-tokens 256
+
+# a repetitive prompt, like the code edits and the extraction tasks where the
+# prompt lookup shines
+PROMPT = "\n".join(f"item {i}: the quick brown fox jumps over the lazy dog" for i in range(8))
+
+
+def measure(
+    models_dir: str,
+    model: str,
+    draft: Optional[str],
+    draft_tokens: int,
+    max_tokens: int,
+    runs: int,
+) -> dict:
+    lm = LocalLm(
+        LmParams(
+            models_dir=models_dir,
+            draft_model=draft,
+            draft_tokens=draft_tokens,
+            cache_policy="never",
+            on_token=lambda t: None,
+        )
+    )
+    lm.load_model(model, 1024)
+    params = InferenceParams(max_tokens=max_tokens, temperature=0, stream=False)
+    # warm up the model
+    lm.infer(PROMPT, params)
+    samples = []
+    result = None
+    for _ in range(runs):
+        # evaluate the prompt again on each run
+        lm.llm.reset()  # type: ignore
+        start = time.perf_counter()
+        result = lm.infer(PROMPT, params)
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    stats = result["stats"]  # type: ignore
+    return {
+        "text": result["text"],  # type: ignore
+        "generated_tokens": stats.get("generated_tokens", 0),
+        "total_ms_median": samples[len(samples) // 2] * 1000,
+        "tokens_per_second": stats.get("generated_tokens", 0) / samples[len(samples) // 2],
+        "draft_acceptance_rate": stats.get("draft_acceptance_rate"),
+    }
+
+
+def main(
+    models_dir: str, model: str, draft: str, draft_tokens: int, max_tokens: int, runs: int
+):
+    modes = {"plain": None, "draft_model": draft, "prompt_lookup": "prompt_lookup"}
+    results = {
+        name: measure(models_dir, model, mode, draft_tokens, max_tokens, runs)
+        for name, mode in modes.items()
+        if name != "draft_model" or draft
+    }
+    plain = results["plain"]
+    texts = {name: res.pop("text") for name, res in results.items()}
+    for name, res in results.items():
+        res["speedup"] = res["tokens_per_second"] / plain["tokens_per_second"]
+        res["identical_output"] = texts[name] == texts["plain"]
+    print(
+        json.dumps(
+            {
+                "benchmark": "speculative",
+                "model": model,
+                "draft": draft,
+                "draft_tokens": draft_tokens,
+                "max_tokens": max_tokens,
+                "runs": runs,
+                "results": results,
+            },
+            indent=2,
+        )
+    )
+
+
+def arg(name: str, default: str) -> str:
+    if name in sys.argv:
+        return sys.argv[sys.argv.index(name) + 1]
+    return default
+
+
+if __name__ == "__main__":
+    main(
+        arg("--models-dir", "/tmp/models"),
+        arg("--model", "tiny.gguf"),
+        arg("--draft", ""),
+        int(arg("--draft-tokens", "8")),
+        int(arg("--max-tokens", "128")),
+        int(arg("--runs", "5")),
+    )
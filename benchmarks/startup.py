@@ -0,0 +1,56 @@
+# flake8: noqa: E501
+import json
+import subprocess
+import sys
+
+# measure the cold start cost of each provider: the import time, the resident
+# memory and whether the llama.cpp native library was loaded
+# > python -m benchmarks.startup
+# > python -m benchmarks.startup --runs 10
+
+PROVIDERS = ["LmProvider", "KoboldcppLm", "OllamaLm", "LocalLm"]
+
+CODE = """
+import json, resource, sys, time
+t = time.perf_counter()
+import locallm
+getattr(locallm, "{name}")
+elapsed = time.perf_counter() - t
+print(json.dumps({{
+    "import_time_ms": elapsed * 1000,
+    "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    "llama_cpp_loaded": "llama_cpp" in sys.modules,
+}}))
+"""
+
+
+def measure(name: str, runs: int) -> dict:
+    samples = []
+    for _ in range(runs):
+        res = subprocess.run(
+            [sys.executable, "-c", CODE.format(name=name)],
+            capture_output=True,
+            text=True,
+        )
+        if res.returncode != 0:
+            return {"error": res.stderr.strip().splitlines()[-1]}
+        samples.append(json.loads(res.stdout))
+    times = sorted(s["import_time_ms"] for s in samples)
+    return {
+        "import_time_ms_median": times[len(times) // 2],
+        "import_time_ms_min": times[0],
+        "max_rss_kb": max(s["max_rss_kb"] for s in samples),
+        "llama_cpp_loaded": samples[0]["llama_cpp_loaded"],
+    }
+
+
+def main(runs: int):
+    results = {name: measure(name, runs) for name in PROVIDERS}
+    print(json.dumps({"benchmark": "startup", "runs": runs, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    runs = 5
+    if "--runs" in sys.argv:
+        runs = int(sys.argv[sys.argv.index("--runs") + 1])
+    main(runs)
@@ -0,0 +1,113 @@
+# flake8: noqa: E501
+import json
+import sys
+import time
+from typing import Callable, List
+
+from locallm.stream import TokenConsumer, json_loads
+
+# measure the per token cost of the stream consumption: replay a recorded Ollama
+# ndjson stream of 8k tokens through the previous string concatenation loop and
+# through the token consumer, with per token and batched callbacks
+# > python -m benchmarks.stream
+# > python -m benchmarks.stream --stream recorded.ndjson --runs 10
+
+N_TOKENS = 8192
+
+WORDS = ["The", " planets", " of", " the", " solar", " system", " are", ",", " and", "\n"]
+
+
+def make_stream(n_tokens: int) -> List[bytes]:
+    lines = []
+    for i in range(n_tokens):
+        body = {
+            "model": "mistral",
+            "created_at": "2023-12-12T14:13:43.416799Z",
+            "response": WORDS[i % len(WORDS)],
+            "done": False,
+        }
+        lines.append(json.dumps(body).encode("utf-8"))
+    final = {"model": "mistral", "response": "", "done": True, "eval_count": n_tokens}
+    lines.append(json.dumps(final).encode("utf-8"))
+    return lines
+
+
+def read_stream(path: str) -> List[bytes]:
+    with open(path, "rb") as f:
+        return [line.rstrip(b"\n") for line in f if line.strip()]
+
+
+def concat_loop(lines: List[bytes]) -> str:
+    # the loop used before the token consumer
+    text = ""
+    for line in lines:
+        body = json.loads(line)
+        token = body.get("response", "")
+        on_token(token)
+        text = text + token
+    return text
+
+
+def consumer_loop(lines: List[bytes], **kwargs) -> str:
+    consumer = TokenConsumer(on_token, **kwargs)
+    for line in lines:
+        token = json_loads(line).get("response", "")
+        if token:
+            consumer.push(token)
+    return consumer.text()
+
+
+def on_token(token: str):
+    pass
+
+
+def measure(fn: Callable[[], str], runs: int, n_tokens: int) -> dict:
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    best = samples[0]
+    return {
+        "total_ms_median": samples[len(samples) // 2] * 1000,
+        "total_ms_min": best * 1000,
+        "per_token_us": best / n_tokens * 1e6,
+    }
+
+
+def main(lines: List[bytes], runs: int):
+    n = len(lines) - 1
+    results = {
+        "concat_json": measure(lambda: concat_loop(lines), runs, n),
+        "consumer": measure(lambda: consumer_loop(lines), runs, n),
+        "consumer_batch_16": measure(
+            lambda: consumer_loop(lines, batch_size=16), runs, n
+        ),
+        "consumer_batch_50ms": measure(
+            lambda: consumer_loop(lines, batch_ms=50), runs, n
+        ),
+    }
+    print(
+        json.dumps(
+            {
+                "benchmark": "stream",
+                "tokens": n,
+                "runs": runs,
+                "json_decoder": json_loads.__module__,
+                "results": results,
+            },
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    runs = 20
+    if "--runs" in sys.argv:
+        runs = int(sys.argv[sys.argv.index("--runs") + 1])
+    if "--stream" in sys.argv:
+        lines = read_stream(sys.argv[sys.argv.index("--stream") + 1])
+    else:
+        lines = make_stream(N_TOKENS)
+    main(lines, runs)
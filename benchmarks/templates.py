@@ -0,0 +1,71 @@
+# flake8: noqa: E501
+import inspect
+import json
+import sys
+import time
+from typing import Callable
+
+from examples.autodoc.templates.many import TEMPLATE
+from locallm.schemas import InferenceParams
+from locallm.templates import prompt_prefix, render_prompt
+
+# measure the per query cost of the prompt rendering with the long few shot
+# template of the autodoc example: the previous string replace, the compiled
+# template, and the rendered prefix lookup used by the prefix caches and the
+# context window checks
+# > python -m benchmarks.templates
+# > python -m benchmarks.templates --queries 100000
+
+N_QUERIES = 10000
+
+
+def measure(fn: Callable[[], None], queries: int) -> dict:
+    samples = []
+    for _ in range(5):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    return {
+        "total_ms_median": samples[len(samples) // 2] * 1000,
+        "per_query_us": samples[0] / queries * 1e6,
+    }
+
+
+def main(queries: int):
+    prompt = inspect.getsource(measure)
+    params = InferenceParams(template=TEMPLATE)
+
+    def replace():
+        for _ in range(queries):
+            tpl = params.template or "{prompt}"
+            tpl.replace("{prompt}", prompt)
+            tpl.split("{prompt}")[0]
+
+    def compiled():
+        for _ in range(queries):
+            render_prompt(prompt, params)
+            prompt_prefix(params)
+
+    results = {
+        "replace": measure(replace, queries),
+        "compiled": measure(compiled, queries),
+    }
+    print(
+        json.dumps(
+            {
+                "benchmark": "templates",
+                "template_chars": len(TEMPLATE),
+                "queries": queries,
+                "results": results,
+            },
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    queries = N_QUERIES
+    if "--queries" in sys.argv:
+        queries = int(sys.argv[sys.argv.index("--queries") + 1])
+    main(queries)
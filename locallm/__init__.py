@@ -1,28 +1,74 @@
 """An api to query local language models using different backends"""
+from importlib import import_module
 from importlib.metadata import version
+from typing import TYPE_CHECKING, Any
+from .cache import DiskCache, LruCache, ResponseCache
+from .cancel import CancelHandle
 from .provider import LmProvider
-from .providers.koboldcpp import KoboldcppLm
-from .providers.ollama import OllamaLm
-from .providers.local import LocalLm
+from .scheduler import DeadlineExceeded, Scheduler
+from .stream import Token
+from .structured import StructuredOutputError
 from .schemas import (
     InferenceParams,
+    LmEndpoint,
     LmParams,
     LmProviderType,
     OnTokenType,
     OnStartEmitType,
 )
 
+if TYPE_CHECKING:
+    from .providers.koboldcpp import KoboldcppLm
+    from .providers.ollama import OllamaLm
+    from .providers.local import LocalLm
+    from .providers.balanced import BalancedLm
+    from .providers.local_pool import LocalPoolLm
+
 __pkgname__ = "locallm"
 __version__ = version(__pkgname__)
 
 __all__ = [
+    "CancelHandle",
+    "DiskCache",
+    "LruCache",
+    "ResponseCache",
     "LmProvider",
+    "DeadlineExceeded",
+    "Scheduler",
+    "StructuredOutputError",
+    "Token",
     "KoboldcppLm",
     "OllamaLm",
     "LocalLm",
+    "BalancedLm",
+    "LocalPoolLm",
     "InferenceParams",
+    "LmEndpoint",
     "LmParams",
     "LmProviderType",
     "OnTokenType",
     "OnStartEmitType",
 ]
+
+# the providers are imported on first access: an http only deployment never
+# loads the llama.cpp native library
+_lazy_imports = {
+    "KoboldcppLm": ".providers.koboldcpp",
+    "OllamaLm": ".providers.ollama",
+    "LocalLm": ".providers.local",
+    "BalancedLm": ".providers.balanced",
+    "LocalPoolLm": ".providers.local_pool",
+}
+
+
+def __getattr__(name: str) -> Any:
+    if name in _lazy_imports:
+        module = import_module(_lazy_imports[name], __name__)
+        value = getattr(module, name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals().keys()) + list(_lazy_imports.keys()))
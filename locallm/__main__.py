@@ -0,0 +1,183 @@
+import argparse
+import json
+from pathlib import Path
+from typing import List, Optional
+
+from .provider import LmProvider
+from .schemas import LmParams
+
+# > python -m locallm serve --provider ollama --model mistral --ctx 4096
+# > python -m locallm serve --provider local --models-dir ~/models --model m.gguf
+# > python -m locallm serve --provider local_pool --workers 4 --models-dir ~/models
+#   --model m.gguf --max-in-flight 4
+# > python -m locallm autotune --models-dir ~/models --model m.gguf
+
+
+def make_provider(args: argparse.Namespace) -> LmProvider:
+    """
+    Create the provider of the command line arguments and load its model
+
+    Args:
+        args (argparse.Namespace): The parsed arguments.
+
+    Returns:
+        LmProvider: The provider.
+    """
+    params = LmParams(
+        models_dir=args.models_dir,
+        server_url=args.server_url,
+        threads=args.threads,
+        gpu_layers=args.gpu_layers,
+        workers=args.workers,
+        n_batch=args.n_batch,
+        threads_batch=args.threads_batch,
+        use_mmap=False if args.no_mmap else None,
+        use_mlock=args.mlock or None,
+        type_k=args.type_k,
+        type_v=args.type_v,
+        profiles_file=args.profiles_file,
+        # the tokens are sent to the clients, not to the terminal
+        on_token=lambda t: None,
+        is_verbose=args.verbose,
+    )
+    lm: LmProvider
+    if args.provider == "local":
+        from .providers.local import LocalLm
+
+        lm = LocalLm(params)
+    elif args.provider == "local_pool":
+        from .providers.local_pool import LocalPoolLm
+
+        lm = LocalPoolLm(params)
+    elif args.provider == "koboldcpp":
+        from .providers.koboldcpp import KoboldcppLm
+
+        lm = KoboldcppLm(params)
+    else:
+        from .providers.ollama import OllamaLm
+
+        lm = OllamaLm(params)
+    lm.load_model(args.model or "", args.ctx)
+    return lm
+
+
+def serve(args: argparse.Namespace):
+    from .server import LmServer
+
+    lm = make_provider(args)
+    server = LmServer(
+        lm,
+        chat_format=args.chat_format,
+        max_in_flight=args.max_in_flight,
+        max_queue=args.max_queue,
+        model_name=args.model_name,
+    )
+    server.run(args.host, args.port, args.shutdown_timeout)
+
+
+def autotune(args: argparse.Namespace):
+    from .providers.tuning import autotune, kv_cache_type, save_profile
+
+    params = {}
+    if args.gpu_layers:
+        params["n_gpu_layers"] = args.gpu_layers
+    if args.no_mmap:
+        params["use_mmap"] = False
+    if args.type_k:
+        params["type_k"] = kv_cache_type(args.type_k)
+    if args.type_v:
+        params["type_v"] = kv_cache_type(args.type_v)
+    profile = autotune(
+        str(Path(args.models_dir) / args.model),
+        args.ctx,
+        [int(n) for n in args.threads.split(",")] if args.threads else None,
+        [int(n) for n in args.batch.split(",")] if args.batch else None,
+        args.prompt_tokens,
+        args.generated_tokens,
+        args.runs,
+        params,
+        on_result=lambda res: print(json.dumps(res)),
+    )
+    print(json.dumps(profile, indent=2))
+    if args.dry_run is False:
+        save_profile(args.model, profile, args.profiles_file)
+
+
+def add_model_args(cmd: argparse.ArgumentParser):
+    # the model loading settings of the local providers
+    cmd.add_argument("--gpu-layers", type=int)
+    cmd.add_argument("--no-mmap", action="store_true", help="Read the model file")
+    cmd.add_argument("--type-k", help="The key cache type: f16, q8_0, q4_0...")
+    cmd.add_argument("--type-v", help="The value cache type: f16, q8_0, q4_0...")
+    cmd.add_argument(
+        "--profiles-file", help="The autotune profiles file of the local providers"
+    )
+
+
+def parser() -> argparse.ArgumentParser:
+    """
+    Build the command line parser
+
+    Returns:
+        argparse.ArgumentParser: The parser.
+    """
+    main = argparse.ArgumentParser(prog="python -m locallm")
+    commands = main.add_subparsers(dest="command", required=True)
+    cmd = commands.add_parser("serve", help="Run an OpenAI compatible http server")
+    cmd.add_argument(
+        "--provider",
+        choices=["local", "local_pool", "koboldcpp", "ollama"],
+        default="ollama",
+    )
+    cmd.add_argument("--model", help="The model name or file")
+    cmd.add_argument("--model-name", help="The model name in the responses")
+    cmd.add_argument("--ctx", type=int, default=2048, help="The context window size")
+    cmd.add_argument("--models-dir", help="The models directory of the local provider")
+    cmd.add_argument("--server-url", help="The url of the inference server")
+    cmd.add_argument("--threads", type=int)
+    cmd.add_argument("--threads-batch", type=int)
+    cmd.add_argument("--n-batch", type=int, help="The prompt evaluation batch size")
+    cmd.add_argument("--mlock", action="store_true", help="Lock the model in memory")
+    add_model_args(cmd)
+    cmd.add_argument("--workers", type=int, help="The processes of the local pool")
+    cmd.add_argument(
+        "--chat-format", choices=["mistral", "chatml", "llama3"], default="chatml"
+    )
+    cmd.add_argument("--host", default="127.0.0.1")
+    cmd.add_argument("--port", type=int, default=8000)
+    cmd.add_argument(
+        "--max-in-flight", type=int, help="The queries running at once on the backend"
+    )
+    cmd.add_argument(
+        "--max-queue", type=int, help="The waiting queries before rejecting with 429"
+    )
+    cmd.add_argument("--shutdown-timeout", type=float, default=30)
+    cmd.add_argument("--verbose", action="store_true")
+    cmd.set_defaults(run=serve)
+    cmd = commands.add_parser(
+        "autotune",
+        help="Find the fastest threads and batch size of a local model on this host",
+    )
+    cmd.add_argument("--models-dir", required=True)
+    cmd.add_argument("--model", required=True, help="The model file")
+    cmd.add_argument("--ctx", type=int, default=2048, help="The context window size")
+    cmd.add_argument("--threads", help="The thread counts to try: 4,8,16")
+    cmd.add_argument("--batch", help="The batch sizes to try: 256,512")
+    cmd.add_argument("--prompt-tokens", type=int, default=512)
+    cmd.add_argument("--generated-tokens", type=int, default=64)
+    cmd.add_argument("--runs", type=int, default=3)
+    add_model_args(cmd)
+    cmd.add_argument(
+        "--dry-run", action="store_true", help="Print the profile without saving it"
+    )
+    cmd.set_defaults(run=autotune)
+    return main
+
+
+def main(argv: Optional[List[str]] = None):
+    args = parser().parse_args(argv)
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+import asyncio
+import threading
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, TypeVar
+
+from .stream import json_loads
+
+T = TypeVar("T")
+
+DEFAULT_QUEUE_SIZE = 64
+
+_DONE = object()
+
+
+async def iterate_in_executor(
+    iterator_factory: Callable[[], Iterator[T]],
+    maxsize: int = DEFAULT_QUEUE_SIZE,
+    executor: Any = None,
+) -> AsyncIterator[T]:
+    """
+    Run a blocking iterator in an executor and consume it from the event loop. The
+    items are passed through a bounded queue: the producer thread waits when the
+    consumer is late, and stops when the consumer goes away.
+
+    Args:
+        iterator_factory (Callable[[], Iterator[T]]): A function that returns the
+            blocking iterator. It is called in the executor.
+        maxsize (int, optional): The maximum number of pending items. Defaults
+            to 64.
+        executor (Any, optional): The executor to use. Defaults to None: the loop's
+            default executor.
+
+    Yields:
+        T: The items of the iterator.
+
+    Example:
+        >>> async for token in iterate_in_executor(lambda: iter(["a", "b"])):
+        >>>     print(token)
+    """
+    loop = asyncio.get_running_loop()
+    # the producer hands the items over with call_soon_threadsafe and waits for
+    # some space in the queue on a semaphore
+    queue: asyncio.Queue = asyncio.Queue()
+    space = threading.Semaphore(maxsize)
+    stopped = False
+
+    def put(item: Any, error: BaseException | None = None):
+        loop.call_soon_threadsafe(queue.put_nowait, (item, error))
+
+    def produce():
+        if stopped:
+            return
+        iterator = None
+        try:
+            iterator = iterator_factory()
+            for item in iterator:
+                space.acquire()
+                if stopped:
+                    break
+                put(item)
+        except BaseException as e:
+            put(_DONE, e)
+            return
+        finally:
+            if hasattr(iterator, "close"):
+                iterator.close()  # type: ignore
+        put(_DONE)
+
+    future = loop.run_in_executor(executor, produce)
+    try:
+        while True:
+            item, error = await queue.get()
+            if item is _DONE:
+                if error is not None:
+                    raise error
+                break
+            space.release()
+            yield item
+    finally:
+        stopped = True
+        # unblock the producer if it waits for some queue space
+        space.release()
+        await future
+
+
+async def iter_ndjson(response: Any) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Decode a newline delimited json stream from an aiohttp response
+
+    Args:
+        response (aiohttp.ClientResponse): The streaming response.
+
+    Yields:
+        Dict[str, Any]: The decoded json objects.
+    """
+    async for line in response.content:
+        if line.strip():
+            yield json_loads(line)
+
+
+async def iter_sse(response: Any) -> AsyncIterator[str]:
+    """
+    Decode a server sent events stream from an aiohttp response
+
+    Args:
+        response (aiohttp.ClientResponse): The streaming response.
+
+    Yields:
+        str: The data of each event.
+    """
+    data = []
+    async for raw in response.content:
+        line = raw.decode("utf-8").rstrip("\r\n")
+        if line == "":
+            if len(data) > 0:
+                yield "\n".join(data)
+                data = []
+        elif line.startswith("data:"):
+            value = line[5:]
+            # a single leading space is part of the field separator
+            data.append(value[1:] if value.startswith(" ") else value)
+    if len(data) > 0:
+        yield "\n".join(data)
@@ -0,0 +1,251 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+from .schemas import InferenceParams, InferenceResult
+
+# the params that do not change the generated text
+_IGNORED_PARAMS = {"stream", "threads", "template"}
+
+
+class ResponseCache(ABC):
+    """
+    An abstract base class for the inference results caches.
+
+    Attributes:
+        hits (int): The number of lookups that found a result.
+        misses (int): The number of lookups that found nothing.
+        evictions (int): The number of results removed to respect the size limits.
+    """
+
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[InferenceResult]:
+        """
+        Get a result from the cache
+
+        Args:
+            key (str): The cache key.
+
+        Returns:
+            Optional[InferenceResult]: The result or None if not found.
+        """
+        pass
+
+    @abstractmethod
+    def set(self, key: str, value: InferenceResult):
+        """
+        Store a result in the cache
+
+        Args:
+            key (str): The cache key.
+            value (InferenceResult): The result to store.
+        """
+        pass
+
+    @abstractmethod
+    def clear(self):
+        """Remove all the results from the cache"""
+        pass
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        """The hits, misses and evictions counters"""
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+class LruCache(ResponseCache):
+    """
+    An in memory cache that evicts the least recently used results.
+
+    Args:
+        max_items (Optional[int], optional): The maximum number of results to keep.
+            Defaults to 1024.
+        max_bytes (Optional[int], optional): The maximum size of the stored
+            results in bytes. Defaults to None: no limit.
+
+    Example:
+        >>> cache = LruCache(max_bytes=64 * 1024 * 1024)
+        >>> lm = OllamaLm(LmParams(cache=cache))
+    """
+
+    def __init__(
+        self, max_items: Optional[int] = 1024, max_bytes: Optional[int] = None
+    ) -> None:
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._data: OrderedDict[str, Tuple[InferenceResult, int]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[InferenceResult]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key: str, value: InferenceResult):
+        size = len(json.dumps(value))
+        with self._lock:
+            if key in self._data:
+                self.size -= self._data.pop(key)[1]
+            self._data[key] = (value, size)
+            self.size += size
+            while len(self._data) > 1 and (
+                (self.max_items is not None and len(self._data) > self.max_items)
+                or (self.max_bytes is not None and self.size > self.max_bytes)
+            ):
+                _, (_, evicted_size) = self._data.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class DiskCache(ResponseCache):
+    """
+    A persistent cache stored in a sqlite database. The least recently used
+    results are evicted.
+
+    Args:
+        path (str | Path): The path of the database file.
+        max_items (Optional[int], optional): The maximum number of results to keep.
+            Defaults to None: no limit.
+        max_bytes (Optional[int], optional): The maximum size of the stored
+            results in bytes. Defaults to None: no limit.
+
+    Example:
+        >>> cache = DiskCache("/home/me/.cache/locallm.db", max_bytes=2 * 1024**3)
+        >>> lm = KoboldcppLm(LmParams(cache=cache))
+    """
+
+    def __init__(
+        self,
+        path: str | Path,
+        max_items: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+    ) -> None:
+        self.path = Path(path)
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS results "
+            "(key TEXT PRIMARY KEY, value TEXT, size INTEGER, atime REAL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS results_atime ON results(atime)")
+        self._db.commit()
+
+    def get(self, key: str) -> Optional[InferenceResult]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._db.execute(
+                "UPDATE results SET atime = ? WHERE key = ?", (time.time(), key)
+            )
+            self._db.commit()
+            self.hits += 1
+            return json.loads(row[0])
+
+    def set(self, key: str, value: InferenceResult):
+        data = json.dumps(value)
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                (key, data, len(data), time.time()),
+            )
+            self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        count, size = self._db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results"
+        ).fetchone()
+        while count > 1 and (
+            (self.max_items is not None and count > self.max_items)
+            or (self.max_bytes is not None and size > self.max_bytes)
+        ):
+            key, evicted_size = self._db.execute(
+                "SELECT key, size FROM results ORDER BY atime LIMIT 1"
+            ).fetchone()
+            self._db.execute("DELETE FROM results WHERE key = ?", (key,))
+            count -= 1
+            size -= evicted_size
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM results")
+            self._db.commit()
+
+    def close(self):
+        """Close the database"""
+        self._db.close()
+
+
+def is_deterministic(params: InferenceParams) -> bool:
+    """
+    Check if the sampling params always produce the same output for a prompt
+
+    Args:
+        params (InferenceParams): The inference params.
+
+    Returns:
+        bool: True for greedy sampling.
+
+    Example:
+        >>> is_deterministic(InferenceParams(temperature=0))
+        True
+    """
+    return params.temperature == 0 or params.top_k == 1
+
+
+def cache_key(
+    ptype: str, model: str, ctx: int, final_prompt: str, params: InferenceParams
+) -> str:
+    """
+    Build a cache key for a query
+
+    Args:
+        ptype (str): The provider type.
+        model (str): The loaded model name.
+        ctx (int): The context window size.
+        final_prompt (str): The prompt rendered with its template.
+        params (InferenceParams): The inference params.
+
+    Returns:
+        str: A sha256 hex digest.
+    """
+    normalized: Dict[str, Any] = {
+        k: v
+        for k, v in params.model_dump(exclude_none=True).items()
+        if k not in _IGNORED_PARAMS
+    }
+    raw = json.dumps(
+        [ptype, model, ctx, final_prompt, normalized], sort_keys=True
+    ).encode("utf-8")
+    return hashlib.sha256(raw).hexdigest()
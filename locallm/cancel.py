@@ -0,0 +1,125 @@
+import threading
+import uuid
+from typing import Callable, Generic, Iterator, List, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class CancelHandle:
+    """
+    A handle to cancel a running inference query. The providers check it between
+    the tokens and free the backend when it is cancelled.
+
+    Attributes:
+        genkey (str): A unique key for the generation. The Koboldcpp provider
+            sends it to the server to be able to abort the generation.
+        cancelled (bool): Whether the query has been cancelled.
+        finished (bool): Whether the query is finished.
+
+    Example:
+        >>> handle = CancelHandle()
+        >>> threading.Timer(2, handle.cancel).start()
+        >>> lm.infer("List the planets in the solar system", handle=handle)
+    """
+
+    genkey: str
+    cancelled: bool = False
+    finished: bool = False
+
+    def __init__(self, genkey: Optional[str] = None) -> None:
+        self.genkey = genkey or "KCPP" + uuid.uuid4().hex[:12]
+        self._callbacks: List[Callable[[], None]] = []
+        self._lock = threading.Lock()
+
+    def on_cancel(self, callback: Callable[[], None]):
+        """
+        Register a function to call when the query is cancelled. It is called
+        right away if the query has already been cancelled.
+
+        Args:
+            callback (Callable[[], None]): The function to call.
+        """
+        with self._lock:
+            if not self.cancelled:
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def cancel(self):
+        """Cancel the query. It has no effect if the query is finished"""
+        with self._lock:
+            if self.cancelled or self.finished:
+                return
+            self.cancelled = True
+            callbacks = self._callbacks
+            self._callbacks = []
+        for callback in callbacks:
+            callback()
+
+    def finish(self):
+        """Mark the query as finished: the cancel callbacks will not run anymore"""
+        with self._lock:
+            self.finished = True
+            self._callbacks = []
+
+
+class GenerationStream(Generic[T]):
+    """
+    An iterator over a running generation that can be cancelled. The stream stops
+    at the next item once its handle is cancelled.
+
+    Attributes:
+        handle (CancelHandle): The cancellation handle of the generation.
+
+    Example:
+        >>> stream = lm.generate("List the planets in the solar system")
+        >>> for item in stream:
+        >>>     if client_is_gone():
+        >>>         stream.cancel()
+    """
+
+    handle: CancelHandle
+
+    def __init__(
+        self,
+        iterator: Iterator[T],
+        handle: CancelHandle,
+        on_close: Optional[Callable[[], None]] = None,
+    ) -> None:
+        self.handle = handle
+        self._iterator = iterator
+        self._on_close = on_close
+        self._closed = False
+
+    def __iter__(self) -> "GenerationStream[T]":
+        return self
+
+    def __next__(self) -> T:
+        if self._closed:
+            raise StopIteration
+        if self.handle.cancelled:
+            self.close()
+            raise StopIteration
+        try:
+            return next(self._iterator)
+        except StopIteration:
+            self.close()
+            raise
+        except Exception:
+            self.close()
+            if self.handle.cancelled:
+                raise StopIteration
+            raise
+
+    def cancel(self):
+        """Cancel the generation"""
+        self.handle.cancel()
+
+    def close(self):
+        """Release the resources of the generation"""
+        if self._closed:
+            return
+        self._closed = True
+        self.handle.finish()
+        if self._on_close is not None:
+            self._on_close()
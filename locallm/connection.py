@@ -0,0 +1,169 @@
+import asyncio
+import threading
+import weakref
+from typing import Any, Dict, Optional, Tuple
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_POOL_SIZE = 10
+
+_sessions: Dict[Tuple[str, int, bool], requests.Session] = {}
+_lock = threading.Lock()
+# the aiohttp sessions are bound to an event loop: keep one pool per loop, with
+# the async generator that closes it at the loop shutdown
+_async_sessions: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def get_session(
+    server_url: str,
+    pool_size: Optional[int] = None,
+    keep_alive: Optional[bool] = None,
+) -> requests.Session:
+    """
+    Get a pooled http session for a server. The sessions are shared between the
+    providers that use the same server url and pool settings, so that the tcp
+    connections are reused across instances and calls.
+
+    Args:
+        server_url (str): The base url of the server.
+        pool_size (Optional[int], optional): The maximum number of connections
+            to keep in the pool. Defaults to 10.
+        keep_alive (Optional[bool], optional): Keep the connections open between
+            the requests. Defaults to True.
+
+    Returns:
+        requests.Session: The shared session for this server.
+
+    Example:
+        >>> session = get_session("http://localhost:5001", pool_size=4)
+        >>> session.get("http://localhost:5001/api/v1/model")
+    """
+    size = pool_size or DEFAULT_POOL_SIZE
+    alive = keep_alive is not False
+    key = (server_url, size, alive)
+    with _lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=size)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            if not alive:
+                session.headers["Connection"] = "close"
+            _sessions[key] = session
+    return session
+
+
+def close_sessions():
+    """Close all the pooled http sessions and their connections"""
+    with _lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+def get_async_session(
+    server_url: str,
+    pool_size: Optional[int] = None,
+    keep_alive: Optional[bool] = None,
+) -> Any:
+    """
+    Get a pooled aiohttp session for a server in the running event loop. The
+    sessions are shared between the providers that use the same server url and
+    pool settings. Requires the `aiohttp` package: `pip install locallm[async]`
+
+    Args:
+        server_url (str): The base url of the server.
+        pool_size (Optional[int], optional): The maximum number of connections
+            to keep in the pool. Defaults to 10.
+        keep_alive (Optional[bool], optional): Keep the connections open between
+            the requests. Defaults to True.
+
+    Returns:
+        aiohttp.ClientSession: The shared session for this server and loop.
+
+    Example:
+        >>> session = get_async_session("http://localhost:11434")
+        >>> async with session.get("http://localhost:11434/api/tags") as res:
+        >>>     print(await res.json())
+    """
+    try:
+        import aiohttp
+    except ImportError:
+        raise ImportError(
+            "The async api requires the aiohttp package: pip install locallm[async]"
+        )
+    loop = asyncio.get_running_loop()
+    size = pool_size or DEFAULT_POOL_SIZE
+    alive = keep_alive is not False
+    key = (server_url, size, alive)
+    if loop not in _async_sessions:
+        sessions: Dict[Tuple[str, int, bool], Any] = {}
+        closer = _close_at_shutdown(sessions)
+        _start(closer)
+        _async_sessions[loop] = (sessions, closer)
+    sessions = _async_sessions[loop][0]
+    session = sessions.get(key)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit=size, force_close=not alive)
+        session = aiohttp.ClientSession(connector=connector)
+        sessions[key] = session
+    return session
+
+
+async def aclose_sessions():
+    """
+    Close the pooled aiohttp sessions of the running event loop. They are also
+    closed when the loop shuts down its async generators, as `asyncio.run` does
+    """
+    entry = _async_sessions.pop(asyncio.get_running_loop(), None)
+    if entry is not None:
+        sessions, closer = entry
+        await _close(sessions)
+        await closer.aclose()
+
+
+async def _close(sessions: Dict[Tuple[str, int, bool], Any]):
+    for session in sessions.values():
+        await session.close()
+    sessions.clear()
+
+
+async def _close_at_shutdown(sessions: Dict[Tuple[str, int, bool], Any]):
+    # a suspended async generator: the loop closes it before it closes itself
+    try:
+        yield
+    finally:
+        await _close(sessions)
+
+
+def _start(closer: Any):
+    # run the closer to its yield now: the loop registers it on its first
+    # iteration and closes it at shutdown
+    try:
+        closer.asend(None).send(None)
+    except StopIteration:
+        pass
+
+
+def get_async_timeout(
+    connect_timeout: Optional[float] = None,
+    read_timeout: Optional[float] = None,
+) -> Any:
+    """
+    Build an aiohttp timeout. A `None` value means no timeout.
+
+    Args:
+        connect_timeout (Optional[float], optional): The connection timeout in
+            seconds. Defaults to None.
+        read_timeout (Optional[float], optional): The read timeout in seconds.
+            Defaults to None.
+
+    Returns:
+        aiohttp.ClientTimeout: The timeout settings.
+    """
+    import aiohttp
+
+    return aiohttp.ClientTimeout(
+        total=None, sock_connect=connect_timeout, sock_read=read_timeout
+    )
@@ -0,0 +1,158 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, Dict, Optional, Sequence
+
+if TYPE_CHECKING:
+    import numpy as np
+
+DEFAULT_BATCH_SIZE = 32
+
+DEFAULT_MAX_ITEMS = 65536
+
+
+def import_numpy() -> Any:
+    """
+    Import numpy, that the embeddings api requires
+
+    Raises:
+        ImportError: If numpy is not installed.
+
+    Returns:
+        module: The numpy module.
+    """
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError(
+            "The embeddings api requires the numpy package: "
+            "pip install locallm[embeddings]"
+        )
+    return numpy
+
+
+def to_matrix(rows: Sequence[Any]) -> "np.ndarray":
+    """
+    Convert the embeddings returned by a backend to a float32 matrix. The token
+    level embeddings of the models without pooling are mean pooled
+
+    Args:
+        rows (Sequence[Any]): One embedding per text, as lists of floats or lists
+            of token embeddings.
+
+    Returns:
+        np.ndarray: A contiguous (texts, dimensions) float32 matrix.
+    """
+    numpy = import_numpy()
+    if len(rows) > 0 and len(rows[0]) > 0 and isinstance(rows[0][0], list):
+        matrix = numpy.empty((len(rows), len(rows[0][0])), dtype=numpy.float32)
+        for i, tokens in enumerate(rows):
+            matrix[i] = numpy.asarray(tokens, dtype=numpy.float32).mean(axis=0)
+        return matrix
+    return numpy.ascontiguousarray(rows, dtype=numpy.float32)
+
+
+def l2_normalize(matrix: "np.ndarray") -> "np.ndarray":
+    """
+    Normalize the rows of a matrix to unit length, in place. The zero rows are
+    left as is
+
+    Args:
+        matrix (np.ndarray): The embeddings matrix.
+
+    Returns:
+        np.ndarray: The same matrix.
+    """
+    numpy = import_numpy()
+    norms = numpy.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    matrix /= norms
+    return matrix
+
+
+class EmbeddingCache:
+    """
+    An in memory cache of the embeddings, keyed by a hash of the model name and
+    the text. The least recently used embeddings are evicted.
+
+    Args:
+        max_items (int, optional): The maximum number of embeddings to keep.
+            Defaults to 65536.
+
+    Example:
+        >>> cache = EmbeddingCache(max_items=1_000_000)
+        >>> cache.set(cache.key("nomic-embed-text", text), vector)
+    """
+
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+    def __init__(self, max_items: int = DEFAULT_MAX_ITEMS) -> None:
+        self.max_items = max_items
+        self._data: OrderedDict[bytes, "np.ndarray"] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(model: str, text: str) -> bytes:
+        """
+        Get the cache key of a text
+
+        Args:
+            model (str): The name of the embeddings model.
+            text (str): The text.
+
+        Returns:
+            bytes: The cache key.
+        """
+        h = hashlib.blake2b(model.encode("utf-8"), digest_size=16)
+        h.update(b"\0")
+        h.update(text.encode("utf-8"))
+        return h.digest()
+
+    def get(self, key: bytes) -> Optional["np.ndarray"]:
+        """
+        Get an embedding from the cache
+
+        Args:
+            key (bytes): The cache key.
+
+        Returns:
+            Optional[np.ndarray]: The embedding or None if not found.
+        """
+        with self._lock:
+            vector = self._data.get(key)
+            if vector is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return vector
+
+    def set(self, key: bytes, vector: "np.ndarray"):
+        """
+        Store an embedding in the cache
+
+        Args:
+            key (bytes): The cache key.
+            vector (np.ndarray): The embedding.
+        """
+        with self._lock:
+            self._data[key] = vector
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_items:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """Remove all the embeddings from the cache"""
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        """The hits, misses and evictions counters"""
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
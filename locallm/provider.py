@@ -1,15 +1,49 @@
 from abc import ABC, abstractmethod
-from typing import Optional, Iterator, Any
-from llama_cpp import Llama
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import (
+    TYPE_CHECKING,
+    Optional,
+    Any,
+    AsyncIterator,
+    Dict,
+    Iterator,
+    List,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
+from .cache import LruCache, ResponseCache, cache_key, is_deterministic
+from .cancel import CancelHandle, GenerationStream
+from .embeddings import (
+    DEFAULT_BATCH_SIZE,
+    EmbeddingCache,
+    import_numpy,
+    l2_normalize,
+)
+from .stop import StopMatcher
+from .stream import TokenConsumer
+from .templates import prompt_prefix, render_prompt
+from .structured import JsonValidator, SchemaType, parse_output, schema_dict
+from .tokens import TokenCounts, estimate_tokens, trim_text
 from .schemas import (
     InferenceParams,
     InferenceResult,
+    CachePolicyType,
+    TruncateType,
     LmParams,
+    OnResultType,
     OnStartEmitType,
     OnTokenType,
     LmProviderType,
 )
 
+if TYPE_CHECKING:
+    import numpy as np
+    from llama_cpp import Llama
+
+BatchItemType = Union[str, Tuple[str, InferenceParams]]
+
 
 def defaultOnToken(token: str):
     print(token, end="", flush=True)
@@ -40,6 +74,24 @@ class LmProvider(ABC):
         outputs the token to the terminal
     on_start_emit : OnStartEmitType
         The function to be called when the model starts emitting tokens.
+    handles : Set[CancelHandle]
+        The cancellation handles of the running queries.
+    cache : Optional[ResponseCache]
+        The cache for the inference results.
+    cache_policy : CachePolicyType
+        When to use the cache. Default: only for the greedy sampling queries
+    max_batch_concurrency : Optional[int]
+        The maximum number of queries that the provider can run at once in a
+        batch. Default: no limit
+    token_batch_size : Optional[int]
+        Pass the tokens to on_token by batches of this size. Default: one call
+        per token
+    token_batch_ms : Optional[float]
+        Pass the tokens to on_token at most every n milliseconds
+    embedding_batch_size : int
+        The number of texts per embeddings request. Default: 32
+    embedding_cache : Optional[EmbeddingCache]
+        The cache for the embeddings.
 
     Example
     -------
@@ -48,7 +100,7 @@ class LmProvider(ABC):
     """
 
     ptype: LmProviderType
-    llm: Optional[Llama] = None
+    llm: Optional["Llama"] = None
     models_dir: str = ""
     loaded_model: str = ""
     api_key: str = ""
@@ -56,6 +108,16 @@ class LmProvider(ABC):
     is_verbose = False
     on_token: OnTokenType | None = None
     on_start_emit: OnStartEmitType | None = None
+    ctx: int = 2048
+    handles: Set[CancelHandle]
+    max_batch_concurrency: Optional[int] = None
+    cache: Optional[ResponseCache] = None
+    cache_policy: CachePolicyType = "deterministic"
+    token_batch_size: Optional[int] = None
+    token_batch_ms: Optional[float] = None
+    embedding_batch_size: int = DEFAULT_BATCH_SIZE
+    embedding_cache: Optional[EmbeddingCache] = None
+    _token_counts: TokenCounts
 
     @abstractmethod
     def __init__(
@@ -107,6 +169,7 @@ class LmProvider(ABC):
         self,
         prompt: str,
         params: InferenceParams = InferenceParams(),
+        handle: Optional[CancelHandle] = None,
     ) -> InferenceResult:
         """
         Run an inference query.
@@ -117,6 +180,8 @@ class LmProvider(ABC):
             The prompt to generate text from.
         params : InferenceParams
             The parameters for the inference query.
+        handle : Optional[CancelHandle]
+            A handle to cancel the query from another thread.
 
         Returns
         -------
@@ -138,7 +203,9 @@ class LmProvider(ABC):
         self,
         prompt: str,
         params: InferenceParams = InferenceParams(),
-    ) -> Iterator[Any]:
+        handle: Optional[CancelHandle] = None,
+        raw: bool = False,
+    ) -> GenerationStream[Any]:
         """
         Run an inference query for a prompt and params
 
@@ -146,24 +213,506 @@ class LmProvider(ABC):
             prompt (str): The prompt to use for the inference.
             params (InferenceParams, optional): The inference parameters. Defaults to
                 InferenceParams().
+            handle (Optional[CancelHandle], optional): A handle to cancel the
+                query. Defaults to None: a new handle is created.
+            raw (bool, optional): Iterate over the token texts only, for the
+                lowest per token cost. Defaults to False.
 
         Returns:
-            InferenceResult: The result of the inference.
+            GenerationStream[Any]: The stream iterator of `Token` records, or of
+                texts if raw. The last record holds the stats of the query. Use its
+                `cancel` method to stop the generation.
 
         Raises:
             Exception: If no model is loaded. Use the load_model method first.
 
         Example:
-            >>> from locallm import GoinferLm, LmParams
-            >>> lm = GoinferLm(LmParams(api_key="5dz78.."))
-            >>> lm.load_model('my_model.gguf', 2048)
-            >>> stream = lm.infer("What is the capital of France?")
-            >>> for (line in stream):
-            >>>     # process the line
+            >>> from locallm import OllamaLm, LmParams
+            >>> lm = OllamaLm(LmParams())
+            >>> lm.load_model('my_model', 2048)
+            >>> stream = lm.generate("What is the capital of France?")
+            >>> for token in stream:
+            >>>     print(token.text, end="")
         """
         pass
 
     @abstractmethod
-    def abort(self):
-        """Abort a running inference query"""
+    async def ainfer(
+        self,
+        prompt: str,
+        params: InferenceParams = InferenceParams(),
+        handle: Optional[CancelHandle] = None,
+    ) -> InferenceResult:
+        """
+        Run an inference query without blocking the event loop.
+
+        Args:
+            prompt (str): The prompt to generate text from.
+            params (InferenceParams, optional): The inference parameters. Defaults to
+                InferenceParams().
+            handle (Optional[CancelHandle], optional): A handle to cancel the
+                query. Defaults to None.
+
+        Returns:
+            InferenceResult: The generated text and the stats if any
+
+        Example:
+            >>> result = await lm.ainfer("What is the capital of France?")
+            >>> print(result["text"])
+        """
+        pass
+
+    @abstractmethod
+    def agenerate(
+        self,
+        prompt: str,
+        params: InferenceParams = InferenceParams(),
+        handle: Optional[CancelHandle] = None,
+    ) -> AsyncIterator[str]:
+        """
+        Run an inference query and iterate over the generated tokens without
+        blocking the event loop.
+
+        Args:
+            prompt (str): The prompt to generate text from.
+            params (InferenceParams, optional): The inference parameters. Defaults to
+                InferenceParams().
+            handle (Optional[CancelHandle], optional): A handle to cancel the
+                query. Defaults to None. Leaving the iteration also stops the
+                generation.
+
+        Returns:
+            AsyncIterator[str]: The generated tokens
+
+        Example:
+            >>> async for token in lm.agenerate("What is the capital of France?"):
+            >>>     print(token, end="")
+        """
+        pass
+
+    def infer_many(
+        self,
+        prompts: Sequence[BatchItemType],
+        params: InferenceParams = InferenceParams(),
+        max_concurrency: int = 1,
+        on_result: Optional[OnResultType] = None,
+    ) -> List[InferenceResult]:
+        """
+        Run a batch of inference queries. The tokens are not emitted: use the
+        `on_result` callback to follow the progress.
+
+        Args:
+            prompts (Sequence[BatchItemType]): The prompts, or (prompt, params)
+                pairs to override the default params.
+            params (InferenceParams, optional): The default inference parameters.
+                Defaults to InferenceParams().
+            max_concurrency (int, optional): The maximum number of queries to run
+                at once. Defaults to 1.
+            on_result (Optional[OnResultType], optional): A function called with
+                the index and the result of each query as it completes. Defaults
+                to None.
+
+        Returns:
+            List[InferenceResult]: The results, in the order of the prompts.
+
+        Example:
+            >>> results = lm.infer_many(["Hello", "Hi"], max_concurrency=2)
+            >>> print([res["text"] for res in results])
+        """
+        results: List[Optional[InferenceResult]] = [None] * len(prompts)
+        for index, result in self.iter_many(prompts, params, max_concurrency):
+            results[index] = result
+            if on_result is not None:
+                on_result(index, result)
+        return results  # type: ignore
+
+    def iter_many(
+        self,
+        prompts: Sequence[BatchItemType],
+        params: InferenceParams = InferenceParams(),
+        max_concurrency: int = 1,
+    ) -> Iterator[Tuple[int, InferenceResult]]:
+        """
+        Run a batch of inference queries and iterate over the results as they
+        complete.
+
+        Args:
+            prompts (Sequence[BatchItemType]): The prompts, or (prompt, params)
+                pairs to override the default params.
+            params (InferenceParams, optional): The default inference parameters.
+                Defaults to InferenceParams().
+            max_concurrency (int, optional): The maximum number of queries to run
+                at once. Defaults to 1.
+
+        Returns:
+            Iterator[Tuple[int, InferenceResult]]: The index of the prompt and its
+                result.
+
+        Example:
+            >>> for index, result in lm.iter_many(prompts, max_concurrency=4):
+            >>>     print(index, result["text"])
+        """
+        items = [(p, params) if isinstance(p, str) else p for p in prompts]
+        order = self._batch_order(items)
+        if self.max_batch_concurrency is not None:
+            max_concurrency = min(max_concurrency, self.max_batch_concurrency)
+        if max_concurrency <= 1:
+            for index in order:
+                prompt, item_params = items[index]
+                yield index, self._run_infer(prompt, item_params, emit=False)
+            return
+        handles = [CancelHandle() for _ in items]
+        executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        try:
+            futures = {
+                executor.submit(
+                    self._run_infer,
+                    items[index][0],
+                    items[index][1],
+                    handle=handles[index],
+                    emit=False,
+                ): index
+                for index in order
+            }
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+        finally:
+            # stop the running queries if the iteration is left early
+            executor.shutdown(wait=False, cancel_futures=True)
+            for handle in handles:
+                handle.cancel()
+            executor.shutdown(wait=True)
+
+    def infer_json(
+        self,
+        prompt: str,
+        schema: SchemaType,
+        params: InferenceParams = InferenceParams(),
+        handle: Optional[CancelHandle] = None,
+    ) -> Any:
+        """
+        Run an inference query whose output follows a JSON Schema. The local and
+        Koboldcpp providers constrain the generation with a grammar compiled
+        from the schema, Ollama with its `format` param. The output is checked
+        as it is generated and the query stops at the first error
+
+        Args:
+            prompt (str): The prompt to use for the inference.
+            schema (SchemaType): A JSON Schema or a pydantic model.
+            params (InferenceParams, optional): The inference parameters. Defaults to
+                InferenceParams().
+            handle (Optional[CancelHandle], optional): A handle to cancel the
+                query. Defaults to None.
+
+        Returns:
+            Any: The parsed output, an instance of the model for a pydantic model.
+
+        Raises:
+            StructuredOutputError: If the output does not follow the schema.
+
+        Example:
+            >>> class Planet(BaseModel):
+            >>>     name: str
+            >>>     moons: int
+            >>> planet = lm.infer_json("Describe the planet Mars", Planet)
+            >>> planet.moons
+            2
+        """
+        params = params.model_copy(update={"json_schema": schema_dict(schema)})
+        return parse_output(self.infer(prompt, params, handle)["text"], schema)
+
+    async def ainfer_json(
+        self,
+        prompt: str,
+        schema: SchemaType,
+        params: InferenceParams = InferenceParams(),
+        handle: Optional[CancelHandle] = None,
+    ) -> Any:
+        """
+        Run an inference query whose output follows a JSON Schema without
+        blocking the event loop. See `infer_json`
+
+        Args:
+            prompt (str): The prompt to use for the inference.
+            schema (SchemaType): A JSON Schema or a pydantic model.
+            params (InferenceParams, optional): The inference parameters. Defaults to
+                InferenceParams().
+            handle (Optional[CancelHandle], optional): A handle to cancel the
+                query. Defaults to None.
+
+        Returns:
+            Any: The parsed output, an instance of the model for a pydantic model.
+
+        Raises:
+            StructuredOutputError: If the output does not follow the schema.
+        """
+        params = params.model_copy(update={"json_schema": schema_dict(schema)})
+        res = await self.ainfer(prompt, params, handle)
+        return parse_output(res["text"], schema)
+
+    def embed(
+        self,
+        texts: Sequence[str],
+        normalize: bool = False,
+        model: Optional[str] = None,
+        max_concurrency: int = 1,
+    ) -> "np.ndarray":
+        """
+        Compute the embeddings of some texts. The texts are deduplicated, looked
+        up in the embeddings cache and the others are sent by batches of
+        `embedding_batch_size`
+
+        Args:
+            texts (Sequence[str]): The texts.
+            normalize (bool, optional): Scale the embeddings to unit length.
+                Defaults to False.
+            model (Optional[str], optional): The embeddings model, instead of the
+                loaded model. Defaults to None.
+            max_concurrency (int, optional): The maximum number of batches to run
+                at once. Defaults to 1.
+
+        Returns:
+            np.ndarray: A contiguous (texts, dimensions) float32 matrix, in the
+                order of the texts.
+
+        Example:
+            >>> vectors = lm.embed(chunks, normalize=True, max_concurrency=4)
+            >>> scores = vectors @ lm.embed([query], normalize=True)[0]
+        """
+        numpy = import_numpy()
+        if len(texts) == 0:
+            return numpy.empty((0, 0), dtype=numpy.float32)
+        model_name = model or self.loaded_model
+        positions: Dict[str, int] = {}
+        inverse = numpy.fromiter(
+            (positions.setdefault(t, len(positions)) for t in texts),
+            dtype=numpy.intp,
+            count=len(texts),
+        )
+        unique = list(positions)
+        cache = self.embedding_cache
+        cached: Dict[int, "np.ndarray"] = {}
+        keys: List[bytes] = []
+        if cache is not None:
+            keys = [cache.key(model_name, text) for text in unique]
+            for i, key in enumerate(keys):
+                vector = cache.get(key)
+                if vector is not None:
+                    cached[i] = vector
+        todo = [i for i in range(len(unique)) if i not in cached]
+        size = self.embedding_batch_size
+        batches = [todo[i:i + size] for i in range(0, len(todo), size)]
+
+        def run(batch: List[int]) -> "np.ndarray":
+            return self._embed([unique[i] for i in batch], model)
+
+        if self.max_batch_concurrency is not None:
+            max_concurrency = min(max_concurrency, self.max_batch_concurrency)
+        if max_concurrency <= 1 or len(batches) <= 1:
+            results = [run(batch) for batch in batches]
+        else:
+            with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+                results = list(executor.map(run, batches))
+        if len(results) > 0:
+            dims = results[0].shape[1]
+        else:
+            dims = next(iter(cached.values())).shape[0]
+        matrix = numpy.empty((len(unique), dims), dtype=numpy.float32)
+        for batch, result in zip(batches, results):
+            matrix[batch] = result
+            if cache is not None:
+                for i, vector in zip(batch, result):
+                    cache.set(keys[i], vector.copy())
+        for i, vector in cached.items():
+            matrix[i] = vector
+        if len(unique) < len(texts):
+            matrix = matrix[inverse]
+        if normalize:
+            l2_normalize(matrix)
+        return matrix
+
+    def count_tokens(self, text: str) -> int:
+        """
+        Count the tokens of a text. The counts are memoized
+
+        Args:
+            text (str): The text.
+
+        Returns:
+            int: The number of tokens.
+
+        Example:
+            >>> lm.count_tokens("List the planets of the solar system")
+            9
+        """
+        return self._token_counts.get(text, self._count_tokens)
+
+    def fit_prompt(self, prompt: str, params: InferenceParams) -> str:
+        """
+        Check that a prompt fits in the context window with its template and the
+        max tokens, following the `truncate` param. The template parts are
+        counted apart from the prompt to reuse their counts
+
+        Args:
+            prompt (str): The prompt.
+            params (InferenceParams): The inference parameters.
+
+        Returns:
+            str: The prompt, trimmed if needed.
+
+        Raises:
+            ValueError: If the prompt is too long and `truncate` is `error`, or
+                if the max tokens and the template leave no room for it.
+
+        Example:
+            >>> prompt = lm.fit_prompt(text, InferenceParams(truncate="head"))
+        """
+        if params.truncate is None:
+            return prompt
+        before, after = prompt_prefix(params)
+        budget = self.ctx - (params.max_tokens or 0)
+        for part in (before, after):
+            if part != "":
+                budget -= self.count_tokens(part)
+        n_tokens = self.count_tokens(prompt)
+        if n_tokens <= budget:
+            return prompt
+        if params.truncate == "error":
+            raise ValueError(
+                f"The prompt is too long: {n_tokens} tokens for {budget} available"
+            )
+        if budget <= 0:
+            raise ValueError(
+                f"The max tokens and the template leave no room for the prompt in "
+                f"the {self.ctx} tokens context window"
+            )
+        return self._trim_prompt(prompt, budget, params.truncate, n_tokens)
+
+    def _count_tokens(self, text: str) -> int:
+        return estimate_tokens(text)
+
+    def _trim_prompt(
+        self, prompt: str, budget: int, strategy: TruncateType, n_tokens: int
+    ) -> str:
+        return trim_text(prompt, budget, strategy, self.count_tokens, n_tokens)
+
+    def _run_infer(
+        self,
+        prompt: str,
+        params: InferenceParams,
+        handle: Optional[CancelHandle] = None,
+        emit: bool = True,
+    ) -> InferenceResult:
+        key = self._cache_key(prompt, params)
+        cached = self._cache_get(key, emit)
+        if cached is not None:
+            return cached
+        handle = handle or CancelHandle()
+        res: InferenceResult = self._infer(  # type: ignore
+            prompt, params, handle=handle, emit=emit
+        )
+        self._cache_set(key, res, handle)
+        return res
+
+    def _init_cache(self, params: LmParams):
+        self._token_counts = TokenCounts()
+        self.cache_policy = params.cache_policy or "deterministic"
+        if self.cache_policy != "never":
+            self.cache = params.cache if params.cache is not None else LruCache()
+        if params.embedding_batch_size:
+            self.embedding_batch_size = params.embedding_batch_size
+        if params.embedding_cache_items is None:
+            self.embedding_cache = EmbeddingCache()
+        elif params.embedding_cache_items > 0:
+            self.embedding_cache = EmbeddingCache(params.embedding_cache_items)
+
+    def _cache_key(self, prompt: str, params: InferenceParams) -> Optional[str]:
+        if self.cache is None or self.cache_policy == "never":
+            return None
+        if self.cache_policy == "deterministic" and not is_deterministic(params):
+            return None
+        final_prompt = render_prompt(prompt, params)
+        model = params.model or self.loaded_model
+        return cache_key(self.ptype, model, self.ctx, final_prompt, params)
+
+    def _cache_get(
+        self, key: Optional[str], emit: bool = True
+    ) -> Optional[InferenceResult]:
+        if key is None or self.cache is None:
+            return None
+        res = self.cache.get(key)
+        if res is not None and emit:
+            # replay the cached text for the streaming callers
+            if self.on_start_emit:
+                self.on_start_emit(None)
+            if self.on_token:
+                self.on_token(res["text"])
+        return res
+
+    def _cache_set(
+        self, key: Optional[str], res: InferenceResult, handle: CancelHandle
+    ):
+        if key is None or self.cache is None or handle.cancelled:
+            return
+        # a result cut off by the time limit is not the full answer
+        if res["stats"].get("timed_out"):
+            return
+        self.cache.set(key, res)
+
+    def _consumer(
+        self, emit: bool = True, params: Optional[InferenceParams] = None
+    ) -> TokenConsumer:
+        matcher = None
+        max_time = None
+        validator = None
+        if params is not None:
+            # the servers may not honor the stop strings: match them client side
+            if params.stop or params.stop_regex:
+                matcher = StopMatcher(params.stop or (), params.stop_regex or ())
+            max_time = params.max_time
+            if params.json_schema is not None:
+                validator = JsonValidator(params.json_schema)
+        return TokenConsumer(
+            self.on_token,
+            self.on_start_emit,
+            emit,
+            self.token_batch_size,
+            self.token_batch_ms,
+            matcher,
+            max_time,
+            validator,
+        )
+
+    def _embed(self, texts: List[str], model: Optional[str]) -> "np.ndarray":
+        raise Exception(f"The {self.ptype} provider does not support embeddings")
+
+    def _batch_order(self, items: List[Tuple[str, InferenceParams]]) -> List[int]:
+        return list(range(len(items)))
+
+    @abstractmethod
+    def _infer(
+        self,
+        prompt: str,
+        params: InferenceParams = InferenceParams(),
+        return_stream=False,
+        handle: Optional[CancelHandle] = None,
+        emit: bool = True,
+        raw: bool = False,
+    ) -> InferenceResult | GenerationStream[Any]:
+        """Run a query and return its result, or its stream if requested"""
         pass
+
+    def abort(self):
+        """Abort all the running inference queries"""
+        for handle in list(self.handles):
+            handle.cancel()
+
+    def _open_handle(self, handle: Optional[CancelHandle] = None) -> CancelHandle:
+        if handle is None:
+            handle = CancelHandle()
+        self.handles.add(handle)
+        return handle
+
+    def _close_handle(self, handle: CancelHandle):
+        handle.finish()
+        self.handles.discard(handle)
@@ -0,0 +1,525 @@
+import random
+import threading
+import time
+from contextvars import ContextVar
+from typing import TYPE_CHECKING, Any, AsyncIterator, Dict, Iterator, List, Optional
+import requests
+from ..cancel import CancelHandle, GenerationStream
+from ..connection import get_session
+from ..schemas import (
+    BalanceStrategyType,
+    InferenceParams,
+    InferenceResult,
+    LmEndpoint,
+    LmParams,
+    OnTokenType,
+    OnStartEmitType,
+    LmProviderType,
+)
+from ..provider import LmProvider, defaultOnToken
+from .koboldcpp import KoboldcppLm
+from .ollama import OllamaLm
+
+if TYPE_CHECKING:
+    import numpy as np
+
+# the weight of the last latency sample in the moving average
+EWMA_ALPHA = 0.3
+
+DEFAULT_EJECT_TIME = 30.0
+
+HEALTH_PATHS = {"koboldcpp": "/api/v1/model", "ollama": "/api/tags"}
+
+# whether the node running the current query emitted tokens: once they are
+# emitted the query can not be sent to another server
+_emitted: ContextVar[Optional[List[bool]]] = ContextVar("emitted", default=None)
+
+
+class _Node:
+    # an endpoint and its load
+    def __init__(self, endpoint: LmEndpoint, params: LmParams) -> None:
+        self.endpoint = endpoint
+        self.params = params
+        self.lm: Optional[LmProvider] = None
+        self.http: requests.Session = get_session(
+            endpoint.url, params.pool_size, params.keep_alive
+        )
+        self.outstanding = 0
+        self.ewma = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.ejected_until = 0.0
+        self.loaded = False
+
+    @property
+    def healthy(self) -> bool:
+        return self.ejected_until <= time.monotonic()
+
+
+class BalancedLm(LmProvider):
+    """
+    A provider that spreads the queries over several Koboldcpp or Ollama servers
+    running the same model. A failing server is ejected for a while and the
+    query is sent to the next one.
+
+    Example:
+        >>> from locallm import BalancedLm, LmEndpoint, LmParams
+        >>> lm = BalancedLm(LmParams(endpoints=[
+            LmEndpoint(url="http://10.0.0.2:5001", weight=2),
+            LmEndpoint(url="http://10.0.0.3:5001"),
+        ], balance_strategy="ewma", health_interval=10))
+    """
+
+    ptype: LmProviderType
+    loaded_model = ""
+    ctx = 2048
+    is_verbose = False
+    on_token: OnTokenType | None = None
+    on_start_emit: OnStartEmitType | None = None
+    nodes: List[_Node]
+    strategy: BalanceStrategyType = "least_outstanding"
+    eject_time: float = DEFAULT_EJECT_TIME
+
+    def __init__(
+        self,
+        params: LmParams,
+    ) -> None:
+        """
+        Initialize a new instance of the BalancedLm class.
+
+        Args:
+            params (LmParams): The parameters to use when initializing the instance.
+
+        Raises:
+            ValueError: If `params.endpoints` is not provided.
+
+        Example:
+            >>> from locallm import BalancedLm, LmEndpoint, LmParams
+            >>> lm = BalancedLm(LmParams(endpoints=[LmEndpoint(url=url1),
+                LmEndpoint(url=url2)]))
+        """
+        self.ptype = "balanced"
+        if not params.endpoints:
+            raise ValueError("Provide an endpoints parameter")
+        self.handles = set()
+        self._init_cache(params)
+        if params.is_verbose is True:
+            self.is_verbose = True
+        if params.on_token:
+            self.on_token = params.on_token
+        else:
+            self.on_token = defaultOnToken
+        if params.on_start_emit:
+            self.on_start_emit = params.on_start_emit
+        if params.balance_strategy:
+            self.strategy = params.balance_strategy
+        if params.eject_time is not None:
+            self.eject_time = params.eject_time
+        self._lock = threading.Lock()
+        self._model_args: Optional[tuple] = None
+        self.nodes = []
+        for endpoint in params.endpoints:
+            # the results are cached by the balanced provider
+            node_params = params.model_copy(
+                update={
+                    "server_url": endpoint.url,
+                    "cache_policy": "never",
+                    "embedding_cache_items": 0,
+                }
+            )
+            node = _Node(endpoint, node_params)
+            self.nodes.append(node)
+            try:
+                self._load_node(node)
+            except OSError:
+                self._eject(node)
+        self._stop = threading.Event()
+        if params.health_interval:
+            thread = threading.Thread(
+                target=self._health_loop, args=(params.health_interval,), daemon=True
+            )
+            thread.start()
+
+    def load_model(self, model_name: str, ctx: int, gpu_layers: Optional[int] = None):
+        """
+        Load the model on the servers. The context window size of each server is
+        discovered once and kept
+
+        Args:
+            model_name (str): The name of the model to be loaded.
+            ctx (int): The context window size for the model.
+            gpu_layers (Optional[int], optional): The number of GPU layers to use.
+                Defaults to None.
+
+        Example:
+            >>> lm.load_model('my_model', 2048)
+        """
+        self._model_args = (model_name, ctx, gpu_layers)
+        for node in self.nodes:
+            try:
+                self._load_node(node)
+            except OSError:
+                self._eject(node)
+        loaded = [node for node in self.nodes if node.loaded]
+        if len(loaded) == 0:
+            raise Exception("No server is available")
+        self.loaded_model = loaded[0].lm.loaded_model  # type: ignore
+        self.ctx = min(node.lm.ctx for node in loaded)  # type: ignore
+
+    def infer(
+        self,
+        prompt: str,
+        params: InferenceParams = InferenceParams(),
+        handle: Optional[CancelHandle] = None,
+    ) -> InferenceResult:
+        """
+        Run an inference query on the least loaded server
+
+        Args:
+            prompt (str): The prompt to use for the inference.
+            params (InferenceParams, optional): The inference parameters. Defaults to
+                InferenceParams().
+            handle (Optional[CancelHandle], optional): A handle to cancel the
+                query. Defaults to None.
+
+        Returns:
+            InferenceResult: The result of the inference.
+
+        Raises:
+            Exception: If no server is available.
+        """
+        return self._run_infer(prompt, params, handle)
+
+    def generate(
+        self,
+        prompt: str,
+        params: InferenceParams = InferenceParams(),
+        handle: Optional[CancelHandle] = None,
+        raw: bool = False,
+    ) -> GenerationStream[Any]:
+        """
+        Run an inference query on the least loaded server and return a stream
+
+        Args:
+            prompt (str): The prompt to use for the inference.
+            params (InferenceParams, optional): The inference parameters. Defaults to
+                InferenceParams().
+            handle (Optional[CancelHandle], optional): A handle to cancel the
+                query. Defaults to None.
+            raw (bool, optional): Iterate over the token texts only. Defaults to
+                False.
+
+        Returns:
+            GenerationStream[Any]: The stream iterator of `Token` records, or
+                of texts if raw
+
+        Raises:
+            Exception: If no server is available.
+        """
+        params.stream = True
+        res: GenerationStream[Any] = self._infer(  # type: ignore
+            prompt, params, True, handle, raw=raw
+        )
+        return res
+
+    async def ainfer(
+        self,
+        prompt: str,
+        params: InferenceParams = InferenceParams(),
+        handle: Optional[CancelHandle] = None,
+    ) -> InferenceResult:
+        """
+        Run an inference query on the least loaded server without blocking the
+        event loop
+
+        Args:
+            prompt (str): The prompt to use for the inference.
+            params (InferenceParams, optional): The inference parameters. Defaults to
+                InferenceParams().
+            handle (Optional[CancelHandle], optional): A handle to cancel the
+                query. Defaults to None.
+
+        Returns:
+            InferenceResult: The result of the inference.
+
+        Raises:
+            Exception: If no server is available.
+        """
+        key = self._cache_key(prompt, params)
+        cached = self._cache_get(key)
+        if cached is not None:
+            return cached
+        handle = handle or CancelHandle()
+        tried: List[_Node] = []
+        while True:
+            node = self._acquire(tried)
+            emitted = [False]
+            token = _emitted.set(emitted)
+            try:
+                res = await node.lm.ainfer(prompt, params, handle)  # type: ignore
+            except OSError:
+                self._release(node, failed=True)
+                if emitted[0]:
+                    # the tokens already sent can not be taken back
+                    raise
+                tried.append(node)
+                continue
+            except BaseException:
+                self._release(node)
+                raise
+            finally:
+                _emitted.reset(token)
+            self._release(node, res["stats"].get("time_to_first_token"))
+            self._cache_set(key, res, handle)
+            return res
+
+    async def agenerate(
+        self,
+        prompt: str,
+        params: InferenceParams = InferenceParams(),
+        handle: Optional[CancelHandle] = None,
+    ) -> AsyncIterator[str]:
+        """
+        Run an inference query on the least loaded server and iterate over the
+        tokens without blocking the event loop
+
+        Args:
+            prompt (str): The prompt to use for the inference.
+            params (InferenceParams, optional): The inference parameters. Defaults to
+                InferenceParams().
+            handle (Optional[CancelHandle], optional): A handle to cancel the
+                query. Defaults to None.
+
+        Returns:
+            AsyncIterator[str]: The generated tokens
+
+        Raises:
+            Exception: If no server is available.
+        """
+        tried: List[_Node] = []
+        while True:
+            node = self._acquire(tried)
+            start = time.monotonic()
+            latency: Optional[float] = None
+            try:
+                tokens = node.lm.agenerate(prompt, params, handle)  # type: ignore
+                async for token in tokens:
+                    if latency is None:
+                        latency = time.monotonic() - start
+                    yield token
+            except OSError:
+                if latency is not None:
+                    # the tokens already sent can not be taken back
+                    self._release(node, failed=True)
+                    raise
+                self._release(node, failed=True)
+                tried.append(node)
+                continue
+            except BaseException:
+                self._release(node)
+                raise
+            self._release(node, latency)
+            return
+
+    @property
+    def stats(self) -> List[Dict[str, Any]]:
+        """The state and load of each server"""
+        with self._lock:
+            return [
+                {
+                    "url": node.endpoint.url,
+                    "healthy": node.healthy,
+                    "outstanding": node.outstanding,
+                    "ewma": node.ewma,
+                    "requests": node.requests,
+                    "failures": node.failures,
+                    "ctx": node.lm.ctx if node.lm is not None else None,
+                }
+                for node in self.nodes
+            ]
+
+    def abort(self):
+        """Abort all the running inference queries on all the servers"""
+        for node in self.nodes:
+            if node.lm is not None:
+                node.lm.abort()
+
+    def check_health(self):
+        """Check the servers: eject the failing ones and restore the others"""
+        for node in self.nodes:
+            path = HEALTH_PATHS[node.endpoint.ptype]
+            try:
+                res = node.http.get(
+                    node.endpoint.url + path,
+                    timeout=node.params.connect_timeout or 5,
+                )
+                ok = res.status_code == 200
+                if ok:
+                    self._load_node(node)
+            except OSError:
+                ok = False
+            with self._lock:
+                if ok:
+                    node.ejected_until = 0.0
+                else:
+                    node.ejected_until = time.monotonic() + self.eject_time
+
+    def close(self):
+        """Stop the background health checks"""
+        self._stop.set()
+
+    def _health_loop(self, interval: float):
+        while not self._stop.wait(interval):
+            try:
+                self.check_health()
+            except Exception as e:
+                if self.is_verbose is True:
+                    print("Health check error", e)
+
+    def _load_node(self, node: _Node):
+        # discover the context window size of the server once: the Koboldcpp
+        # provider asks the server when it is created
+        if node.lm is None:
+            if node.endpoint.ptype == "ollama":
+                node.lm = OllamaLm(node.params)
+            else:
+                node.lm = KoboldcppLm(node.params)
+            node.lm.on_token = self._node_token
+            node.lm.on_start_emit = self._node_start_emit
+        if node.lm.loaded_model == "":
+            if self._model_args is None:
+                return
+            node.lm.load_model(*self._model_args)
+        node.loaded = True
+
+    def _node_token(self, token: str):
+        emitted = _emitted.get()
+        if emitted is not None:
+            emitted[0] = True
+        self.on_token(token)  # type: ignore
+
+    def _node_start_emit(self, arg: Any):
+        emitted = _emitted.get()
+        if emitted is not None:
+            emitted[0] = True
+        if self.on_start_emit is not None:
+            self.on_start_emit(arg)
+
+    def _acquire(self, tried: List[_Node]) -> _Node:
+        with self._lock:
+            candidates = [
+                n for n in self.nodes if n not in tried and n.healthy and n.loaded
+            ]
+            if len(candidates) == 0:
+                # all the servers are ejected: try the ones not tried yet anyway
+                candidates = [n for n in self.nodes if n not in tried and n.loaded]
+            if len(candidates) == 0:
+                raise Exception("No server is available")
+            if self.strategy == "ewma":
+                # a server without latency samples gets the mean latency of the
+                # others: only its outstanding queries tell it apart
+                sampled = [n.ewma for n in candidates if n.ewma > 0]
+                prior = sum(sampled) / len(sampled) if sampled else 1.0
+
+                def cost(n: _Node) -> float:
+                    return (n.ewma or prior) * (n.outstanding + 1) / n.endpoint.weight
+
+            else:
+
+                def cost(n: _Node) -> float:
+                    return (n.outstanding + 1) / n.endpoint.weight
+
+            best = min(cost(n) for n in candidates)
+            node = random.choice([n for n in candidates if cost(n) == best])
+            node.outstanding += 1
+            node.requests += 1
+            return node
+
+    def _release(
+        self, node: _Node, latency: Optional[float] = None, failed: bool = False
+    ):
+        with self._lock:
+            node.outstanding -= 1
+            if failed:
+                node.failures += 1
+                node.ejected_until = time.monotonic() + self.eject_time
+            elif latency is not None:
+                if node.ewma == 0:
+                    node.ewma = latency
+                else:
+                    node.ewma = EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * node.ewma
+
+    def _eject(self, node: _Node):
+        with self._lock:
+            node.failures += 1
+            node.ejected_until = time.monotonic() + self.eject_time
+
+    def _embed(self, texts: List[str], model: Optional[str]) -> "np.ndarray":
+        tried: List[_Node] = []
+        while True:
+            node = self._acquire(tried)
+            start = time.monotonic()
+            try:
+                res = node.lm._embed(texts, model)  # type: ignore
+            except OSError:
+                self._release(node, failed=True)
+                tried.append(node)
+                continue
+            except BaseException:
+                self._release(node)
+                raise
+            self._release(node, time.monotonic() - start)
+            return res
+
+    def _infer(
+        self,
+        prompt: str,
+        params: InferenceParams = InferenceParams(),
+        return_stream=False,
+        handle: Optional[CancelHandle] = None,
+        emit: bool = True,
+        raw: bool = False,
+    ) -> InferenceResult | GenerationStream[Any]:
+        tried: List[_Node] = []
+        while True:
+            node = self._acquire(tried)
+            start = time.monotonic()
+            emitted = [False]
+            token = _emitted.set(emitted)
+            try:
+                res = node.lm._infer(  # type: ignore
+                    prompt, params, return_stream, handle, emit, raw=raw
+                )
+            except OSError:
+                self._release(node, failed=True)
+                if emitted[0]:
+                    # the tokens already sent can not be taken back
+                    raise
+                tried.append(node)
+                continue
+            except BaseException:
+                self._release(node)
+                raise
+            finally:
+                _emitted.reset(token)
+            if isinstance(res, GenerationStream):
+                return self._track_stream(node, res, start)
+            self._release(node, res["stats"].get("time_to_first_token"))
+            return res
+
+    def _track_stream(
+        self, node: _Node, stream: GenerationStream[Any], start: float
+    ) -> GenerationStream[Any]:
+        latency: List[float] = []
+
+        def items() -> Iterator[Any]:
+            for item in stream:
+                if len(latency) == 0:
+                    latency.append(time.monotonic() - start)
+                yield item
+
+        def close():
+            stream.close()
+            self._release(node, latency[0] if latency else None)
+
+        return GenerationStream(items(), stream.handle, close)
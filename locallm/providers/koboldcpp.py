@@ -1,27 +1,63 @@
-from typing import Dict, Optional, Any, Iterator
-import json
+from typing import AsyncIterator, Dict, Iterator, Optional, Any, Tuple
+import asyncio
+import time
 import sseclient
 import requests
+from ..aio import iter_sse
+from ..cancel import CancelHandle, GenerationStream
+from ..connection import get_async_session, get_async_timeout, get_session
 from ..schemas import (
     InferenceParams,
     InferenceResult,
+    InferenceStats,
     LmParams,
     OnTokenType,
     OnStartEmitType,
     LmProviderType,
 )
 from ..provider import LmProvider, defaultOnToken
+from ..stats import StatsRecorder
+from ..stream import Token, TokenConsumer, json_loads
+from ..structured import json_schema_gbnf
+from ..templates import render_prompt
+from ..translate import ParamTranslator
 
 
 class KoboldcppLm(LmProvider):
+    # convert the params to the Kobold api format
+    _translate = ParamTranslator(
+        {
+            "stream": None,
+            "template": None,
+            "variables": None,
+            "threads": None,
+            "max_tokens": "max_length",
+            "stop": "stop_sequence",
+            "frequency_penalty": None,
+            "presence_penalty": None,
+            "repeat_penalty": "rep_pen",
+            "json_schema": ("grammar", json_schema_gbnf),
+            # the server runs a single model
+            "model": None,
+            "truncate": None,
+            # the regex stops and the time limit are applied client side
+            "stop_regex": None,
+            "max_time": None,
+        }
+    )
     ptype: LmProviderType
     loaded_model = ""
     headers: Dict[str, str]
     url: str
+    http: requests.Session
+    pool_size: Optional[int] = None
+    keep_alive: Optional[bool] = None
+    timeout: Tuple[Optional[float], Optional[float]] = (None, None)
     ctx = 2048
     is_verbose = False
     on_token: OnTokenType | None = None
     on_start_emit: OnStartEmitType | None = None
+    server_stats = False
 
     def __init__(
         self,
@@ -49,6 +85,12 @@ class KoboldcppLm(LmProvider):
             )
         else:
             self.url = params.server_url
+        self.pool_size = params.pool_size
+        self.keep_alive = params.keep_alive
+        self.http = get_session(self.url, self.pool_size, self.keep_alive)
+        self.timeout = (params.connect_timeout, params.read_timeout)
+        self.handles = set()
+        self._init_cache(params)
         if params.is_verbose is True:
             self.is_verbose = True
         if params.on_token:
@@ -57,6 +99,10 @@ class KoboldcppLm(LmProvider):
             self.on_token = defaultOnToken
         if params.on_start_emit:
             self.on_start_emit = params.on_start_emit
+        if params.server_stats is True:
+            self.server_stats = True
+        self.token_batch_size = params.token_batch_size
+        self.token_batch_ms = params.token_batch_ms
         self.headers = {
             "Content-Type": "application/json",
             "Accept": "text/event-stream",
@@ -81,14 +127,14 @@ class KoboldcppLm(LmProvider):
             >>> lm.load_model('my_model.gguf', 2048)
         """
         url = self.url + "/api/extra/true_max_context_length"
-        res = requests.get(url, headers=self.headers)
+        res = self.http.get(url, headers=self.headers, timeout=self.timeout)
         data = res.json()
         v = int(data["value"])
         self.ctx = v
         if self.is_verbose is True:
             print("Setting model context window to", v)
         url = self.url + "/api/v1/model"
-        res = requests.get(url, headers=self.headers)
+        res = self.http.get(url, headers=self.headers, timeout=self.timeout)
         data = res.json()
         m = data["result"]
         self.loaded_model = m
@@ -99,7 +145,9 @@ class KoboldcppLm(LmProvider):
         self,
         prompt: str,
         params: InferenceParams = InferenceParams(),
-    ) -> Iterator[Any]:
+        handle: Optional[CancelHandle] = None,
+        raw: bool = False,
+    ) -> GenerationStream[Any]:
         """
         Run an inference query for a prompt and params and return an iterator
 
@@ -107,9 +155,14 @@ class KoboldcppLm(LmProvider):
             prompt (str): The prompt to use for the inference.
             params (InferenceParams, optional): The inference parameters. Defaults to
                 InferenceParams().
+            handle (Optional[CancelHandle], optional): A handle to cancel the
+                query. Defaults to None.
+            raw (bool, optional): Iterate over the token texts only. Defaults to
+                False.
 
         Returns:
-            Iterator[Any]: The stream iterator
+            GenerationStream[Any]: The stream iterator of `Token` records, or
+                of texts if raw. The last record holds the stats of the query
 
         Raises:
             Exception: If no model is loaded. Use the load_model method first.
@@ -118,18 +171,21 @@ class KoboldcppLm(LmProvider):
             >>> from locallm import LocalLm
             >>> lm = LocalLm(model_path='/absolute/path/to/models')
             >>> lm.load_model('my_model.gguf', 2048)
-            >>> stream = lm.infer("What is the capital of France?")
-            >>> for (line in stream):
-            >>>     # process the line
+            >>> stream = lm.generate("What is the capital of France?")
+            >>> for token in stream:
+            >>>     print(token.text, end="")
         """
         params.stream = True
-        res: Iterator[Any] = self._infer(prompt, params, True)  # type: ignore
+        res: GenerationStream[Any] = self._infer(  # type: ignore
+            prompt, params, True, handle, raw=raw
+        )
         return res
 
     def infer(
         self,
         prompt: str,
         params: InferenceParams = InferenceParams(),
+        handle: Optional[CancelHandle] = None,
     ) -> InferenceResult:
         """
         Run an inference query for a prompt and params
@@ -138,6 +194,8 @@ class KoboldcppLm(LmProvider):
             prompt (str): The prompt to use for the inference.
             params (InferenceParams, optional): The inference parameters. Defaults to
                 InferenceParams().
+            handle (Optional[CancelHandle], optional): A handle to cancel the
+                query. Defaults to None.
 
         Returns:
             InferenceResult: The result of the inference.
@@ -151,70 +209,292 @@ class KoboldcppLm(LmProvider):
             >>> print(result)
             {'text': 'Paris', 'stats': {}}
         """
-        res: InferenceResult = self._infer(prompt, params)  # type: ignore
-        return res
+        return self._run_infer(prompt, params, handle)
 
-    def _infer(
+    async def ainfer(
         self,
         prompt: str,
         params: InferenceParams = InferenceParams(),
-        return_stream=False,
-    ) -> InferenceResult | Iterator[Any]:
-        tpl = params.template or "{prompt}"
-        final_prompt = tpl.replace("{prompt}", prompt)
+        handle: Optional[CancelHandle] = None,
+    ) -> InferenceResult:
+        """
+        Run an inference query for a prompt and params without blocking the
+        event loop
+
+        Args:
+            prompt (str): The prompt to use for the inference.
+            params (InferenceParams, optional): The inference parameters. Defaults to
+                InferenceParams().
+            handle (Optional[CancelHandle], optional): A handle to cancel the
+                query. Defaults to None.
+
+        Returns:
+            InferenceResult: The result of the inference.
+
+        Example:
+            >>> from locallm import KoboldcppLm, LmParams
+            >>> lm = KoboldcppLm(LmParams(is_verbose=True))
+            >>> result = await lm.ainfer("What is the capital of France?")
+            Paris
+            >>> print(result)
+            {'text': 'Paris', 'stats': {}}
+        """
+        key = self._cache_key(prompt, params)
+        cached = self._cache_get(key)
+        if cached is not None:
+            return cached
+        handle = handle or CancelHandle()
+        consumer = self._consumer(params=params)
+        tokens = self._astream(prompt, params, handle)
+        try:
+            async for token in tokens:
+                if consumer.push(token):
+                    break
+        finally:
+            # leaving the generator early aborts the generation
+            await tokens.aclose()  # type: ignore
+        text = consumer.text()
+        perf = None
+        if self.server_stats is True and not handle.cancelled:
+            session = get_async_session(self.url, self.pool_size, self.keep_alive)
+            try:
+                async with session.get(
+                    self.url + "/api/extra/perf",
+                    headers=self.headers,
+                    timeout=get_async_timeout(*self.timeout),
+                ) as response:
+                    perf = await response.json()
+            except Exception:
+                pass
+        result: InferenceResult = {
+            "text": text,
+            "stats": self._get_stats(consumer.recorder, perf),
+        }
+        self._cache_set(key, result, handle)
+        return result
+
+    async def agenerate(
+        self,
+        prompt: str,
+        params: InferenceParams = InferenceParams(),
+        handle: Optional[CancelHandle] = None,
+    ) -> AsyncIterator[str]:
+        """
+        Run an inference query for a prompt and params and iterate over the
+        tokens without blocking the event loop
+
+        Args:
+            prompt (str): The prompt to use for the inference.
+            params (InferenceParams, optional): The inference parameters. Defaults to
+                InferenceParams().
+            handle (Optional[CancelHandle], optional): A handle to cancel the
+                query. Defaults to None.
+
+        Returns:
+            AsyncIterator[str]: The generated tokens
+
+        Example:
+            >>> from locallm import KoboldcppLm, LmParams
+            >>> lm = KoboldcppLm(LmParams(is_verbose=True))
+            >>> async for token in lm.agenerate("What is the capital of France?"):
+            >>>     print(token, end="")
+        """
+        consumer = self._consumer(False, params)
+        tokens = self._astream(prompt, params, handle)
+        try:
+            async for token in tokens:
+                text, stopped = consumer.feed(token)
+                if text:
+                    yield text
+                if stopped:
+                    break
+        finally:
+            # leaving the generator early aborts the generation
+            await tokens.aclose()  # type: ignore
+        text = consumer.rest()
+        if text:
+            yield text
+
+    async def _astream(
+        self,
+        prompt: str,
+        params: InferenceParams,
+        handle: Optional[CancelHandle] = None,
+    ) -> AsyncIterator[str]:
+        # the tokens sent by the server, before the stops
+        # build the payload first: a prompt that does not fit raises before the
+        # handle is registered
+        handle = handle or CancelHandle()
+        payload = self._get_payload(prompt, params)
+        payload["genkey"] = handle.genkey
+        session = get_async_session(self.url, self.pool_size, self.keep_alive)
+        handle = self._open_handle(handle)
+        aborted = False
+        try:
+            async with session.post(
+                self.url + "/api/extra/generate/stream",
+                headers=self.headers,
+                json=payload,
+                timeout=get_async_timeout(*self.timeout),
+            ) as response:
+                async for data in iter_sse(response):
+                    if handle.cancelled:
+                        aborted = True
+                        break
+                    yield json_loads(data)["token"]
+        except (GeneratorExit, asyncio.CancelledError):
+            aborted = True
+            raise
+        finally:
+            self._close_handle(handle)
+            if aborted:
+                # the consumer has gone or cancelled: free the server slot
+                async with session.post(
+                    self.url + "/api/extra/abort",
+                    headers=self.headers,
+                    json={"genkey": handle.genkey},
+                    timeout=get_async_timeout(*self.timeout),
+                ):
+                    pass
+
+    def _get_payload(self, prompt: str, params: InferenceParams) -> Dict[str, Any]:
+        prompt = self.fit_prompt(prompt, params)
+        final_prompt = render_prompt(prompt, params)
         if self.is_verbose is True:
             print("Running inference with prompt:")
             print(final_prompt)
-        # convert the params to the Kobold api format
-        final_params = params.model_dump(exclude_none=True, exclude_unset=True)
-        if "stop" in final_params:
-            final_params["stop_sequence"] = final_params["stop"]
-            del final_params["stop"]
-        if "repeat_penalty" in final_params:
-            final_params["rep_pen"] = final_params["repeat_penalty"]
-            del final_params["repeat_penalty"]
-        if "presence_penalty" in final_params:
-            del final_params["presence_penalty"]
-        if "frequency_penalty" in final_params:
-            del final_params["frequency_penalty"]
-        if "threads" in final_params:
-            del final_params["threads"]
-        if "max_tokens" in final_params:
-            final_params["max_length"] = final_params["max_tokens"]
-            del final_params["max_tokens"]
-        if "stream" in final_params:
-            del final_params["stream"]
+        final_params = self._translate(params)
         if self.is_verbose is True:
             print("Inference parameters:")
             print(final_params)
-        # run the query
-        payload = {
+        return {
             "prompt": final_prompt,
             "max_context_length": self.ctx,
             **final_params,
         }
+
+    def _infer(
+        self,
+        prompt: str,
+        params: InferenceParams = InferenceParams(),
+        return_stream=False,
+        handle: Optional[CancelHandle] = None,
+        emit: bool = True,
+        raw: bool = False,
+    ) -> InferenceResult | GenerationStream[Any]:
+        handle = handle or CancelHandle()
+        consumer = self._consumer(emit, params)
+        payload = self._get_payload(prompt, params)
+        payload["genkey"] = handle.genkey
         url = self.url + "/api/extra/generate/stream"
-        response = requests.post(url, stream=True, headers=self.headers, json=payload)
+        response = self.http.post(
+            url, stream=True, headers=self.headers, json=payload, timeout=self.timeout
+        )
+        # register the handle once the query runs: the errors above leave nothing
+        # to release
+        handle = self._open_handle(handle)
+        handle.on_cancel(lambda: self._abort_generation(handle.genkey))
+
+        def close():
+            self._close_handle(handle)
+            response.close()
+
         client = sseclient.SSEClient(response)  # type: ignore
         if return_stream is True:
-            return client.events()
-        buf = []
-        i = 0
+            tokens = self._tokens(client, raw, self._consumer(False, params), handle)
+            return GenerationStream(tokens, handle, close)
+        events = GenerationStream(client.events(), handle, close)
+        for event in events:
+            if consumer.push(json_loads(event.data)["token"]):
+                # a stop completed: free the server slot
+                self._abort_generation(handle.genkey)
+                events.close()
+                break
+        text = consumer.text()
+        perf = None
+        if self.server_stats is True and not handle.cancelled:
+            perf = self._get_perf()
+        return {"text": text, "stats": self._get_stats(consumer.recorder, perf)}
+
+    def _tokens(
+        self,
+        client: sseclient.SSEClient,
+        raw: bool,
+        consumer: TokenConsumer,
+        handle: CancelHandle,
+    ) -> Iterator[Any]:
+        # parse the events once and apply the stops: the token records end with
+        # the stats
+        index = 0
+        stopped = False
         for event in client.events():
-            # print(event)
-            if i == 0:
-                if self.on_start_emit:
-                    self.on_start_emit(None)
-            # print("|begin|", event, "|end|")
-            data = json.loads(event.data)
-            # print(data)
-            if self.on_token:
-                self.on_token(data["token"])
-            buf.append(data["token"])
-            i += 1
-        return {"text": "".join(buf), "stats": {}}
-
-    def abort(self):
-        headers = {"Content-Type": "application/json"}
-        payload = {"genKey": ""}
-        requests.post("/api/extra/abort", headers=headers, json=payload)
+            text, stopped = consumer.feed(json_loads(event.data)["token"])
+            if raw is False:
+                yield Token(text, index, time.perf_counter())
+                index += 1
+            elif text:
+                yield text
+            if stopped:
+                # a stop completed: free the server slot
+                self._abort_generation(handle.genkey)
+                break
+        text = consumer.rest()
+        if raw is True:
+            if text:
+                yield text
+            return
+        perf = None
+        if self.server_stats is True and not stopped:
+            perf = self._get_perf()
+        stats = self._get_stats(consumer.recorder, perf)
+        yield Token(text, index, time.perf_counter(), stats)
+
+    def _count_tokens(self, text: str) -> int:
+        # count with the tokenizer of the server, or estimate if it is too old
+        try:
+            response = self.http.post(
+                self.url + "/api/extra/tokencount",
+                headers=self.headers,
+                json={"prompt": text},
+                timeout=self.timeout,
+            )
+            response.raise_for_status()
+            return int(response.json()["value"])
+        except (requests.HTTPError, KeyError, ValueError):
+            return super()._count_tokens(text)
+
+    def _get_perf(self) -> Optional[Dict[str, Any]]:
+        # the timings of the last generation reported by the server
+        try:
+            response = self.http.get(
+                self.url + "/api/extra/perf", headers=self.headers, timeout=self.timeout
+            )
+            return response.json()
+        except Exception:
+            return None
+
+    def _get_stats(
+        self, recorder: StatsRecorder, perf: Optional[Dict[str, Any]]
+    ) -> InferenceStats:
+        # the perf endpoint only knows the last generation: it may belong to
+        # another client on a busy server. An event holds at least one token
+        if perf is None or perf.get("last_token_count", 0) < recorder.tokens:
+            return recorder.stats()
+        prompt_time = perf.get("last_process")
+        generation_time = perf.get("last_eval")
+        server_time = None
+        if prompt_time is not None and generation_time is not None:
+            server_time = prompt_time + generation_time
+        return recorder.stats(
+            prompt_tokens=perf.get("last_input_count"),
+            generated_tokens=perf.get("last_token_count"),
+            prompt_time=prompt_time,
+            generation_time=generation_time,
+            server_time=server_time,
+        )
+
+    def _abort_generation(self, genkey: str):
+        url = self.url + "/api/extra/abort"
+        self.http.post(
+            url, headers=self.headers, json={"genkey": genkey}, timeout=self.timeout
+        )
@@ -1,18 +1,75 @@
-from typing import Any, Iterator, List, Optional
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncIterator,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from llama_cpp import CompletionChunk, Llama
+try:
+    from llama_cpp import CompletionChunk, Llama
+except ImportError:
+    raise ImportError(
+        "The local provider requires llama-cpp-python: pip install locallm[local]"
+    )
+from ..aio import iterate_in_executor
+from ..cancel import CancelHandle, GenerationStream
 from ..schemas import (
     InferenceParams,
     InferenceResult,
+    InferenceStats,
     LmParams,
     OnTokenType,
     OnStartEmitType,
     LmProviderType,
+    TruncateType,
 )
 from ..provider import LmProvider, defaultOnToken
+from ..embeddings import to_matrix
+from ..stream import Token, TokenConsumer
+from ..structured import llama_grammar
+from ..templates import prompt_prefix, render_prompt
+from ..translate import ParamTranslator
+from .model_pool import ModelPool
+from .prefix_cache import PrefixCache, common_prefix_len
+from .speculative import DEFAULT_DRAFT_TOKENS, SpeculativeDraft, make_draft
+from .tuning import kv_cache_type, load_profile
+
+if TYPE_CHECKING:
+    import numpy as np
+
+
+DEFAULT_PREFIX_CACHE_BYTES = 1024 * 1024 * 1024
+
+# the number of tokenized template prefixes kept
+MAX_PREFIX_TOKENS = 64
 
 
 class LocalLm(LmProvider):
+    # convert the params to the llama.cpp completion args: always stream from the
+    # model to be able to stop it between the tokens
+    _translate = ParamTranslator(
+        {
+            "stream": None,
+            "template": None,
+            "variables": None,
+            "threads": None,
+            "tfs": "tfs_z",
+            # the grammars are compiled once and cached
+            "grammar": ("grammar", llama_grammar),
+            "json_schema": ("grammar", lambda schema: llama_grammar(schema=schema)),
+            "model": None,
+            "truncate": None,
+            "stop_regex": None,
+            "max_time": None,
+        },
+        constants={"stream": True},
+    )
     ptype: LmProviderType
     llm: Llama | None = None
     models_dir = ""
@@ -24,6 +81,21 @@ class LocalLm(LmProvider):
     embedding: bool = False
     threads: Optional[int] = None
     gpu_layers: int = 0
+    executor: ThreadPoolExecutor | None = None
+    prefix_cache: PrefixCache | None = None
+    pool: ModelPool
+    draft_model: Optional[str] = None
+    draft_tokens: int = DEFAULT_DRAFT_TOKENS
+    draft: SpeculativeDraft | None = None
+    n_batch: Optional[int] = None
+    threads_batch: Optional[int] = None
+    use_mmap: Optional[bool] = None
+    use_mlock: Optional[bool] = None
+    type_k: Optional[str] = None
+    type_v: Optional[str] = None
+    profiles_file: Optional[str] = None
+    # the model can only run one query at a time
+    max_batch_concurrency = 1
 
     def __init__(
         self,
@@ -43,6 +115,8 @@ class LocalLm(LmProvider):
             >>> lm = LocalLm(LmParams(model_dir='/absolute/path/to/models'))
         """
         self.ptype = "local"
+        self.handles = set()
+        self._init_cache(params)
         if params.models_dir is None:
             raise ValueError("Provide a models_dir parameter")
         # print("Initializing lm", model_path)
@@ -55,12 +129,46 @@ class LocalLm(LmProvider):
             self.on_token = defaultOnToken
         if params.on_start_emit:
             self.on_start_emit = params.on_start_emit
+        self.token_batch_size = params.token_batch_size
+        self.token_batch_ms = params.token_batch_ms
         if params.embedding:
             self.embedding = params.embedding
         if params.threads:
             self.threads = params.threads
         if params.gpu_layers:
             self.gpu_layers = params.gpu_layers
+        if params.draft_model:
+            self.draft_model = params.draft_model
+        if params.draft_tokens:
+            self.draft_tokens = params.draft_tokens
+        if params.n_batch:
+            self.n_batch = params.n_batch
+        if params.threads_batch:
+            self.threads_batch = params.threads_batch
+        self.use_mmap = params.use_mmap
+        self.use_mlock = params.use_mlock
+        if params.type_k:
+            kv_cache_type(params.type_k)
+            self.type_k = params.type_k
+        if params.type_v:
+            kv_cache_type(params.type_v)
+            self.type_v = params.type_v
+        if params.profiles_file:
+            self.profiles_file = params.profiles_file
+        self.pool = ModelPool(
+            params.max_models or 1, params.models_memory, self._on_unload
+        )
+        self._prefix_tokens: Dict[Tuple[str, str], List[int]] = {}
+        # model name -> the draft of the model
+        self._drafts: Dict[str, SpeculativeDraft] = {}
+        if params.prefix_cache_bytes or params.prefix_cache_dir:
+            self.prefix_cache = PrefixCache(
+                params.prefix_cache_bytes or DEFAULT_PREFIX_CACHE_BYTES,
+                params.prefix_cache_dir,
+                params.prefix_cache_disk_bytes,
+            )
+        if params.preload_models:
+            self.preload(params.preload_models, self.ctx)
 
     def load_model(self, model_name: str, ctx: int, gpu_layers: Optional[int] = None):
         """
@@ -80,28 +188,124 @@ class LocalLm(LmProvider):
         if self.is_verbose is True:
             print("Loading model", self.models_dir, model_name)
         p = Path(self.models_dir) / model_name
-        if self.loaded_model != model_name:
-            params = {
-                "model_path": str(p),
-                "n_ctx": ctx,
-            }
-            if self.embedding:
-                params["embedding"] = self.embedding
-            if self.threads:
-                params["n_threads"] = self.threads
-            if gpu_layers:
-                params["n_gpu_layers"] = gpu_layers
-            elif self.gpu_layers:
-                params["n_gpu_layers"] = self.gpu_layers
-            self.llm = Llama(**params)
+        params = {
+            "model_path": str(p),
+            "n_ctx": ctx,
+        }
+        if self.embedding:
+            params["embedding"] = self.embedding
+        # the autotune profile of the model on this host fills the settings not
+        # set in the params
+        profile = load_profile(model_name, self.profiles_file)
+        threads = self.threads or profile.get("threads")
+        if threads:
+            params["n_threads"] = threads
+        threads_batch = self.threads_batch or profile.get("threads_batch")
+        if threads_batch:
+            params["n_threads_batch"] = threads_batch
+        n_batch = self.n_batch or profile.get("n_batch")
+        if n_batch:
+            params["n_batch"] = n_batch
+            params["n_ubatch"] = n_batch
+        if self.use_mmap is not None:
+            params["use_mmap"] = self.use_mmap
+        if self.use_mlock is not None:
+            params["use_mlock"] = self.use_mlock
+        if self.type_k:
+            params["type_k"] = kv_cache_type(self.type_k)
+        if self.type_v:
+            params["type_v"] = kv_cache_type(self.type_v)
+            # llama.cpp needs the flash attention for a quantized value cache
+            if self.type_v not in ("f16", "f32"):
+                params["flash_attn"] = True
+        if gpu_layers:
+            params["n_gpu_layers"] = gpu_layers
+        elif self.gpu_layers:
+            params["n_gpu_layers"] = self.gpu_layers
+        if self.draft_model is not None:
+            # llama.cpp forces the logits of all the tokens with a draft model,
+            # but sizes the scores buffer from this param
+            params["logits_all"] = True
+
+        def load() -> Llama:
+            if self.draft_model is None:
+                return Llama(**params)
+            # llama.cpp evaluates the drafted tokens in a batch with the model:
+            # each model of the pool has its own draft, sized to its context
+            draft_params = {}
+            if "n_threads" in params:
+                draft_params["n_threads"] = params["n_threads"]
+            draft = make_draft(
+                self.draft_model,
+                str(Path(self.models_dir) / self.draft_model),
+                ctx,
+                self.draft_tokens,
+                draft_params,
+            )
+            try:
+                llm = Llama(**params, draft_model=draft)
+            except Exception:
+                draft.close()
+                raise
+            self._drafts[model_name] = draft
+            return llm
+
+        self.llm = self.pool.get(model_name, ctx, load, p)
         self.loaded_model = model_name
         self.ctx = ctx
+        self.draft = self._drafts.get(model_name)
+
+    def preload(
+        self, model_names: List[str], ctx: int, gpu_layers: Optional[int] = None
+    ):
+        """
+        Load models in the pool ahead of the queries. The last one is the
+        active model
+
+        Args:
+            model_names (List[str]): The names of the models to load.
+            ctx (int): The context window size for the models.
+            gpu_layers (Optional[int], optional): The number of GPU layers to use.
+                Defaults to None.
+
+        Example:
+            >>> lm = LocalLm(LmParams(models_dir='/absolute/path/to/models',
+                max_models=2))
+            >>> lm.preload(['router.gguf', 'writer.gguf'], 4096)
+            >>> lm.infer("Classify this", InferenceParams(model='router.gguf'))
+        """
+        for model_name in model_names:
+            self.load_model(model_name, ctx, gpu_layers)
+
+    def _use_model(self, model_name: str):
+        # route a query to a model, loading it if it is not in the pool
+        if model_name == self.loaded_model:
+            return
+        item = self.pool.peek(model_name)
+        if item is None:
+            self.load_model(model_name, self.ctx)
+            return
+        self.llm, self.ctx = item
+        self.loaded_model = model_name
+        self.draft = self._drafts.get(model_name)
+
+    def _on_unload(self, model_name: str):
+        # the pool closes this model: do not keep using it or its draft
+        draft = self._drafts.pop(model_name, None)
+        if draft is not None:
+            draft.close()
+        if model_name == self.loaded_model:
+            self.llm = None
+            self.loaded_model = ""
+            self.draft = None
 
     def generate(
         self,
         prompt: str,
         params: InferenceParams = InferenceParams(),
-    ) -> Iterator[CompletionChunk]:
+        handle: Optional[CancelHandle] = None,
+        raw: bool = False,
+    ) -> GenerationStream[Any]:
         """
         Run an inference query for a prompt and params and return an iterator
 
@@ -109,9 +313,14 @@ class LocalLm(LmProvider):
             prompt (str): The prompt to use for the inference.
             params (InferenceParams, optional): The inference parameters. Defaults to
                 InferenceParams().
+            handle (Optional[CancelHandle], optional): A handle to cancel the
+                query. Defaults to None.
+            raw (bool, optional): Iterate over the token texts only. Defaults to
+                False.
 
         Returns:
-            Iterator[CompletionChunk]: The stream iterator
+            GenerationStream[Any]: The stream iterator of `Token` records, or
+                of texts if raw. The last record holds the stats of the query
 
         Raises:
             Exception: If no model is loaded. Use the load_model method first.
@@ -120,13 +329,13 @@ class LocalLm(LmProvider):
             >>> from locallm import LocalLm
             >>> lm = LocalLm(model_path='/absolute/path/to/models')
             >>> lm.load_model('my_model.gguf', 2048)
-            >>> stream = lm.infer("What is the capital of France?")
-            >>> for (line in stream):
-            >>>     # process the line
+            >>> stream = lm.generate("What is the capital of France?")
+            >>> for token in stream:
+            >>>     print(token.text, end="")
         """
         params.stream = True
-        res: Iterator[CompletionChunk] = self._infer(  # type: ignore
-            prompt, params, True
+        res: GenerationStream[Any] = self._infer(  # type: ignore
+            prompt, params, True, handle, raw=raw
         )
         return res
 
@@ -134,6 +343,7 @@ class LocalLm(LmProvider):
         self,
         prompt: str,
         params: InferenceParams = InferenceParams(),
+        handle: Optional[CancelHandle] = None,
     ) -> InferenceResult:
         """
         Run an inference query for a prompt and params
@@ -142,6 +352,8 @@ class LocalLm(LmProvider):
             prompt (str): The prompt to use for the inference.
             params (InferenceParams, optional): The inference parameters. Defaults to
                 InferenceParams().
+            handle (Optional[CancelHandle], optional): A handle to cancel the
+                query. Defaults to None.
 
         Returns:
             InferenceResult: The result of the inference.
@@ -157,68 +369,288 @@ class LocalLm(LmProvider):
             >>> print(result)
             {'text': 'Paris', 'stats': {}}
         """
-        res: InferenceResult = self._infer(prompt, params)  # type: ignore
-        return res
+        return self._run_infer(prompt, params, handle)
+
+    def _batch_order(self, items: List[Tuple[str, InferenceParams]]) -> List[int]:
+        # group the prompts by model, and run the prompts that share a prefix one
+        # after the other: the model reuses the evaluated prefix from its
+        # previous query
+        def final_prompt(index: int) -> Tuple[str, str]:
+            prompt, params = items[index]
+            return (params.model or self.loaded_model, render_prompt(prompt, params))
+
+        return sorted(range(len(items)), key=final_prompt)
 
     def _infer(
         self,
         prompt: str,
         params: InferenceParams = InferenceParams(),
         return_stream=False,
-    ) -> InferenceResult | Iterator[Any]:
-        tpl = params.template or "{prompt}"
-        final_prompt = tpl.replace("{prompt}", prompt)
+        handle: Optional[CancelHandle] = None,
+        emit: bool = True,
+        raw: bool = False,
+        stops: bool = True,
+    ) -> InferenceResult | GenerationStream[Any]:
+        # the pool workers leave the stops, the time limit and the output
+        # validation of their streams to the pool
+        if params.model is not None:
+            self._use_model(params.model)
+        if self.llm is None:
+            raise Exception("No model is loaded: use the load_model method first")
+        prompt = self.fit_prompt(prompt, params)
+        final_prompt = render_prompt(prompt, params)
         if self.is_verbose is True:
             print("Running inference with prompt:")
             print(final_prompt)
-        if self.llm is None:
-            raise Exception("No model is loaded: use the load_model method first")
-        final_params = params.model_dump(exclude_none=True, exclude_unset=True)
-        if "threads" in final_params:
-            del final_params["threads"]
-        if "template" in final_params:
-            del final_params["template"]
-        if "tfs" in final_params:
-            final_params["tfs_z"] = final_params["tfs"]
-            del final_params["tfs"]
-        if "gpu_layers" in final_params:
-            final_params["n_gpu_layers"] = final_params["gpu_layers"]
-            del final_params["gpu_layers"]
-        if "threads" in final_params:
-            final_params["n_threads"] = final_params["threads"]
-            del final_params["threads"]
+        final_params = self._translate(params)
         if self.is_verbose is True:
             print("Inference parameters:")
             print(final_params)
-        stream = self.llm.create_completion(
-            final_prompt,
+        # the tokens are only emitted in stream mode
+        consumer = self._consumer(emit and params.stream is True, params)
+        # tokenize once and restore the evaluated template prefix if cached
+        if final_prompt == "":
+            tokens = [self.llm.token_bos()]
+        else:
+            tokens = self.llm.tokenize(final_prompt.encode("utf-8"), special=True)
+        if self.prefix_cache is not None:
+            prefix_len = self._prefix_len(prompt_prefix(params)[0], tokens)
+            skipped = self.prefix_cache.prepare(
+                self.llm, tokens, prefix_len, self.loaded_model
+            )
+        else:
+            skipped = common_prefix_len(self.llm, tokens)
+        if self.draft is not None:
+            self.draft.reset()
+        completion: Iterator[CompletionChunk] = self.llm.create_completion(
+            tokens,
             **final_params,
-        )
+        )  # type: ignore
+        handle = self._open_handle(handle)
+
+        def close():
+            self._close_handle(handle)
+            completion.close()  # type: ignore
+
         if return_stream is True:
-            s: Iterator[CompletionChunk] = stream  # type: ignore
-            return s
-        buf: List[str] = []
-        i = 0
-        if params.stream is True:
-            for output in stream:
-                if i == 0:
-                    if self.on_start_emit:
-                        self.on_start_emit(None)
-                # print("OUT", output)
-                txt = ""
-                try:
-                    txt = output["choices"][0]["text"]  # type: ignore
-                except Exception:
-                    pass
-                if self.on_token is not None:
-                    print("T", txt)
-                    self.on_token(txt)
-                buf.append(txt)
-                i += 1
-            text = "".join(buf)
+            consumer = self._consumer(False, params if stops is True else None)
+            return GenerationStream(
+                self._tokens(completion, raw, consumer, len(tokens), skipped),
+                handle,
+                close,
+            )
+        stream = GenerationStream(completion, handle, close)
+        # llama.cpp streams a chunk per generated token, and a final chunk
+        for output in stream:
+            choice = output["choices"][0]
+            is_token = choice["finish_reason"] is None
+            if is_token or choice["text"]:
+                if consumer.push(choice["text"], is_token):
+                    # closing the stream stops the generation
+                    stream.close()
+                    break
+        text = consumer.text()
+        stats = consumer.recorder.stats(
+            prompt_tokens=len(tokens), skipped_prompt_tokens=skipped
+        )
+        if self.draft is not None:
+            stats.update(self.draft.stats())  # type: ignore
+        return {"text": text, "stats": stats}
+
+    def _tokens(
+        self,
+        completion: Iterator[CompletionChunk],
+        raw: bool,
+        consumer: TokenConsumer,
+        prompt_tokens: int,
+        skipped: int,
+    ) -> Iterator[Any]:
+        # llama.cpp streams a chunk per generated token, and a final chunk: the
+        # token records end with the stats
+        index = 0
+        text = ""
+        for output in completion:
+            choice = output["choices"][0]
+            is_token = choice["finish_reason"] is None
+            text, stopped = consumer.feed(choice["text"], is_token)
+            if stopped or not is_token:
+                # the text cleared by the stop or the text of the final chunk
+                break
+            if raw is False:
+                yield Token(text, index, time.perf_counter())
+                index += 1
+            elif text:
+                yield text
+            text = ""
+        text += consumer.rest()
+        if raw is True:
+            if text:
+                yield text
+            return
+        stats = consumer.recorder.stats(
+            prompt_tokens=prompt_tokens, skipped_prompt_tokens=skipped
+        )
+        if self.draft is not None:
+            stats.update(self.draft.stats())  # type: ignore
+        yield Token(text, index, time.perf_counter(), stats)
+
+    def _embed(self, texts: List[str], model: Optional[str]) -> "np.ndarray":
+        if model is not None:
+            self._use_model(model)
+        if self.llm is None:
+            raise Exception("No model is loaded: use the load_model method first")
+        if self.embedding is False:
+            raise Exception("Use the embedding param to load the model for embeddings")
+        return to_matrix(self.llm.embed(texts))
+
+    def _count_tokens(self, text: str) -> int:
+        if self.llm is None:
+            return super()._count_tokens(text)
+        return len(self.llm.tokenize(text.encode("utf-8"), add_bos=False, special=True))
+
+    def _trim_prompt(
+        self, prompt: str, budget: int, strategy: TruncateType, n_tokens: int
+    ) -> str:
+        # cut the tokens rather than the text to fit exactly
+        if self.llm is None:
+            return super()._trim_prompt(prompt, budget, strategy, n_tokens)
+        tokens = self.llm.tokenize(prompt.encode("utf-8"), add_bos=False, special=True)
+        if strategy == "head":
+            tokens = tokens[len(tokens) - budget:]
+        elif strategy == "tail":
+            tokens = tokens[:budget]
         else:
-            text = stream["choices"][0]["text"]  # type: ignore
-        return {"text": text, "stats": {}}
+            start = budget // 2
+            tokens = tokens[:start] + tokens[len(tokens) - (budget - start):]
+        text = self.llm.detokenize(tokens, special=True).decode("utf-8", "ignore")
+        # the text may tokenize a bit differently at the cut
+        return super()._trim_prompt(text, budget, strategy, self.count_tokens(text))
+
+    def _prefix_len(self, prefix: str, tokens: List[int]) -> int:
+        # the number of prompt tokens that belong to the rendered template prefix
+        if prefix == "" or self.llm is None:
+            return 0
+        key = (self.loaded_model, prefix)
+        prefix_tokens = self._prefix_tokens.get(key)
+        if prefix_tokens is None:
+            if len(self._prefix_tokens) >= MAX_PREFIX_TOKENS:
+                self._prefix_tokens.clear()
+            prefix_tokens = self.llm.tokenize(prefix.encode("utf-8"), special=True)
+            self._prefix_tokens[key] = prefix_tokens
+        n = 0
+        for a, b in zip(prefix_tokens, tokens):
+            if a != b:
+                break
+            n += 1
+        return n
+
+    async def ainfer(
+        self,
+        prompt: str,
+        params: InferenceParams = InferenceParams(),
+        handle: Optional[CancelHandle] = None,
+    ) -> InferenceResult:
+        """
+        Run an inference query for a prompt and params without blocking the
+        event loop. The generation runs in a worker thread
+
+        Args:
+            prompt (str): The prompt to use for the inference.
+            params (InferenceParams, optional): The inference parameters. Defaults to
+                InferenceParams().
+            handle (Optional[CancelHandle], optional): A handle to cancel the
+                query. Defaults to None.
+
+        Returns:
+            InferenceResult: The result of the inference.
+
+        Raises:
+            Exception: If no model is loaded. Use the load_model method first.
+
+        Example:
+            >>> from locallm import LocalLm
+            >>> lm = LocalLm(model_path='/absolute/path/to/models')
+            >>> lm.load_model('my_model.gguf', 2048)
+            >>> result = await lm.ainfer("What is the capital of France?")
+            >>> print(result)
+            {'text': 'Paris', 'stats': {}}
+        """
+        key = self._cache_key(prompt, params)
+        cached = self._cache_get(key)
+        if cached is not None:
+            return cached
+        handle = handle or CancelHandle()
+        # the stream applies the stops: the consumer only emits its text
+        consumer = self._consumer()
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1)
+
+        def records() -> Iterator[Token]:
+            stream = self.generate(prompt, params, handle)
+            try:
+                yield from stream
+            finally:
+                stream.close()
+
+        # the last record holds the stats of the query
+        stats: Optional[InferenceStats] = None
+        tokens = iterate_in_executor(records, executor=self.executor)
+        try:
+            async for token in tokens:
+                is_token = token.stats is None
+                if not is_token:
+                    stats = token.stats
+                if is_token or token.text:
+                    consumer.push(token.text, is_token)
+        finally:
+            # leaving the generator early stops the generation
+            await tokens.aclose()  # type: ignore
+        if stats is None:
+            stats = consumer.recorder.stats()
+        result: InferenceResult = {"text": consumer.text(), "stats": stats}
+        self._cache_set(key, result, handle)
+        return result
+
+    async def agenerate(
+        self,
+        prompt: str,
+        params: InferenceParams = InferenceParams(),
+        handle: Optional[CancelHandle] = None,
+    ) -> AsyncIterator[str]:
+        """
+        Run an inference query for a prompt and params and iterate over the
+        tokens without blocking the event loop. The model is not thread safe: the
+        generations are queued and run one at a time in a worker thread
+
+        Args:
+            prompt (str): The prompt to use for the inference.
+            params (InferenceParams, optional): The inference parameters. Defaults to
+                InferenceParams().
+            handle (Optional[CancelHandle], optional): A handle to cancel the
+                query. Defaults to None.
+
+        Returns:
+            AsyncIterator[str]: The generated tokens
+
+        Raises:
+            Exception: If no model is loaded. Use the load_model method first.
+
+        Example:
+            >>> from locallm import LocalLm
+            >>> lm = LocalLm(model_path='/absolute/path/to/models')
+            >>> lm.load_model('my_model.gguf', 2048)
+            >>> async for token in lm.agenerate("What is the capital of France?"):
+            >>>     print(token, end="")
+        """
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1)
+
+        def tokens() -> Iterator[str]:
+            stream = self.generate(prompt, params, handle, raw=True)
+            try:
+                yield from stream
+            finally:
+                stream.close()
 
-    def abort(self):
-        pass
+        async for token in iterate_in_executor(tokens, executor=self.executor):
+            yield token
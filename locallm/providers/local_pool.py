@@ -0,0 +1,702 @@
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import Connection
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncIterator,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+from ..aio import iterate_in_executor
+from ..cancel import CancelHandle, GenerationStream
+from ..schemas import (
+    InferenceParams,
+    InferenceResult,
+    InferenceStats,
+    LmParams,
+    OnTokenType,
+    OnStartEmitType,
+    LmProviderType,
+)
+from ..provider import LmProvider, defaultOnToken
+from ..stream import Token, TokenConsumer
+
+if TYPE_CHECKING:
+    import numpy as np
+
+DEFAULT_WORKERS = 2
+
+# the local provider params passed to the workers: the callbacks and the caches
+# stay in the main process
+WORKER_PARAMS = [
+    "models_dir",
+    "is_verbose",
+    "gpu_layers",
+    "embedding",
+    "max_models",
+    "models_memory",
+    "prefix_cache_bytes",
+    "draft_model",
+    "draft_tokens",
+    "n_batch",
+    "use_mmap",
+    "use_mlock",
+    "type_k",
+    "type_v",
+    "profiles_file",
+]
+
+# the speculative decoding stats measured by the workers
+DRAFT_STATS = [
+    "draft_tokens",
+    "accepted_draft_tokens",
+    "draft_acceptance_rate",
+]
+
+
+def _serve_generate(conn: Connection, lm: Any, prompt: str, params: InferenceParams):
+    # stream the token records of a query, and stop at a cancel message. The
+    # pool applies the stops, the time limit and the output validation
+    params.stream = True
+    stream = lm._infer(prompt, params, True, stops=False)
+    try:
+        for token in stream:
+            conn.send(("token", token.text, token.stats))
+            if conn.poll():
+                # the only message sent during a generation is a cancellation
+                conn.recv()
+                break
+    finally:
+        stream.close()
+    conn.send(("end",))
+
+
+def _worker_main(conn: Connection, params: Dict[str, Any], model_args: tuple):
+    # the worker process: load the model and run the queries one at a time
+    from .local import LocalLm
+
+    try:
+        lm = LocalLm(
+            LmParams(
+                **params,
+                on_token=lambda t: None,
+                cache_policy="never",
+                embedding_cache_items=0,
+            )
+        )
+        lm.load_model(*model_args)
+    except Exception as e:
+        conn.send(("error", str(e)))
+        return
+    conn.send(("ready", os.getpid()))
+    while True:
+        try:
+            msg = conn.recv()
+        except (EOFError, OSError):
+            return
+        kind = msg[0]
+        try:
+            if kind == "stop":
+                return
+            elif kind == "generate":
+                _serve_generate(conn, lm, msg[1], msg[2])
+            elif kind == "embed":
+                conn.send(("result", lm._embed(msg[1], msg[2])))
+            # a late cancel message of a finished query is ignored
+        except Exception as e:
+            conn.send(("error", str(e)))
+
+
+class _Worker:
+    # a worker process and its load
+    def __init__(self, index: int) -> None:
+        self.index = index
+        self.process: Any = None
+        self.conn: Optional[Connection] = None
+        self.pid: Optional[int] = None
+        self.ready = False
+        self.starting = False
+        self.busy = False
+        self.busy_since = 0.0
+        self.busy_time = 0.0
+        self.started = time.monotonic()
+        self.requests = 0
+        self.generated_tokens = 0
+        self.failures = 0
+        self.restarts = 0
+        self._send_lock = threading.Lock()
+
+    def send(self, msg: tuple):
+        # the cancel messages are sent from other threads
+        with self._send_lock:
+            self.conn.send(msg)  # type: ignore
+
+    def cancel(self):
+        try:
+            self.send(("cancel",))
+        except (OSError, ValueError):
+            pass
+
+    def stop(self, timeout: float = 5):
+        if self.process is None:
+            return
+        try:
+            self.send(("stop",))
+        except (OSError, ValueError):
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()  # type: ignore
+        self.ready = False
+
+
+class _Query:
+    # a generation running on a worker: iterate over its (text, stats) messages
+    def __init__(self, pool: "LocalPoolLm", worker: _Worker) -> None:
+        self.pool = pool
+        self.worker = worker
+        self.process = worker.process
+        self.tokens = 0
+        self.finished = False
+        self.failed = False
+        self.closed = False
+
+    def __iter__(self) -> "_Query":
+        return self
+
+    def __next__(self) -> Tuple[str, Optional[InferenceStats]]:
+        if self.finished or self.failed:
+            raise StopIteration
+        try:
+            msg = self.worker.conn.recv()  # type: ignore
+        except (EOFError, OSError):
+            self.failed = True
+            self.close()
+            raise Exception(f"The worker process {self.worker.pid} stopped")
+        if msg[0] == "token":
+            if msg[2] is None:
+                self.tokens += 1
+            return msg[1], msg[2]
+        self.finished = True
+        self.close()
+        if msg[0] == "error":
+            raise Exception(msg[1])
+        raise StopIteration
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if not self.finished and not self.failed:
+            # the caller left early: stop the generation and skip its last
+            # messages
+            self.worker.cancel()
+            try:
+                while self.worker.conn.recv()[0] == "token":  # type: ignore
+                    pass
+            except (EOFError, OSError):
+                self.failed = True
+        self.pool._release(self.worker, self.process, self.tokens, self.failed)
+
+
+class LocalPoolLm(LmProvider):
+    """
+    A provider that runs the local models in several worker processes to use all
+    the cores of a machine: one `Llama` object runs one query at a time. Each
+    worker loads the model with mmap, so that the weights are shared through the
+    page cache, and gets a share of the threads. The tokens are streamed back to
+    the main process, that never loads llama.cpp. A crashed worker is restarted
+
+    Example:
+        >>> from locallm import LocalPoolLm, LmParams
+        >>> lm = LocalPoolLm(LmParams(models_dir="/absolute/path/to/models",
+            workers=4, threads=32))
+        >>> lm.load_model('my_model.gguf', 2048)
+        >>> lm.infer_many(prompts, max_concurrency=4)
+    """
+
+    ptype: LmProviderType
+    models_dir = ""
+    loaded_model = ""
+    ctx = 2048
+    is_verbose = False
+    on_token: OnTokenType | None = None
+    on_start_emit: OnStartEmitType | None = None
+    workers: List[_Worker]
+    threads: int = 1
+    executor: ThreadPoolExecutor | None = None
+
+    def __init__(
+        self,
+        params: LmParams,
+    ) -> None:
+        """
+        Initialize a new instance of the LocalPoolLm class. The workers start
+        when a model is loaded
+
+        Args:
+            params (LmParams): The parameters to use when initializing the instance.
+                The `threads` are split between the `workers`.
+
+        Raises:
+            ValueError: If `params.models_dir` is not provided.
+
+        Example:
+            >>> from locallm import LocalPoolLm, LmParams
+            >>> lm = LocalPoolLm(LmParams(models_dir='/absolute/path/to/models',
+                workers=4))
+        """
+        self.ptype = "local_pool"
+        self.handles = set()
+        self._init_cache(params)
+        if params.models_dir is None:
+            raise ValueError("Provide a models_dir parameter")
+        self.models_dir = params.models_dir
+        if params.is_verbose is True:
+            self.is_verbose = True
+        if params.on_token:
+            self.on_token = params.on_token
+        else:
+            self.on_token = defaultOnToken
+        if params.on_start_emit:
+            self.on_start_emit = params.on_start_emit
+        self.token_batch_size = params.token_batch_size
+        self.token_batch_ms = params.token_batch_ms
+        n_workers = params.workers or DEFAULT_WORKERS
+        self.threads = max(1, (params.threads or os.cpu_count() or 1) // n_workers)
+        self.max_batch_concurrency = n_workers
+        self._params = {
+            name: getattr(params, name)
+            for name in WORKER_PARAMS
+            if getattr(params, name) is not None
+        }
+        self._params["threads"] = self.threads
+        # the workers evaluate the prompts at the same time
+        self._params["threads_batch"] = (
+            max(1, params.threads_batch // n_workers)
+            if params.threads_batch
+            else self.threads
+        )
+        # the workers do not share the llama.cpp native state with the main
+        # process
+        self._mp = multiprocessing.get_context("spawn")
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._model_args: Optional[tuple] = None
+        self._closed = False
+        self.workers = [_Worker(i) for i in range(n_workers)]
+
+    def load_model(self, model_name: str, ctx: int, gpu_layers: Optional[int] = None):
+        """
+        Start the workers and load the model in each of them. The running
+        workers are stopped first
+
+        Args:
+            model_name (str): The name of the model to be loaded.
+            ctx (int): The context window size for the model.
+            gpu_layers (Optional[int], optional): The number of GPU layers to use.
+                Defaults to None.
+
+        Raises:
+            Exception: If a worker can not load the model.
+
+        Example:
+            >>> lm.load_model('my_model.gguf', 2048)
+        """
+        self.close()
+        self._closed = False
+        self._model_args = (model_name, ctx, gpu_layers)
+        for worker in self.workers:
+            self._spawn(worker)
+        errors = [self._wait_ready(worker) for worker in self.workers]
+        if any(error is not None for error in errors):
+            self.close()
+            raise Exception(next(e for e in errors if e is not None))
+        self.loaded_model = model_name
+        self.ctx = ctx
+
+    def infer(
+        self,
+        prompt: str,
+        params: InferenceParams = InferenceParams(),
+        handle: Optional[CancelHandle] = None,
+    ) -> InferenceResult:
+        """
+        Run an inference query on an idle worker. The query waits for a worker
+        if they are all busy
+
+        Args:
+            prompt (str): The prompt to use for the inference.
+            params (InferenceParams, optional): The inference parameters. Defaults to
+                InferenceParams().
+            handle (Optional[CancelHandle], optional): A handle to cancel the
+                query. Defaults to None.
+
+        Returns:
+            InferenceResult: The result of the inference.
+
+        Raises:
+            Exception: If no worker is running or if the worker stops.
+        """
+        return self._run_infer(prompt, params, handle)
+
+    def generate(
+        self,
+        prompt: str,
+        params: InferenceParams = InferenceParams(),
+        handle: Optional[CancelHandle] = None,
+        raw: bool = False,
+    ) -> GenerationStream[Any]:
+        """
+        Run an inference query on an idle worker and return a stream
+
+        Args:
+            prompt (str): The prompt to use for the inference.
+            params (InferenceParams, optional): The inference parameters. Defaults to
+                InferenceParams().
+            handle (Optional[CancelHandle], optional): A handle to cancel the
+                query. Defaults to None.
+            raw (bool, optional): Iterate over the token texts only. Defaults to
+                False.
+
+        Returns:
+            GenerationStream[Any]: The stream iterator of `Token` records, or
+                of texts if raw. The last record holds the stats of the query
+
+        Raises:
+            Exception: If no worker is running or if the worker stops.
+        """
+        params.stream = True
+        res: GenerationStream[Any] = self._infer(  # type: ignore
+            prompt, params, True, handle, raw=raw
+        )
+        return res
+
+    async def ainfer(
+        self,
+        prompt: str,
+        params: InferenceParams = InferenceParams(),
+        handle: Optional[CancelHandle] = None,
+    ) -> InferenceResult:
+        """
+        Run an inference query on an idle worker without blocking the event loop
+
+        Args:
+            prompt (str): The prompt to use for the inference.
+            params (InferenceParams, optional): The inference parameters. Defaults to
+                InferenceParams().
+            handle (Optional[CancelHandle], optional): A handle to cancel the
+                query. Defaults to None.
+
+        Returns:
+            InferenceResult: The result of the inference.
+
+        Raises:
+            Exception: If no worker is running or if the worker stops.
+        """
+        key = self._cache_key(prompt, params)
+        cached = self._cache_get(key)
+        if cached is not None:
+            return cached
+        handle = handle or CancelHandle()
+        # the stream applies the stops: the consumer only emits its text
+        consumer = self._consumer()
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=len(self.workers))
+
+        def records() -> Iterator[Token]:
+            stream = self.generate(prompt, params, handle)
+            try:
+                yield from stream
+            finally:
+                stream.close()
+
+        # the last record holds the stats of the query
+        stats: Optional[InferenceStats] = None
+        tokens = iterate_in_executor(records, executor=self.executor)
+        try:
+            async for token in tokens:
+                is_token = token.stats is None
+                if not is_token:
+                    stats = token.stats
+                if is_token or token.text:
+                    consumer.push(token.text, is_token)
+        finally:
+            # leaving the generator early stops the generation
+            await tokens.aclose()  # type: ignore
+        if stats is None:
+            stats = consumer.recorder.stats()
+        result: InferenceResult = {"text": consumer.text(), "stats": stats}
+        self._cache_set(key, result, handle)
+        return result
+
+    async def agenerate(
+        self,
+        prompt: str,
+        params: InferenceParams = InferenceParams(),
+        handle: Optional[CancelHandle] = None,
+    ) -> AsyncIterator[str]:
+        """
+        Run an inference query on an idle worker and iterate over the tokens
+        without blocking the event loop
+
+        Args:
+            prompt (str): The prompt to use for the inference.
+            params (InferenceParams, optional): The inference parameters. Defaults to
+                InferenceParams().
+            handle (Optional[CancelHandle], optional): A handle to cancel the
+                query. Defaults to None.
+
+        Returns:
+            AsyncIterator[str]: The generated tokens
+
+        Raises:
+            Exception: If no worker is running or if the worker stops.
+        """
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=len(self.workers))
+
+        def tokens() -> Iterator[str]:
+            stream = self.generate(prompt, params, handle, raw=True)
+            try:
+                yield from stream
+            finally:
+                stream.close()
+
+        async for token in iterate_in_executor(tokens, executor=self.executor):
+            yield token
+
+    @property
+    def stats(self) -> List[Dict[str, Any]]:
+        """The state and utilization of each worker"""
+        now = time.monotonic()
+        with self._lock:
+            res = []
+            for worker in self.workers:
+                busy_time = worker.busy_time
+                if worker.busy:
+                    busy_time += now - worker.busy_since
+                uptime = now - worker.started
+                res.append(
+                    {
+                        "pid": worker.pid,
+                        "alive": worker.ready,
+                        "busy": worker.busy,
+                        "requests": worker.requests,
+                        "generated_tokens": worker.generated_tokens,
+                        "failures": worker.failures,
+                        "restarts": worker.restarts,
+                        "utilization": busy_time / uptime if uptime > 0 else 0.0,
+                    }
+                )
+            return res
+
+    def close(self):
+        """Stop the workers"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for worker in self.workers:
+            worker.stop()
+
+    def _spawn(self, worker: _Worker):
+        conn, child_conn = self._mp.Pipe()
+        process = self._mp.Process(
+            target=_worker_main,
+            args=(child_conn, self._params, self._model_args),
+            daemon=True,
+        )
+        process.start()
+        # the pipe reports the end of the process once its copy is closed
+        child_conn.close()
+        with self._lock:
+            worker.process = process
+            worker.conn = conn
+            worker.starting = True
+
+    def _wait_ready(self, worker: _Worker) -> Optional[str]:
+        # wait for the model of a started worker: return the error if any
+        try:
+            msg = worker.conn.recv()  # type: ignore
+        except (EOFError, OSError):
+            msg = ("error", "The worker process stopped while loading the model")
+        with self._cond:
+            worker.starting = False
+            if msg[0] != "ready":
+                return msg[1]
+            worker.pid = msg[1]
+            worker.ready = True
+            worker.busy = False
+            worker.busy_time = 0.0
+            worker.started = time.monotonic()
+            self._cond.notify_all()
+        return None
+
+    def _restart(self, worker: _Worker):
+        worker.stop(0)
+        with self._lock:
+            if self._closed:
+                return
+            worker.restarts += 1
+        self._spawn(worker)
+        error = self._wait_ready(worker)
+        if error is not None and self.is_verbose is True:
+            print("Worker restart error", error)
+        with self._cond:
+            self._cond.notify_all()
+
+    def _acquire(self) -> _Worker:
+        with self._cond:
+            while True:
+                for worker in self.workers:
+                    if worker.ready and not worker.busy:
+                        if not worker.process.is_alive():
+                            # the worker crashed between two queries
+                            self._schedule_restart(worker)
+                idle = [w for w in self.workers if w.ready and not w.busy]
+                if len(idle) > 0:
+                    worker = min(idle, key=lambda w: w.requests)
+                    worker.busy = True
+                    worker.busy_since = time.monotonic()
+                    worker.requests += 1
+                    return worker
+                if self._closed or not any(
+                    w.ready or w.starting for w in self.workers
+                ):
+                    raise Exception("No worker is running: use the load_model method")
+                self._cond.wait()
+
+    def _release(self, worker: _Worker, process: Any, tokens: int, failed: bool):
+        with self._cond:
+            worker.busy = False
+            worker.busy_time += time.monotonic() - worker.busy_since
+            worker.generated_tokens += tokens
+            if failed and worker.process is process:
+                self._schedule_restart(worker)
+            self._cond.notify_all()
+
+    def _schedule_restart(self, worker: _Worker):
+        # called with the lock: restart a crashed worker, unless the pool was
+        # stopped meanwhile
+        worker.failures += 1
+        worker.ready = False
+        if self._closed:
+            return
+        worker.starting = True
+        threading.Thread(target=self._restart, args=(worker,), daemon=True).start()
+
+    def _start_query(
+        self, prompt: str, params: InferenceParams, handle: Optional[CancelHandle]
+    ) -> Tuple[_Query, CancelHandle]:
+        worker = self._acquire()
+        query = _Query(self, worker)
+        try:
+            worker.send(("generate", prompt, params))
+        except (OSError, ValueError):
+            query.failed = True
+            query.close()
+            raise Exception(f"The worker process {worker.pid} stopped")
+        handle = self._open_handle(handle)
+        # stop the generation on the worker even between two tokens
+        handle.on_cancel(worker.cancel)
+        return query, handle
+
+    def _embed(self, texts: List[str], model: Optional[str]) -> "np.ndarray":
+        worker = self._acquire()
+        failed = False
+        try:
+            worker.send(("embed", texts, model))
+            msg = worker.conn.recv()  # type: ignore
+        except (EOFError, OSError, ValueError):
+            failed = True
+            raise Exception(f"The worker process {worker.pid} stopped")
+        finally:
+            self._release(worker, worker.process, 0, failed)
+        if msg[0] == "error":
+            raise Exception(msg[1])
+        return msg[1]
+
+    def _infer(
+        self,
+        prompt: str,
+        params: InferenceParams = InferenceParams(),
+        return_stream=False,
+        handle: Optional[CancelHandle] = None,
+        emit: bool = True,
+        raw: bool = False,
+    ) -> InferenceResult | GenerationStream[Any]:
+        # the tokens are only emitted in stream mode
+        consumer = self._consumer(emit and params.stream is True, params)
+        query, handle = self._start_query(prompt, params, handle)
+
+        def close():
+            self._close_handle(handle)
+            query.close()
+
+        if return_stream is True:
+            tokens = self._tokens(query, raw, self._consumer(False, params))
+            return GenerationStream(tokens, handle, close)
+        stream = GenerationStream(query, handle, close)
+        final: Optional[InferenceStats] = None
+        for text, token_stats in stream:
+            if token_stats is not None:
+                final = token_stats
+            is_token = token_stats is None
+            if (is_token or text) and consumer.push(text, is_token):
+                # closing the stream stops the generation
+                stream.close()
+                break
+        return {"text": consumer.text(), "stats": self._get_stats(consumer, final)}
+
+    def _tokens(
+        self, query: _Query, raw: bool, consumer: TokenConsumer
+    ) -> Iterator[Any]:
+        # the workers stream the token records of the local provider, the stops
+        # are applied here
+        index = 0
+        final: Optional[InferenceStats] = None
+        text = ""
+        for token, token_stats in query:
+            is_token = token_stats is None
+            if not is_token:
+                final = token_stats
+            text, stopped = consumer.feed(token, is_token)
+            if stopped or not is_token:
+                # the text cleared by the stop or the text of the final record
+                break
+            if raw is False:
+                yield Token(text, index, time.perf_counter())
+                index += 1
+            elif text:
+                yield text
+            text = ""
+        text += consumer.rest()
+        if raw is True:
+            if text:
+                yield text
+            return
+        yield Token(text, index, time.perf_counter(), self._get_stats(consumer, final))
+
+    def _get_stats(
+        self, consumer: TokenConsumer, final: Optional[InferenceStats]
+    ) -> InferenceStats:
+        # the prompt and draft stats measured by the worker
+        if final is None:
+            return consumer.recorder.stats()
+        stats = consumer.recorder.stats(
+            prompt_tokens=final.get("prompt_tokens"),
+            skipped_prompt_tokens=final.get("skipped_prompt_tokens"),
+        )
+        for name in DRAFT_STATS:
+            if name in final:
+                stats[name] = final[name]  # type: ignore
+        return stats
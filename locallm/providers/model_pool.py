@@ -0,0 +1,142 @@
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+from llama_cpp import Llama
+
+
+class ModelPool:
+    """
+    A pool of loaded models that evicts the least recently used ones. The size of
+    a model is estimated from its gguf file.
+
+    Args:
+        max_models (Optional[int], optional): The maximum number of models to keep
+            loaded. Defaults to 1.
+        max_bytes (Optional[int], optional): The memory budget for the models in
+            bytes. Defaults to None: no limit.
+        on_unload (Optional[Callable[[str], None]], optional): A function called
+            with the name of a model before it is closed, to drop the references
+            to it. Defaults to None.
+
+    Attributes:
+        loads (int): The number of models loaded.
+        hits (int): The number of requests for an already loaded model.
+        evictions (int): The number of models unloaded to respect the limits.
+        load_times (Dict[str, float]): The last load time of each model in seconds.
+
+    Example:
+        >>> pool = ModelPool(max_models=2)
+        >>> llm = pool.get("router.gguf", 2048, lambda: Llama(model_path=...))
+    """
+
+    loads: int = 0
+    hits: int = 0
+    evictions: int = 0
+
+    def __init__(
+        self,
+        max_models: Optional[int] = 1,
+        max_bytes: Optional[int] = None,
+        on_unload: Optional[Callable[[str], None]] = None,
+    ) -> None:
+        self.max_models = max_models
+        self.max_bytes = max_bytes
+        self.on_unload = on_unload
+        self.size = 0
+        self.load_times: Dict[str, float] = {}
+        # model name -> (model, context window size, size in bytes)
+        self._models: OrderedDict[str, Tuple[Llama, int, int]] = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(
+        self, name: str, ctx: int, loader: Callable[[], Llama], path: Path
+    ) -> Llama:
+        """
+        Get a model from the pool, loading it if needed
+
+        Args:
+            name (str): The model name.
+            ctx (int): The context window size.
+            loader (Callable[[], Llama]): A function to load the model.
+            path (Path): The model file, to estimate its size.
+
+        Returns:
+            Llama: The model.
+        """
+        with self._lock:
+            item = self._models.get(name)
+            if item is not None:
+                if item[1] == ctx:
+                    self._models.move_to_end(name)
+                    self.hits += 1
+                    return item[0]
+                # the context window changed: reload the model
+                self._unload(name)
+            size = path.stat().st_size if path.exists() else 0
+            self._make_room(size)
+            start = time.perf_counter()
+            llm = loader()
+            self.load_times[name] = time.perf_counter() - start
+            self.loads += 1
+            self._models[name] = (llm, ctx, size)
+            self.size += size
+            return llm
+
+    def peek(self, name: str) -> Optional[Tuple[Llama, int]]:
+        """
+        Get a loaded model and its context window size without loading it
+
+        Args:
+            name (str): The model name.
+
+        Returns:
+            Optional[Tuple[Llama, int]]: The model and its context window size or
+                None if it is not loaded.
+        """
+        with self._lock:
+            item = self._models.get(name)
+            if item is None:
+                return None
+            self._models.move_to_end(name)
+            self.hits += 1
+            return item[0], item[1]
+
+    def clear(self):
+        """Unload all the models"""
+        with self._lock:
+            for name in list(self._models):
+                self._unload(name)
+
+    @property
+    def models(self) -> List[str]:
+        """The names of the loaded models, from the least recently used"""
+        return list(self._models)
+
+    @property
+    def stats(self) -> dict:
+        """The loads, hits, evictions counters and the load times"""
+        return {
+            "models": self.models,
+            "loads": self.loads,
+            "hits": self.hits,
+            "evictions": self.evictions,
+            "load_times": dict(self.load_times),
+        }
+
+    def _make_room(self, size: int):
+        while len(self._models) > 0 and (
+            (self.max_models is not None and len(self._models) >= self.max_models)
+            or (self.max_bytes is not None and self.size + size > self.max_bytes)
+        ):
+            self._unload(next(iter(self._models)))
+            self.evictions += 1
+
+    def _unload(self, name: str):
+        llm, _, size = self._models.pop(name)
+        self.size -= size
+        if self.on_unload is not None:
+            self.on_unload(name)
+        llm.close()
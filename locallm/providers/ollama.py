@@ -1,28 +1,82 @@
-import json
-from typing import Dict, Iterator, Optional, Any
+from typing import (
+    TYPE_CHECKING,
+    AsyncIterator,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Any,
+    Tuple,
+)
+import time
 import requests
 
+from ..aio import iter_ndjson
+from ..cancel import CancelHandle, GenerationStream
+from ..connection import get_async_session, get_async_timeout, get_session
+from ..embeddings import to_matrix
 from ..schemas import (
     InferenceParams,
     InferenceResult,
+    InferenceStats,
     LmParams,
     OnTokenType,
     OnStartEmitType,
     LmProviderType,
 )
 from ..provider import LmProvider, defaultOnToken
+from ..stats import StatsRecorder
+from ..stream import Token, TokenConsumer, json_loads
+from ..templates import render_prompt
+from ..translate import ParamTranslator
+
+if TYPE_CHECKING:
+    import numpy as np
 
 
 class OllamaLm(LmProvider):
+    # convert the params to the Ollama api format: the sampling params are
+    # read from the options
+    _translate = ParamTranslator(
+        {
+            "template": None,
+            "variables": None,
+            "threads": "options.num_thread",
+            "max_tokens": "options.num_predict",
+            "temperature": "options.temperature",
+            "top_k": "options.top_k",
+            "top_p": "options.top_p",
+            "min_p": "options.min_p",
+            "stop": "options.stop",
+            "frequency_penalty": "options.frequency_penalty",
+            "presence_penalty": "options.presence_penalty",
+            "repeat_penalty": "options.repeat_penalty",
+            "tfs": "options.tfs_z",
+            # the api constrains the output with a JSON Schema, not a grammar
+            "grammar": None,
+            "json_schema": "format",
+            "model": None,
+            "truncate": None,
+            # the regex stops and the time limit are applied client side
+            "stop_regex": None,
+            "max_time": None,
+        }
+    )
     ptype: LmProviderType
     models_dir = ""
     loaded_model = ""
     ctx = 2048
     headers: Dict[str, str]
     url: str
+    http: requests.Session
+    pool_size: Optional[int] = None
+    keep_alive: Optional[bool] = None
+    timeout: Tuple[Optional[float], Optional[float]] = (None, None)
     is_verbose = False
     on_token: OnTokenType | None = None
     on_start_emit: OnStartEmitType | None = None
+    # the servers older than 0.3 only have the single text embeddings endpoint
+    legacy_embeddings = False
 
     def __init__(
         self,
@@ -50,6 +104,12 @@ class OllamaLm(LmProvider):
             )
         else:
             self.url = params.server_url
+        self.pool_size = params.pool_size
+        self.keep_alive = params.keep_alive
+        self.http = get_session(self.url, self.pool_size, self.keep_alive)
+        self.timeout = (params.connect_timeout, params.read_timeout)
+        self.handles = set()
+        self._init_cache(params)
         if params.is_verbose is True:
             self.is_verbose = True
         if params.on_token:
@@ -58,6 +118,8 @@ class OllamaLm(LmProvider):
             self.on_token = defaultOnToken
         if params.on_start_emit:
             self.on_start_emit = params.on_start_emit
+        self.token_batch_size = params.token_batch_size
+        self.token_batch_ms = params.token_batch_ms
         # print("Initializing lm", model_path)
         self.headers = {
             "Accept": "text/event-stream",
@@ -88,6 +150,7 @@ class OllamaLm(LmProvider):
         self,
         prompt: str,
         params: InferenceParams = InferenceParams(),
+        handle: Optional[CancelHandle] = None,
     ) -> InferenceResult:
         """
         Run an inference query for a prompt and params
@@ -96,6 +159,8 @@ class OllamaLm(LmProvider):
             prompt (str): The prompt to use for the inference.
             params (InferenceParams, optional): The inference parameters. Defaults to
                 InferenceParams().
+            handle (Optional[CancelHandle], optional): A handle to cancel the
+                query. Defaults to None.
 
         Returns:
             InferenceResult: The result of the inference.
@@ -111,14 +176,15 @@ class OllamaLm(LmProvider):
             >>> print(result)
             {'text': 'Paris', 'stats': {}}
         """
-        res: InferenceResult = self._infer(prompt, params)  # type: ignore
-        return res
+        return self._run_infer(prompt, params, handle)
 
     def generate(
         self,
         prompt: str,
         params: InferenceParams = InferenceParams(),
-    ) -> Iterator[Any]:
+        handle: Optional[CancelHandle] = None,
+        raw: bool = False,
+    ) -> GenerationStream[Any]:
         """
         Run an inference query for a prompt and params and return a stream
 
@@ -126,9 +192,14 @@ class OllamaLm(LmProvider):
             prompt (str): The prompt to use for the inference.
             params (InferenceParams, optional): The inference parameters. Defaults to
                 InferenceParams().
+            handle (Optional[CancelHandle], optional): A handle to cancel the
+                query. Defaults to None.
+            raw (bool, optional): Iterate over the token texts only. Defaults to
+                False.
 
         Returns:
-            InferenceResult: The result of the inference.
+            GenerationStream[Any]: The stream iterator of `Token` records, or
+                of texts if raw. The last record holds the stats of the query
 
         Raises:
             Exception: If no model is loaded. Use the load_model method first.
@@ -137,73 +208,440 @@ class OllamaLm(LmProvider):
             >>> from locallm import OllamaLm, LmParams
             >>> lm = OllamaLm(LmParams(is_verbose=True))
             >>> lm.load_model('my_model', 2048)
-            >>> stream = lm.infer("What is the capital of France?")
-            >>> for (line in stream):
-            >>>     # process the line
+            >>> stream = lm.generate("What is the capital of France?")
+            >>> for token in stream:
+            >>>     print(token.text, end="")
         """
         params.stream = True
-        res: Iterator[Any] = self._infer(prompt, params, True)  # type: ignore
+        res: GenerationStream[Any] = self._infer(  # type: ignore
+            prompt, params, True, handle, raw=raw
+        )
         return res
 
-    def _infer(
+    def session(self) -> "OllamaSession":
+        """
+        Start a multi-turn conversation that reuses the context evaluated by
+        Ollama: each turn only evaluates the new message instead of the whole
+        history
+
+        Returns:
+            OllamaSession: The conversation session.
+
+        Example:
+            >>> from locallm import OllamaLm, LmParams
+            >>> lm = OllamaLm(LmParams())
+            >>> lm.load_model('my_model', 2048)
+            >>> chat = lm.session()
+            >>> chat.infer("What is the capital of France?")
+            >>> chat.infer("And of Italy?")
+            >>> print(chat.stats)
+        """
+        return OllamaSession(self)
+
+    async def ainfer(
         self,
         prompt: str,
         params: InferenceParams = InferenceParams(),
-        return_stream=False,
-    ) -> InferenceResult | Iterator[Any]:
-        tpl = params.template or "{prompt}"
-        final_prompt = tpl.replace("{prompt}", prompt)
+        handle: Optional[CancelHandle] = None,
+    ) -> InferenceResult:
+        """
+        Run an inference query for a prompt and params without blocking the
+        event loop
+
+        Args:
+            prompt (str): The prompt to use for the inference.
+            params (InferenceParams, optional): The inference parameters. Defaults to
+                InferenceParams().
+            handle (Optional[CancelHandle], optional): A handle to cancel the
+                query. Defaults to None.
+
+        Returns:
+            InferenceResult: The result of the inference.
+
+        Raises:
+            Exception: If no model is loaded. Use the load_model method first.
+
+        Example:
+            >>> from locallm import OllamaLm, LmParams
+            >>> lm = OllamaLm(LmParams(is_verbose=True))
+            >>> lm.load_model('my_model', 2048)
+            >>> result = await lm.ainfer("What is the capital of France?")
+            >>> print(result)
+            {'text': 'Paris', 'stats': {...}}
+        """
+        key = self._cache_key(prompt, params)
+        cached = self._cache_get(key)
+        if cached is not None:
+            return cached
+        handle = handle or CancelHandle()
+        consumer = self._consumer(params=params)
+        res: InferenceStats = {}
+        bodies = self._astream(prompt, params, handle)
+        try:
+            async for body in bodies:
+                token = body.get("response", "")
+                if token and consumer.push(token):
+                    # the server has no final body for a stopped generation
+                    res = consumer.recorder.stats()
+                    break
+                if body.get("done", False):
+                    res = self._get_stats(body, consumer.recorder)
+        finally:
+            await bodies.aclose()  # type: ignore
+        result: InferenceResult = {"text": consumer.text(), "stats": res}
+        self._cache_set(key, result, handle)
+        return result
+
+    async def agenerate(
+        self,
+        prompt: str,
+        params: InferenceParams = InferenceParams(),
+        handle: Optional[CancelHandle] = None,
+    ) -> AsyncIterator[str]:
+        """
+        Run an inference query for a prompt and params and iterate over the
+        tokens without blocking the event loop
+
+        Args:
+            prompt (str): The prompt to use for the inference.
+            params (InferenceParams, optional): The inference parameters. Defaults to
+                InferenceParams().
+            handle (Optional[CancelHandle], optional): A handle to cancel the
+                query. Defaults to None.
+
+        Returns:
+            AsyncIterator[str]: The generated tokens
+
+        Raises:
+            Exception: If no model is loaded. Use the load_model method first.
+
+        Example:
+            >>> from locallm import OllamaLm, LmParams
+            >>> lm = OllamaLm(LmParams(is_verbose=True))
+            >>> lm.load_model('my_model', 2048)
+            >>> async for token in lm.agenerate("What is the capital of France?"):
+            >>>     print(token, end="")
+        """
+        consumer = self._consumer(False, params)
+        bodies = self._astream(prompt, params, handle)
+        try:
+            async for body in bodies:
+                token = body.get("response", "")
+                if not token:
+                    continue
+                text, stopped = consumer.feed(token)
+                if text:
+                    yield text
+                if stopped:
+                    break
+        finally:
+            # leaving the generator early stops the generation
+            await bodies.aclose()  # type: ignore
+        text = consumer.rest()
+        if text:
+            yield text
+
+    async def _astream(
+        self,
+        prompt: str,
+        params: InferenceParams,
+        handle: Optional[CancelHandle] = None,
+        session: Optional["OllamaSession"] = None,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        params.stream = True
+        context = session.context if session is not None else None
+        payload = self._get_payload(prompt, params, context)
+        client = get_async_session(self.url, self.pool_size, self.keep_alive)
+        handle = self._open_handle(handle)
+        try:
+            async with client.post(
+                self.url + "/api/generate",
+                headers=self.headers,
+                json=payload,
+                timeout=get_async_timeout(*self.timeout),
+            ) as response:
+                async for body in iter_ndjson(response):
+                    if handle.cancelled:
+                        # closing the connection stops the generation
+                        response.close()
+                        break
+                    if "error" in body:
+                        raise Exception(body["error"])  # type: ignore
+                    if session is not None and body.get("done", False):
+                        session._update(body, len(context or []))
+                    yield body
+        finally:
+            self._close_handle(handle)
+
+    def _get_payload(
+        self,
+        prompt: str,
+        params: InferenceParams,
+        context: Optional[List[int]] = None,
+    ) -> Dict[str, Any]:
+        # the api has no tokenizer endpoint: the counts are estimated
+        prompt = self.fit_prompt(prompt, params)
+        final_prompt = render_prompt(prompt, params)
         if self.is_verbose:
             print("Running inference with prompt:")
             print(final_prompt)
-        if self.loaded_model == "":
+        if self.loaded_model == "" and params.model is None:
             raise Exception("No model is loaded: use the load_model method first")
-        final_params = params.model_dump(exclude_none=True, exclude_unset=True)
-        final_params["model"] = self.loaded_model
-        final_params["num_ctx"] = self.ctx
-        if "template" in final_params:
-            del final_params["template"]
-        if "threads" in final_params:
-            final_params["num_threads"] = final_params["threads"]
-            del final_params["threads"]
-        if "stop" in final_params:
-            final_params["stop_sequence"] = ",".join(final_params["stop"])
-            del final_params["stop"]
-        if "tfs" in final_params:
-            final_params["tfs_z"] = final_params["tfs"]
-            del final_params["tfs"]
-        if "max_tokens" in final_params:
-            final_params["num_predict"] = final_params["max_tokens"]
-            del final_params["max_tokens"]
+        final_params = self._translate(params)
         if self.is_verbose:
             print("Inference parameters:")
             print(final_params)
         payload = {
             "prompt": final_prompt,
             **final_params,
+            # the server loads the models on demand: route the query by model name
+            "model": params.model or self.loaded_model,
+            "options": {**final_params.get("options", {}), "num_ctx": self.ctx},
         }
-        url = self.url + "/api/generate"
-        response = requests.post(url, stream=True, headers=self.headers, json=payload)
-        text = ""
-        res = {}
-        if return_stream is True:
-            s: Iterator[Any] = response.iter_lines()  # type: ignore
-            return s
+        if context:
+            payload["context"] = context
+        return payload
+
+    def _embed(self, texts: List[str], model: Optional[str]) -> "np.ndarray":
+        model_name = model or self.loaded_model
+        if model_name == "":
+            raise Exception("No model is loaded: use the load_model method first")
+        if self.legacy_embeddings is False:
+            response = self.http.post(
+                self.url + "/api/embed",
+                headers=self.headers,
+                json={"model": model_name, "input": texts},
+                timeout=self.timeout,
+            )
+            if response.status_code != 404:
+                response.raise_for_status()
+                return to_matrix(json_loads(response.content)["embeddings"])
+            self.legacy_embeddings = True
+        rows = []
+        for text in texts:
+            response = self.http.post(
+                self.url + "/api/embeddings",
+                headers=self.headers,
+                json={"model": model_name, "prompt": text},
+                timeout=self.timeout,
+            )
+            response.raise_for_status()
+            rows.append(json_loads(response.content)["embedding"])
+        return to_matrix(rows)
+
+    def _tokens(
+        self, response: requests.Response, raw: bool, consumer: TokenConsumer
+    ) -> Iterator[Any]:
+        # parse the lines once and apply the stops: the token records end with
+        # the stats
+        index = 0
+        final: Optional[Dict[str, Any]] = None
         for line in response.iter_lines():
-            body = json.loads(line)
+            if not line:
+                continue
+            body = json_loads(line)
+            if "error" in body:
+                raise Exception(body["error"])  # type: ignore
+            if body.get("done", False):
+                final = body
             token = body.get("response", "")
-            if self.on_token:
-                self.on_token(token)
-            text = text + token
+            if not token:
+                continue
+            text, stopped = consumer.feed(token)
+            if raw is False:
+                yield Token(text, index, time.perf_counter())
+                index += 1
+            elif text:
+                yield text
+            if stopped:
+                # the stream is closed at the end: it stops the generation
+                break
+        text = consumer.rest()
+        if raw is True:
+            if text:
+                yield text
+            return
+        if final is None:
+            # the server has no final body for a stopped generation
+            stats = consumer.recorder.stats()
+        else:
+            stats = self._get_stats(final, consumer.recorder)
+        yield Token(text, index, time.perf_counter(), stats)
+
+    def _get_stats(
+        self, body: Dict[str, Any], recorder: StatsRecorder
+    ) -> InferenceStats:
+        # the server reports its durations in nanoseconds
+        def seconds(key: str) -> Optional[float]:
+            value = body.get(key)
+            return value / 1e9 if value is not None else None
+
+        return recorder.stats(
+            prompt_tokens=body.get("prompt_eval_count"),
+            generated_tokens=body.get("eval_count"),
+            prompt_time=seconds("prompt_eval_duration"),
+            generation_time=seconds("eval_duration"),
+            server_time=seconds("total_duration"),
+        )
+
+    def _infer(
+        self,
+        prompt: str,
+        params: InferenceParams = InferenceParams(),
+        return_stream=False,
+        handle: Optional[CancelHandle] = None,
+        emit: bool = True,
+        session: Optional["OllamaSession"] = None,
+        raw: bool = False,
+    ) -> InferenceResult | GenerationStream[Any]:
+        consumer = self._consumer(emit, params)
+        context = session.context if session is not None else None
+        payload = self._get_payload(prompt, params, context)
+        url = self.url + "/api/generate"
+        response = self.http.post(
+            url, stream=True, headers=self.headers, json=payload, timeout=self.timeout
+        )
+        # register the handle once the query runs: the errors above leave nothing
+        # to release
+        handle = self._open_handle(handle)
+
+        def close():
+            # closing the connection of a running generation stops it
+            self._close_handle(handle)
+            response.close()
+
+        if return_stream is True:
+            tokens = self._tokens(response, raw, self._consumer(False, params))
+            return GenerationStream(tokens, handle, close)
+        lines = GenerationStream(response.iter_lines(), handle, close)
+        res: InferenceStats = {}
+        for line in lines:
+            body = json_loads(line)
             if "error" in body:
+                lines.close()
                 raise Exception(body["error"])  # type: ignore
+            token = body.get("response", "")
+            if token and consumer.push(token):
+                # closing the connection stops the generation: a session turn
+                # gets no context and is left out of the conversation
+                lines.close()
+                res = consumer.recorder.stats()
+                break
             if body.get("done", False):
-                res = body
-                del res["done"]
-                del res["context"]
-                del res["model"]
-                del res["created_at"]
-        return {"text": text, "stats": res}
-
-    def abort(self):
-        pass
+                res = self._get_stats(body, consumer.recorder)
+                if session is not None:
+                    session._update(body, len(context or []))
+        return {"text": consumer.text(), "stats": res}
+
+
+class OllamaSession:
+    """
+    A multi-turn conversation with an Ollama model. The token context returned by
+    the server is passed back on the next turn, so that the history is not
+    evaluated again. The stop strings are applied by the server, which returns
+    the context. A turn stopped on the client side, by a regex stop, the time
+    limit or an invalid structured output, stops the generation right away: the
+    server returns no context and the turn is left out of the history.
+
+    Attributes:
+        lm (OllamaLm): The provider.
+        context (List[int]): The token context returned by the last turn.
+        turns (int): The number of completed turns.
+        prompt_eval_count (int): The number of prompt tokens evaluated by the
+            server over all the turns.
+        reused_tokens (int): The number of context tokens passed back to the
+            server over all the turns, that did not need to be sent as text.
+
+    Example:
+        >>> chat = lm.session()
+        >>> chat.infer("What is the capital of France?")
+        >>> chat.infer("And of Italy?")
+    """
+
+    lm: OllamaLm
+    context: List[int]
+    turns: int = 0
+    prompt_eval_count: int = 0
+    reused_tokens: int = 0
+
+    def __init__(self, lm: OllamaLm) -> None:
+        self.lm = lm
+        self.context = []
+
+    def infer(
+        self,
+        prompt: str,
+        params: InferenceParams = InferenceParams(),
+        handle: Optional[CancelHandle] = None,
+    ) -> InferenceResult:
+        """
+        Run a turn of the conversation
+
+        Args:
+            prompt (str): The new message.
+            params (InferenceParams, optional): The inference parameters. Defaults to
+                InferenceParams().
+            handle (Optional[CancelHandle], optional): A handle to cancel the
+                query. Defaults to None.
+
+        Returns:
+            InferenceResult: The result of the inference.
+        """
+        res: InferenceResult = self.lm._infer(  # type: ignore
+            prompt, params, handle=handle, session=self
+        )
+        return res
+
+    async def ainfer(
+        self,
+        prompt: str,
+        params: InferenceParams = InferenceParams(),
+        handle: Optional[CancelHandle] = None,
+    ) -> InferenceResult:
+        """
+        Run a turn of the conversation without blocking the event loop
+
+        Args:
+            prompt (str): The new message.
+            params (InferenceParams, optional): The inference parameters. Defaults to
+                InferenceParams().
+            handle (Optional[CancelHandle], optional): A handle to cancel the
+                query. Defaults to None.
+
+        Returns:
+            InferenceResult: The result of the inference.
+        """
+        consumer = self.lm._consumer(params=params)
+        res: InferenceStats = {}
+        bodies = self.lm._astream(prompt, params, handle, self)
+        try:
+            async for body in bodies:
+                token = body.get("response", "")
+                if token and consumer.push(token):
+                    # the server has no final body for a stopped generation
+                    res = consumer.recorder.stats()
+                    break
+                if body.get("done", False):
+                    res = self.lm._get_stats(body, consumer.recorder)
+        finally:
+            await bodies.aclose()  # type: ignore
+        return {"text": consumer.text(), "stats": res}
+
+    def reset(self):
+        """Forget the conversation history"""
+        self.context = []
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        """The turns, evaluated prompt tokens and reused context tokens counters"""
+        return {
+            "turns": self.turns,
+            "prompt_eval_count": self.prompt_eval_count,
+            "reused_tokens": self.reused_tokens,
+        }
+
+    def _update(self, body: Dict[str, Any], reused: int):
+        self.context = body.get("context", [])
+        self.turns += 1
+        self.prompt_eval_count += body.get("prompt_eval_count", 0)
+        self.reused_tokens += reused
@@ -0,0 +1,241 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+from llama_cpp import Llama, LlamaState
+
+
+class PrefixCache:
+    """
+    A cache of llama.cpp states for the evaluated prompt prefixes, like the fixed
+    few shots preamble of a template. The states are keyed by a hash of the
+    model, its context settings and the prefix tokens and kept in memory, and
+    optionally on disk as numpy archives. Both stores evict the least recently
+    used states to respect their size limits.
+
+    Args:
+        max_bytes (int): The maximum size of the states kept in memory.
+        disk_dir (Optional[str], optional): A directory to persist the states.
+            Defaults to None: no disk cache.
+        disk_max_bytes (Optional[int], optional): The maximum size of the states
+            stored on disk. Defaults to None: no limit.
+
+    Attributes:
+        hits (int): The number of prefixes restored from the cache.
+        misses (int): The number of prefixes evaluated and stored.
+        evictions (int): The number of states removed to respect the size limits.
+
+    Example:
+        >>> cache = PrefixCache(512 * 1024 * 1024, disk_dir="/tmp/states")
+        >>> skipped = cache.prepare(llm, tokens, prefix_len)
+    """
+
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+    def __init__(
+        self,
+        max_bytes: int,
+        disk_dir: Optional[str] = None,
+        disk_max_bytes: Optional[int] = None,
+    ) -> None:
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.disk_dir = Path(disk_dir) if disk_dir is not None else None
+        self.disk_max_bytes = disk_max_bytes
+        if self.disk_dir is not None:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+        self._states: OrderedDict[str, LlamaState] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def prepare(
+        self, llm: Llama, tokens: Sequence[int], prefix_len: int, model: str = ""
+    ) -> int:
+        """
+        Put the model in a state where the prefix of the prompt is already
+        evaluated, restoring it from the cache or evaluating and storing it.
+
+        Args:
+            llm (Llama): The model.
+            tokens (Sequence[int]): The prompt tokens.
+            prefix_len (int): The number of tokens of the static prefix.
+            model (str, optional): The model name: the states of a model can not
+                be used with another one. Defaults to "".
+
+        Returns:
+            int: The number of prompt tokens that the model will not evaluate.
+        """
+        # the model always evaluates the last prompt token
+        prefix_len = min(prefix_len, len(tokens) - 1)
+        if prefix_len <= 0:
+            return common_prefix_len(llm, tokens)
+        if common_prefix_len(llm, tokens) >= prefix_len:
+            # the model state already holds the prefix
+            return common_prefix_len(llm, tokens)
+        prefix = list(tokens[:prefix_len])
+        key = state_key(llm, prefix, model)
+        state = self.get(key)
+        if state is not None:
+            llm.load_state(state)
+            return common_prefix_len(llm, tokens)
+        llm.reset()
+        llm.eval(prefix)
+        self.set(key, llm.save_state())
+        return 0
+
+    def get(self, key: str) -> Optional[LlamaState]:
+        """
+        Get a state from memory or from disk
+
+        Args:
+            key (str): The prefix hash.
+
+        Returns:
+            Optional[LlamaState]: The state or None if not found.
+        """
+        with self._lock:
+            state = self._states.get(key)
+            if state is not None:
+                self._states.move_to_end(key)
+                self.hits += 1
+                return state
+        if self.disk_dir is not None:
+            path = self.disk_dir / f"{key}.state"
+            if path.exists():
+                state = load_state(path)
+                path.touch()
+                self._store(key, state)
+                with self._lock:
+                    self.hits += 1
+                return state
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, key: str, state: LlamaState):
+        """
+        Store a state in memory and on disk
+
+        Args:
+            key (str): The prefix hash.
+            state (LlamaState): The state.
+        """
+        self._store(key, state)
+        if self.disk_dir is not None:
+            save_state(self.disk_dir / f"{key}.state", state)
+            self._evict_disk()
+
+    @property
+    def stats(self) -> dict:
+        """The hits, misses and evictions counters"""
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+    def _store(self, key: str, state: LlamaState):
+        with self._lock:
+            if key in self._states:
+                self.size -= self._states.pop(key).llama_state_size
+            self._states[key] = state
+            self.size += state.llama_state_size
+            while len(self._states) > 1 and self.size > self.max_bytes:
+                _, evicted = self._states.popitem(last=False)
+                self.size -= evicted.llama_state_size
+                self.evictions += 1
+
+    def _evict_disk(self):
+        if self.disk_dir is None or self.disk_max_bytes is None:
+            return
+        files: List[Tuple[float, int, Path]] = []
+        for path in self.disk_dir.glob("*.state"):
+            stat = path.stat()
+            files.append((stat.st_mtime, stat.st_size, path))
+        files.sort()
+        total = sum(f[1] for f in files)
+        while len(files) > 1 and total > self.disk_max_bytes:
+            _, size, path = files.pop(0)
+            path.unlink(missing_ok=True)
+            total -= size
+            with self._lock:
+                self.evictions += 1
+
+
+def state_key(llm: Llama, prefix: Sequence[int], model: str = "") -> str:
+    """
+    Hash a prefix with the settings that a state depends on: the model and the
+    context size, batch size and kv cache types
+
+    Args:
+        llm (Llama): The model.
+        prefix (Sequence[int]): The prefix tokens.
+        model (str, optional): The model name. Defaults to "".
+
+    Returns:
+        str: The state key.
+    """
+    ctx = llm.context_params
+    settings = f"{model}:{ctx.n_ctx}:{ctx.n_batch}:{ctx.type_k}:{ctx.type_v}:"
+    raw = settings.encode("utf-8") + b"".join(t.to_bytes(4, "little") for t in prefix)
+    return hashlib.sha256(raw).hexdigest()
+
+
+def save_state(path: Path, state: LlamaState):
+    """
+    Write a state to disk as a numpy archive, without pickle
+
+    Args:
+        path (Path): The state file.
+        state (LlamaState): The state.
+    """
+    with open(path, "wb") as f:
+        np.savez(
+            f,
+            input_ids=state.input_ids,
+            scores=state.scores,
+            llama_state=np.frombuffer(state.llama_state, dtype=np.uint8),
+            counts=np.array([state.n_tokens, state.llama_state_size, state.seed]),
+        )
+
+
+def load_state(path: Path) -> LlamaState:
+    """
+    Read a state written by `save_state`
+
+    Args:
+        path (Path): The state file.
+
+    Returns:
+        LlamaState: The state.
+    """
+    with np.load(path, allow_pickle=False) as data:
+        n_tokens, size, seed = (int(n) for n in data["counts"])
+        return LlamaState(
+            input_ids=data["input_ids"],
+            scores=data["scores"],
+            n_tokens=n_tokens,
+            llama_state=data["llama_state"].tobytes(),
+            llama_state_size=size,
+            seed=seed,
+        )
+
+
+def common_prefix_len(llm: Llama, tokens: Sequence[int]) -> int:
+    """
+    Count the prompt tokens already evaluated in the model state
+
+    Args:
+        llm (Llama): The model.
+        tokens (Sequence[int]): The prompt tokens.
+
+    Returns:
+        int: The number of tokens that the model will reuse, at most all the
+            prompt tokens but the last one.
+    """
+    n = 0
+    for a, b in zip(llm.input_ids, tokens[:-1]):
+        if a != b:
+            break
+        n += 1
+    return n
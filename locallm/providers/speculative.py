@@ -0,0 +1,151 @@
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+import numpy.typing as npt
+from llama_cpp import Llama, llama_cpp
+from llama_cpp.llama_speculative import LlamaDraftModel, LlamaPromptLookupDecoding
+
+# the draft model name that drafts the tokens from the n-grams of the prompt
+# instead of a model
+PROMPT_LOOKUP = "prompt_lookup"
+
+# the default number of drafted tokens per step
+DEFAULT_DRAFT_TOKENS = 8
+
+
+class DraftLlama(LlamaDraftModel):
+    """
+    Draft the next tokens greedily with a small model that shares the vocabulary
+    of the main model. The draft model keeps its evaluated tokens from one step
+    to the next and only evaluates the new ones.
+
+    Args:
+        llm (Llama): The draft model.
+        num_pred_tokens (int, optional): The number of tokens to draft per step.
+            Defaults to DEFAULT_DRAFT_TOKENS.
+    """
+
+    def __init__(self, llm: Llama, num_pred_tokens: int = DEFAULT_DRAFT_TOKENS):
+        self.llm = llm
+        self.num_pred_tokens = num_pred_tokens
+
+    def __call__(
+        self, input_ids: npt.NDArray[np.intc], /, **kwargs: Any
+    ) -> npt.NDArray[np.intc]:
+        llm = self.llm
+        n_ctx = llm.n_ctx()
+        if len(input_ids) + self.num_pred_tokens > n_ctx:
+            return np.array([], dtype=np.intc)
+        # reuse the evaluated prefix, but evaluate at least the last token to
+        # get its logits
+        size = min(llm.n_tokens, len(input_ids) - 1)
+        diff = np.nonzero(llm.input_ids[:size] != input_ids[:size])[0]
+        llm.n_tokens = int(diff[0]) if len(diff) > 0 else size
+        llm.eval(input_ids[llm.n_tokens:].tolist())
+        n_vocab = llm.n_vocab()
+        eos = llm.token_eos()
+        draft = []
+        for i in range(self.num_pred_tokens):
+            logits = np.ctypeslib.as_array(
+                llama_cpp.llama_get_logits_ith(llm.ctx, -1), shape=(n_vocab,)
+            )
+            token = int(np.argmax(logits))
+            draft.append(token)
+            if token == eos or i == self.num_pred_tokens - 1:
+                break
+            llm.eval([token])
+        return np.array(draft, dtype=np.intc)
+
+
+class SpeculativeDraft(LlamaDraftModel):
+    """
+    Count the drafted tokens that the main model accepts. llama.cpp evaluates
+    the drafted tokens in a batch with the main model and keeps them up to the
+    first token that the main model samples differently: the next call shows
+    which tokens of the previous draft were kept.
+
+    Args:
+        draft (LlamaDraftModel): The draft model.
+
+    Attributes:
+        proposed (int): The number of drafted tokens checked by the main model
+            since the last reset.
+        accepted (int): The number of drafted tokens accepted.
+    """
+
+    proposed: int = 0
+    accepted: int = 0
+
+    def __init__(self, draft: LlamaDraftModel) -> None:
+        self.draft = draft
+        self._pending: Optional[Tuple[int, npt.NDArray[np.intc]]] = None
+
+    def __call__(
+        self, input_ids: npt.NDArray[np.intc], /, **kwargs: Any
+    ) -> npt.NDArray[np.intc]:
+        if self._pending is not None:
+            start, previous = self._pending
+            kept = input_ids[start: start + len(previous)]
+            diff = np.nonzero(kept != previous[: len(kept)])[0]
+            self.proposed += len(previous)
+            self.accepted += int(diff[0]) if len(diff) > 0 else len(kept)
+        draft = self.draft(input_ids, **kwargs)
+        self._pending = (len(input_ids), draft) if len(draft) > 0 else None
+        return draft
+
+    def reset(self):
+        """Reset the counters before a generation"""
+        self.proposed = 0
+        self.accepted = 0
+        self._pending = None
+
+    def close(self):
+        """Free the draft model, if any"""
+        llm = getattr(self.draft, "llm", None)
+        if llm is not None:
+            llm.close()
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get the counters of the last generation
+
+        Returns:
+            Dict[str, Any]: The drafted and accepted tokens and the acceptance
+                rate.
+        """
+        rate = self.accepted / self.proposed if self.proposed > 0 else 0.0
+        return {
+            "draft_tokens": self.proposed,
+            "accepted_draft_tokens": self.accepted,
+            "draft_acceptance_rate": rate,
+        }
+
+
+def make_draft(
+    draft_model: str,
+    model_path: str,
+    ctx: int,
+    num_pred_tokens: int = DEFAULT_DRAFT_TOKENS,
+    params: Optional[Dict[str, Any]] = None,
+) -> SpeculativeDraft:
+    """
+    Create the draft of a speculative decoding
+
+    Args:
+        draft_model (str): The draft model name, or `prompt_lookup`.
+        model_path (str): The path of the draft model file.
+        ctx (int): The context window size of the draft model.
+        num_pred_tokens (int, optional): The number of tokens to draft per step.
+            Defaults to DEFAULT_DRAFT_TOKENS.
+        params (Optional[Dict[str, Any]], optional): The other params of the
+            draft model, like `n_threads`. Defaults to None.
+
+    Returns:
+        SpeculativeDraft: The counting draft model.
+    """
+    if draft_model == PROMPT_LOOKUP:
+        return SpeculativeDraft(
+            LlamaPromptLookupDecoding(num_pred_tokens=num_pred_tokens)
+        )
+    llm = Llama(model_path=model_path, n_ctx=ctx, **(params or {}))
+    return SpeculativeDraft(DraftLlama(llm, num_pred_tokens))
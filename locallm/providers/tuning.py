@@ -0,0 +1,228 @@
+import json
+import os
+import socket
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from llama_cpp import Llama, llama_cpp
+
+# the tuned profiles, by host and model
+DEFAULT_PROFILES_FILE = "~/.cache/locallm/profiles.json"
+
+# the kv cache types accepted by the type_k and type_v params
+KV_CACHE_TYPES = {
+    "f32": llama_cpp.GGML_TYPE_F32,
+    "f16": llama_cpp.GGML_TYPE_F16,
+    "q8_0": llama_cpp.GGML_TYPE_Q8_0,
+    "q5_1": llama_cpp.GGML_TYPE_Q5_1,
+    "q5_0": llama_cpp.GGML_TYPE_Q5_0,
+    "q4_1": llama_cpp.GGML_TYPE_Q4_1,
+    "q4_0": llama_cpp.GGML_TYPE_Q4_0,
+}
+
+# the profile keys applied to the model params
+PROFILE_PARAMS = ["threads", "threads_batch", "n_batch"]
+
+
+def kv_cache_type(name: str) -> int:
+    """
+    Get the ggml type of a kv cache type name
+
+    Args:
+        name (str): The type name, like `f16` or `q8_0`.
+
+    Raises:
+        ValueError: If the type is unknown.
+
+    Returns:
+        int: The ggml type.
+    """
+    if name not in KV_CACHE_TYPES:
+        raise ValueError(
+            f"Unknown kv cache type {name}: use one of {', '.join(KV_CACHE_TYPES)}"
+        )
+    return KV_CACHE_TYPES[name]
+
+
+def profile_key(model_name: str) -> str:
+    # the best settings depend on the machine and on the model
+    return f"{socket.gethostname()}:{model_name}"
+
+
+def load_profile(model_name: str, path: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Get the tuned profile of a model on this host
+
+    Args:
+        model_name (str): The model file name.
+        path (Optional[str], optional): The profiles file. Defaults to None: the
+            default file.
+
+    Returns:
+        Dict[str, Any]: The profile, empty if the model was not tuned.
+    """
+    file = Path(path or DEFAULT_PROFILES_FILE).expanduser()
+    if not file.exists():
+        return {}
+    try:
+        profiles = json.loads(file.read_text())
+    except ValueError:
+        return {}
+    return profiles.get(profile_key(model_name), {})
+
+
+def save_profile(model_name: str, profile: Dict[str, Any], path: Optional[str] = None):
+    """
+    Save the tuned profile of a model on this host
+
+    Args:
+        model_name (str): The model file name.
+        profile (Dict[str, Any]): The profile.
+        path (Optional[str], optional): The profiles file. Defaults to None: the
+            default file.
+    """
+    file = Path(path or DEFAULT_PROFILES_FILE).expanduser()
+    profiles = {}
+    if file.exists():
+        try:
+            profiles = json.loads(file.read_text())
+        except ValueError:
+            pass
+    profiles[profile_key(model_name)] = profile
+    file.parent.mkdir(parents=True, exist_ok=True)
+    # write the whole file at once for the concurrent readers
+    tmp = file.with_suffix(".tmp")
+    tmp.write_text(json.dumps(profiles, indent=2))
+    os.replace(tmp, file)
+
+
+def default_threads() -> List[int]:
+    # the powers of two up to the number of cores, and the number of cores
+    cores = os.cpu_count() or 1
+    res = [1]
+    while res[-1] * 2 < cores:
+        res.append(res[-1] * 2)
+    if res[-1] != cores:
+        res.append(cores)
+    return res
+
+
+def _eval_speed(llm: Llama, tokens: List[int], one_by_one: bool) -> float:
+    # the evaluation speed in tokens per second, from an empty context
+    llm.reset()
+    start = time.perf_counter()
+    if one_by_one:
+        llm.eval(tokens[:1])
+        start = time.perf_counter()
+        for token in tokens[1:]:
+            llm.eval([token])
+        return (len(tokens) - 1) / (time.perf_counter() - start)
+    llm.eval(tokens)
+    return len(tokens) / (time.perf_counter() - start)
+
+
+def autotune(
+    model_path: str,
+    ctx: int = 2048,
+    threads: Optional[List[int]] = None,
+    batches: Optional[List[int]] = None,
+    prompt_tokens: int = 512,
+    generated_tokens: int = 64,
+    runs: int = 3,
+    params: Optional[Dict[str, Any]] = None,
+    on_result: Optional[Any] = None,
+) -> Dict[str, Any]:
+    """
+    Measure the prompt evaluation and the generation speeds of a model on this
+    machine across the threads and batch sizes, and return the best settings
+
+    Args:
+        model_path (str): The model file path.
+        ctx (int, optional): The context window size. Defaults to 2048.
+        threads (Optional[List[int]], optional): The thread counts to try.
+            Defaults to None: the powers of two up to the number of cores.
+        batches (Optional[List[int]], optional): The batch sizes to try. Defaults
+            to None: 128, 256, 512 and 1024, or the context size if it is
+            smaller.
+        prompt_tokens (int, optional): The number of prompt tokens evaluated.
+            Defaults to 512.
+        generated_tokens (int, optional): The number of tokens evaluated one by
+            one, like in a generation. Defaults to 64.
+        runs (int, optional): The runs per setting, the best one is kept.
+            Defaults to 3.
+        params (Optional[Dict[str, Any]], optional): The other model params, like
+            `n_gpu_layers` or `type_k`. Defaults to None.
+        on_result (Optional[Any], optional): A function called with the result of
+            each setting. Defaults to None.
+
+    Raises:
+        ValueError: If no batch size fits in the context, or if the context
+            can not hold a prompt and the generated tokens.
+
+    Returns:
+        Dict[str, Any]: The profile: `threads`, `threads_batch`, `n_batch` and
+            the measured speeds.
+    """
+    threads = threads or default_threads()
+    if batches is None:
+        # the default sizes that fit in the context, or the context size
+        batches = [b for b in [128, 256, 512, 1024] if b <= ctx] or [ctx]
+    else:
+        batches = [b for b in batches if b <= ctx]
+        if len(batches) == 0:
+            raise ValueError(f"No batch size is smaller than the context size {ctx}")
+    prompt_tokens = min(prompt_tokens, ctx - generated_tokens - 1)
+    if prompt_tokens <= 0 or generated_tokens <= 0:
+        raise ValueError(
+            f"The context size {ctx} is too small to generate {generated_tokens} "
+            "tokens after a prompt"
+        )
+    best_prompt = (0.0, threads[0], batches[0])
+    best_generation = (0.0, threads[0])
+    for n_batch in batches:
+        llm = Llama(
+            model_path=model_path,
+            n_ctx=ctx,
+            n_batch=n_batch,
+            n_ubatch=n_batch,
+            verbose=False,
+            **(params or {}),
+        )
+        # the tokens values do not matter for the speed
+        tokens = [llm.token_bos()] + [
+            i % llm.n_vocab() for i in range(3, prompt_tokens + 2)
+        ]
+        for n_threads in threads:
+            llm._ctx.set_n_threads(n_threads, n_threads)
+            prompt_speed = max(
+                _eval_speed(llm, tokens, False) for _ in range(runs)
+            )
+            if prompt_speed > best_prompt[0]:
+                best_prompt = (prompt_speed, n_threads, n_batch)
+            result = {
+                "n_batch": n_batch,
+                "threads": n_threads,
+                "prompt_tokens_per_second": prompt_speed,
+            }
+            # the generation evaluates one token at a time: the batch size does
+            # not matter
+            if n_batch == batches[0]:
+                generation_speed = max(
+                    _eval_speed(llm, tokens[: generated_tokens + 1], True)
+                    for _ in range(runs)
+                )
+                if generation_speed > best_generation[0]:
+                    best_generation = (generation_speed, n_threads)
+                result["generation_tokens_per_second"] = generation_speed
+            if on_result is not None:
+                on_result(result)
+        del llm
+    return {
+        "threads": best_generation[1],
+        "threads_batch": best_prompt[1],
+        "n_batch": best_prompt[2],
+        "prompt_tokens_per_second": best_prompt[0],
+        "generation_tokens_per_second": best_generation[0],
+        "tuned_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
@@ -0,0 +1,443 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Deque,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+)
+
+from .cancel import CancelHandle, GenerationStream
+from .provider import LmProvider
+from .schemas import InferenceParams, InferenceResult
+
+DEFAULT_PRIORITIES = ("interactive", "batch")
+
+# the number of wait times kept per priority class for the percentiles
+WAIT_SAMPLES = 1000
+
+
+class DeadlineExceeded(Exception):
+    """The query could not be dispatched before its deadline"""
+
+    pass
+
+
+class _Ticket:
+    # a query waiting for a slot
+    def __init__(
+        self, priority: str, tenant: str, deadline: Optional[float], wake: Callable
+    ) -> None:
+        self.priority = priority
+        self.tenant = tenant
+        self.deadline = deadline
+        self.enqueued = time.monotonic()
+        self.dispatched = False
+        self.dropped = False
+        self.wake = wake
+
+
+class Scheduler:
+    """
+    Dispatch the queries to a provider with a limit of queries in flight. The
+    waiting queries are served by priority class, and in round robin between the
+    tenants of a class. A query with a deadline is dropped if it can not be
+    dispatched in time.
+
+    Args:
+        lm (LmProvider): The provider.
+        max_in_flight (Optional[int], optional): The maximum number of queries
+            running at once on the backend. Defaults to None: the provider's batch
+            concurrency or 1.
+        priorities (Sequence[str], optional): The priority classes, from the most
+            urgent. Defaults to ("interactive", "batch").
+        limits (Optional[Dict[str, int]], optional): The maximum number of queries
+            in flight per priority class, to keep some slots for the urgent
+            classes. Defaults to None.
+
+    Example:
+        >>> lm = KoboldcppLm(LmParams(server_url="http://localhost:5001"))
+        >>> scheduler = Scheduler(lm, max_in_flight=4, limits={"batch": 3})
+        >>> scheduler.infer("Hello", priority="interactive", tenant="alice",
+            deadline=2.0)
+        >>> print(scheduler.stats)
+    """
+
+    lm: LmProvider
+    max_in_flight: int
+    priorities: List[str]
+    limits: Dict[str, int]
+    in_flight: int = 0
+
+    def __init__(
+        self,
+        lm: LmProvider,
+        max_in_flight: Optional[int] = None,
+        priorities: Sequence[str] = DEFAULT_PRIORITIES,
+        limits: Optional[Dict[str, int]] = None,
+    ) -> None:
+        self.lm = lm
+        self.max_in_flight = max_in_flight or lm.max_batch_concurrency or 1
+        self.priorities = list(priorities)
+        self.limits = limits or {}
+        self._lock = threading.Lock()
+        # priority -> tenant -> waiting tickets, the tenants in round robin order
+        self._queues: Dict[str, OrderedDict[str, Deque[_Ticket]]] = {
+            p: OrderedDict() for p in self.priorities
+        }
+        self._running: Dict[str, int] = {p: 0 for p in self.priorities}
+        self._waits: Dict[str, Deque[float]] = {
+            p: deque(maxlen=WAIT_SAMPLES) for p in self.priorities
+        }
+        self._counters: Dict[str, Dict[str, int]] = {
+            p: {"dispatched": 0, "dropped": 0, "max_depth": 0} for p in self.priorities
+        }
+
+    def infer(
+        self,
+        prompt: str,
+        params: InferenceParams = InferenceParams(),
+        priority: Optional[str] = None,
+        tenant: str = "default",
+        deadline: Optional[float] = None,
+        handle: Optional[CancelHandle] = None,
+    ) -> InferenceResult:
+        """
+        Wait for a slot and run an inference query
+
+        Args:
+            prompt (str): The prompt to use for the inference.
+            params (InferenceParams, optional): The inference parameters. Defaults to
+                InferenceParams().
+            priority (Optional[str], optional): The priority class. Defaults to
+                None: the most urgent class.
+            tenant (str, optional): The tenant of the query. Defaults to "default".
+            deadline (Optional[float], optional): The maximum time to wait for a
+                slot in seconds. Defaults to None: no limit.
+            handle (Optional[CancelHandle], optional): A handle to cancel the
+                query. Defaults to None.
+
+        Returns:
+            InferenceResult: The result of the inference.
+
+        Raises:
+            DeadlineExceeded: If the query could not start before its deadline.
+        """
+        ticket = self._acquire(priority, tenant, deadline)
+        try:
+            return self.lm.infer(prompt, params, handle)
+        finally:
+            self._release(ticket)
+
+    def generate(
+        self,
+        prompt: str,
+        params: InferenceParams = InferenceParams(),
+        priority: Optional[str] = None,
+        tenant: str = "default",
+        deadline: Optional[float] = None,
+        handle: Optional[CancelHandle] = None,
+        raw: bool = False,
+    ) -> GenerationStream[Any]:
+        """
+        Wait for a slot and run an inference query as a stream. The slot is held
+        until the stream is consumed or closed
+
+        Args:
+            prompt (str): The prompt to use for the inference.
+            params (InferenceParams, optional): The inference parameters. Defaults to
+                InferenceParams().
+            priority (Optional[str], optional): The priority class. Defaults to
+                None: the most urgent class.
+            tenant (str, optional): The tenant of the query. Defaults to "default".
+            deadline (Optional[float], optional): The maximum time to wait for a
+                slot in seconds. Defaults to None: no limit.
+            handle (Optional[CancelHandle], optional): A handle to cancel the
+                query. Defaults to None.
+            raw (bool, optional): Iterate over the token texts only. Defaults to
+                False.
+
+        Returns:
+            GenerationStream[Any]: The stream iterator of the provider.
+
+        Raises:
+            DeadlineExceeded: If the query could not start before its deadline.
+        """
+        ticket = self._acquire(priority, tenant, deadline)
+        try:
+            stream = self.lm.generate(prompt, params, handle, raw)
+        except Exception:
+            self._release(ticket)
+            raise
+
+        def close():
+            stream.close()
+            self._release(ticket)
+
+        return GenerationStream(stream, stream.handle, close)
+
+    async def ainfer(
+        self,
+        prompt: str,
+        params: InferenceParams = InferenceParams(),
+        priority: Optional[str] = None,
+        tenant: str = "default",
+        deadline: Optional[float] = None,
+        handle: Optional[CancelHandle] = None,
+    ) -> InferenceResult:
+        """
+        Wait for a slot and run an inference query without blocking the event loop
+
+        Args:
+            prompt (str): The prompt to use for the inference.
+            params (InferenceParams, optional): The inference parameters. Defaults to
+                InferenceParams().
+            priority (Optional[str], optional): The priority class. Defaults to
+                None: the most urgent class.
+            tenant (str, optional): The tenant of the query. Defaults to "default".
+            deadline (Optional[float], optional): The maximum time to wait for a
+                slot in seconds. Defaults to None: no limit.
+            handle (Optional[CancelHandle], optional): A handle to cancel the
+                query. Defaults to None.
+
+        Returns:
+            InferenceResult: The result of the inference.
+
+        Raises:
+            DeadlineExceeded: If the query could not start before its deadline.
+        """
+        ticket = await self._aacquire(priority, tenant, deadline)
+        try:
+            return await self.lm.ainfer(prompt, params, handle)
+        finally:
+            self._release(ticket)
+
+    async def agenerate(
+        self,
+        prompt: str,
+        params: InferenceParams = InferenceParams(),
+        priority: Optional[str] = None,
+        tenant: str = "default",
+        deadline: Optional[float] = None,
+        handle: Optional[CancelHandle] = None,
+    ) -> AsyncIterator[str]:
+        """
+        Wait for a slot and iterate over the generated tokens without blocking
+        the event loop. The slot is held until the iteration ends
+
+        Args:
+            prompt (str): The prompt to use for the inference.
+            params (InferenceParams, optional): The inference parameters. Defaults to
+                InferenceParams().
+            priority (Optional[str], optional): The priority class. Defaults to
+                None: the most urgent class.
+            tenant (str, optional): The tenant of the query. Defaults to "default".
+            deadline (Optional[float], optional): The maximum time to wait for a
+                slot in seconds. Defaults to None: no limit.
+            handle (Optional[CancelHandle], optional): A handle to cancel the
+                query. Defaults to None.
+
+        Returns:
+            AsyncIterator[str]: The generated tokens
+
+        Raises:
+            DeadlineExceeded: If the query could not start before its deadline.
+        """
+        ticket = await self._aacquire(priority, tenant, deadline)
+        tokens = self.lm.agenerate(prompt, params, handle)
+        try:
+            async for token in tokens:
+                yield token
+        finally:
+            await tokens.aclose()  # type: ignore
+            self._release(ticket)
+
+    def infer_many(
+        self,
+        prompts: Sequence[str],
+        params: InferenceParams = InferenceParams(),
+        priority: Optional[str] = None,
+        tenant: str = "default",
+    ) -> List[InferenceResult]:
+        """
+        Run a batch of inference queries through the scheduler. The tokens are
+        not emitted
+
+        Args:
+            prompts (Sequence[str]): The prompts.
+            params (InferenceParams, optional): The inference parameters. Defaults to
+                InferenceParams().
+            priority (Optional[str], optional): The priority class. Defaults to
+                None: the least urgent class.
+            tenant (str, optional): The tenant of the queries. Defaults to
+                "default".
+
+        Returns:
+            List[InferenceResult]: The results, in the order of the prompts.
+        """
+        priority = priority or self.priorities[-1]
+
+        def run(prompt: str) -> InferenceResult:
+            ticket = self._acquire(priority, tenant, None)
+            try:
+                return self.lm._run_infer(prompt, params, emit=False)
+            finally:
+                self._release(ticket)
+
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+            return list(executor.map(run, prompts))
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        """The queries in flight, and per priority class the queue depth, the
+        dispatched and dropped counters and the wait time percentiles"""
+        with self._lock:
+            classes = {}
+            for p in self.priorities:
+                waits = sorted(self._waits[p])
+                classes[p] = {
+                    "queue_depth": sum(len(q) for q in self._queues[p].values()),
+                    "in_flight": self._running[p],
+                    **self._counters[p],
+                    "wait_p50": _percentile(waits, 0.5),
+                    "wait_p99": _percentile(waits, 0.99),
+                    "wait_max": waits[-1] if waits else 0.0,
+                }
+            return {"in_flight": self.in_flight, "classes": classes}
+
+    def _acquire(
+        self, priority: Optional[str], tenant: str, deadline: Optional[float]
+    ) -> _Ticket:
+        event = threading.Event()
+        ticket = self._enqueue(priority, tenant, deadline, event.set)
+        timeout = None
+        if deadline is not None:
+            timeout = max(ticket.deadline - time.monotonic(), 0)  # type: ignore
+        event.wait(timeout)
+        return self._check(ticket)
+
+    async def _aacquire(
+        self, priority: Optional[str], tenant: str, deadline: Optional[float]
+    ) -> _Ticket:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(_set_result, future)
+
+        ticket = self._enqueue(priority, tenant, deadline, wake)
+        timeout = None
+        if deadline is not None:
+            timeout = max(ticket.deadline - time.monotonic(), 0)  # type: ignore
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            with self._lock:
+                if not ticket.dispatched:
+                    self._remove(ticket)
+                    raise
+            self._release(ticket)
+            raise
+        return self._check(ticket)
+
+    def _enqueue(
+        self,
+        priority: Optional[str],
+        tenant: str,
+        deadline: Optional[float],
+        wake: Callable,
+    ) -> _Ticket:
+        priority = priority or self.priorities[0]
+        if priority not in self._queues:
+            raise ValueError(f"Unknown priority class {priority}")
+        end = time.monotonic() + deadline if deadline is not None else None
+        ticket = _Ticket(priority, tenant, end, wake)
+        with self._lock:
+            tenants = self._queues[priority]
+            tenants.setdefault(tenant, deque()).append(ticket)
+            depth = sum(len(q) for q in tenants.values())
+            counters = self._counters[priority]
+            counters["max_depth"] = max(counters["max_depth"], depth)
+            self._dispatch()
+        return ticket
+
+    def _check(self, ticket: _Ticket) -> _Ticket:
+        with self._lock:
+            if ticket.dispatched:
+                return ticket
+            if not ticket.dropped:
+                # the deadline expired while waiting
+                self._remove(ticket)
+                ticket.dropped = True
+                self._counters[ticket.priority]["dropped"] += 1
+        raise DeadlineExceeded("The query could not be dispatched before its deadline")
+
+    def _release(self, ticket: _Ticket):
+        with self._lock:
+            self.in_flight -= 1
+            self._running[ticket.priority] -= 1
+            self._dispatch()
+
+    def _remove(self, ticket: _Ticket):
+        tenants = self._queues[ticket.priority]
+        queue = tenants.get(ticket.tenant)
+        if queue is not None and ticket in queue:
+            queue.remove(ticket)
+            if len(queue) == 0:
+                del tenants[ticket.tenant]
+
+    def _dispatch(self):
+        # give the free slots to the waiting queries: called with the lock held
+        now = time.monotonic()
+        while self.in_flight < self.max_in_flight:
+            ticket = self._next(now)
+            if ticket is None:
+                return
+            if ticket.deadline is not None and now > ticket.deadline:
+                ticket.dropped = True
+                self._counters[ticket.priority]["dropped"] += 1
+                ticket.wake()
+                continue
+            ticket.dispatched = True
+            self.in_flight += 1
+            self._running[ticket.priority] += 1
+            self._counters[ticket.priority]["dispatched"] += 1
+            self._waits[ticket.priority].append(now - ticket.enqueued)
+            ticket.wake()
+
+    def _next(self, now: float) -> Optional[_Ticket]:
+        for priority in self.priorities:
+            limit = self.limits.get(priority)
+            if limit is not None and self._running[priority] >= limit:
+                continue
+            tenants = self._queues[priority]
+            if len(tenants) == 0:
+                continue
+            # round robin: serve the first tenant and move it to the end
+            tenant, queue = next(iter(tenants.items()))
+            ticket = queue.popleft()
+            del tenants[tenant]
+            if len(queue) > 0:
+                tenants[tenant] = queue
+            return ticket
+        return None
+
+
+def _set_result(future: asyncio.Future):
+    if not future.done():
+        future.set_result(True)
+
+
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(int(len(values) * q), len(values) - 1)]
@@ -2,12 +2,20 @@ from typing import Any, Callable, Dict, List, Literal, Optional, TypedDict
 from pydantic import BaseModel
 
 
-LmProviderType = Literal["local", "koboldcpp", "ollama"]
+LmProviderType = Literal["local", "koboldcpp", "ollama", "balanced", "local_pool"]
+
+BalanceStrategyType = Literal["least_outstanding", "ewma"]
+
+CachePolicyType = Literal["deterministic", "always", "never"]
+
+TruncateType = Literal["error", "head", "tail", "middle"]
 
 OnTokenType = Callable[[str], None]
 
 OnStartEmitType = Callable[[Optional[Any]], None]
 
+OnResultType = Callable[[int, "InferenceResult"], None]
+
 
 class InferenceParams(BaseModel):
     """
@@ -18,7 +26,10 @@ class InferenceParams(BaseModel):
         stream (Optional[bool], optional): Whether to use streaming inference or batch
             inference. Defaults to `None`.
         template (Optional[str], optional): A template string to be used as input to
-            the model. Defaults to `None`.
+            the model, with a `{prompt}` slot and optionally other named slots.
+            Defaults to `None`.
+        variables (Optional[Dict[str, str]], optional): The values of the other
+            named slots of the template, like `{system}`. Defaults to `None`.
         threads (Optional[int], optional): The number of threads to use during
             inference. Defaults to `None`.
         max_tokens (Optional[int], optional): The maximum number of tokens to generate.
@@ -34,6 +45,10 @@ class InferenceParams(BaseModel):
             Defaults to `None`.
         stop (Optional[List[str]], optional): A list of words to stop the model from
             generating. Defaults to `None`.
+        stop_regex (Optional[List[str]], optional): A list of regular expressions
+            to stop the model from generating. Defaults to `None`.
+        max_time (Optional[float], optional): Stop the generation after this
+            number of seconds. Defaults to `None`.
         frequency_penalty (Optional[float], optional): The frequency penalty for rare
             words. Defaults to `None`.
         presence_penalty (Optional[float], optional): The presence penalty for rare
@@ -43,6 +58,14 @@ class InferenceParams(BaseModel):
         tfs (Optional[float], optional): The temperature factor for top-k sampling.
             Defaults to `None`.
         grammar (Optional[str]): a gbnf grammar. Defaults to `None`.
+        json_schema (Optional[Dict[str, Any]]): A JSON Schema that the output must
+            follow. The output is checked as it is generated. Defaults to `None`.
+        model (Optional[str]): The model to run the query with, instead of the
+            loaded model. Defaults to `None`.
+        truncate (Optional[TruncateType]): Check that the prompt fits in the
+            context window with the max tokens before sending it: `error` rejects
+            a long prompt, `head`, `tail` and `middle` remove this part of the
+            prompt. Defaults to `None`: no check.
 
     Returns:
         None
@@ -55,6 +78,7 @@ class InferenceParams(BaseModel):
 
     stream: Optional[bool] = None
     template: Optional[str] = None
+    variables: Optional[Dict[str, str]] = None
     threads: Optional[int] = None
     max_tokens: Optional[int] = None
     temperature: Optional[float] = None
@@ -62,11 +86,36 @@ class InferenceParams(BaseModel):
     top_p: Optional[float] = None
     min_p: Optional[float] = None
     stop: Optional[List[str]] = None
+    stop_regex: Optional[List[str]] = None
+    max_time: Optional[float] = None
     frequency_penalty: Optional[float] = None
     presence_penalty: Optional[float] = None
     repeat_penalty: Optional[float] = None
     tfs: Optional[float] = None
     grammar: Optional[str] = None
+    json_schema: Optional[Dict[str, Any]] = None
+    model: Optional[str] = None
+    truncate: Optional[TruncateType] = None
+
+
+class LmEndpoint(BaseModel):
+    """
+    An inference server for the balanced provider.
+
+    Args:
+        url (str): The server url.
+        ptype (Literal["koboldcpp", "ollama"], optional): The server api. Defaults
+            to `koboldcpp`.
+        weight (float, optional): The relative capacity of the server. Defaults
+            to `1`.
+
+    Example:
+        >>> LmEndpoint(url="http://10.0.0.2:5001", weight=2)
+    """
+
+    url: str
+    ptype: Literal["koboldcpp", "ollama"] = "koboldcpp"
+    weight: float = 1
 
 
 class LmParams(BaseModel):
@@ -93,6 +142,82 @@ class LmParams(BaseModel):
             will output the token to the terminal
         on_start_emit (Optional[OnStartEmitType], optional): A function to call for
             when the model starts emitting. Defaults to None.
+        pool_size (Optional[int], optional): The maximum number of http connections
+            kept open to the server. Defaults to `10`
+        keep_alive (Optional[bool], optional): Reuse the http connections between
+            the requests. Defaults to `True`
+        connect_timeout (Optional[float], optional): The http connection timeout in
+            seconds. Defaults to `None`: no timeout
+        read_timeout (Optional[float], optional): The http read timeout in seconds.
+            Defaults to `None`: no timeout
+        cache (Optional[ResponseCache], optional): The cache for the inference
+            results. Defaults to `None`: an in memory lru cache
+        cache_policy (Optional[CachePolicyType], optional): When to use the cache:
+            `deterministic`, `always` or `never`. Defaults to `deterministic`: only
+            the queries with greedy sampling are cached
+        prefix_cache_bytes (Optional[int], optional): Enable the local provider's
+            cache of the evaluated template prefixes, with this memory limit in
+            bytes. Defaults to `None`: disabled
+        prefix_cache_dir (Optional[str], optional): A directory to persist the
+            evaluated template prefixes of the local provider. Defaults to `None`
+        prefix_cache_disk_bytes (Optional[int], optional): The size limit of the
+            prefixes directory in bytes. Defaults to `None`: no limit
+        max_models (Optional[int], optional): The maximum number of models that the
+            local provider keeps loaded. Defaults to `1`
+        models_memory (Optional[int], optional): The memory budget of the local
+            provider's loaded models in bytes, estimated from the model files.
+            Defaults to `None`: no limit
+        preload_models (Optional[List[str]], optional): The models that the local
+            provider loads at startup, with a 2048 tokens context window. Use the
+            `preload` method for other sizes. Defaults to `None`
+        token_batch_size (Optional[int], optional): Pass the tokens to `on_token`
+            by batches of this size. Defaults to `None`: one call per token
+        token_batch_ms (Optional[float], optional): Pass the tokens to `on_token`
+            at most every n milliseconds. Defaults to `None`
+        endpoints (Optional[List[LmEndpoint]], optional): The servers of the
+            balanced provider. Defaults to `None`
+        balance_strategy (Optional[BalanceStrategyType], optional): How the
+            balanced provider picks a server: `least_outstanding` or `ewma`.
+            Defaults to `least_outstanding`
+        health_interval (Optional[float], optional): The interval of the balanced
+            provider's health checks in seconds. Defaults to `None`: no background
+            checks
+        eject_time (Optional[float], optional): How long the balanced provider
+            ejects a failing server, in seconds. Defaults to `30`
+        embedding_batch_size (Optional[int], optional): The number of texts per
+            embeddings request. Defaults to `32`
+        embedding_cache_items (Optional[int], optional): The maximum number of
+            embeddings in the cache, `0` to disable it. Defaults to `65536`
+        draft_model (Optional[str], optional): Enable the local provider's
+            speculative decoding with this draft model file from `models_dir`, or
+            `prompt_lookup` to draft from the prompt n-grams. The draft model must
+            share the vocabulary of the main model. Defaults to `None`: disabled
+        draft_tokens (Optional[int], optional): The number of tokens drafted per
+            step of the speculative decoding. Defaults to `8`
+        workers (Optional[int], optional): The number of worker processes of the
+            local pool provider. The `threads` are split between them. Defaults
+            to `2`
+        n_batch (Optional[int], optional): The local provider's prompt evaluation
+            batch size. Defaults to `None`: 512, or the tuned profile
+        threads_batch (Optional[int], optional): The number of threads of the
+            local provider's prompt evaluation. Defaults to `None`: the `threads`,
+            or the tuned profile
+        use_mmap (Optional[bool], optional): Map the model file in memory rather
+            than reading it. Defaults to `None`: enabled
+        use_mlock (Optional[bool], optional): Lock the model in memory to avoid
+            swapping. Defaults to `None`: disabled
+        type_k (Optional[str], optional): The type of the local provider's key
+            cache: `f16`, `q8_0`, `q4_0`... Defaults to `None`: `f16`
+        type_v (Optional[str], optional): The type of the value cache. The
+            quantized types enable the flash attention. Defaults to `None`: `f16`
+        profiles_file (Optional[str], optional): The file of the profiles saved
+            by the autotune command, applied to the settings not set in the
+            params. Defaults to `None`: `~/.cache/locallm/profiles.json`
+        server_stats (Optional[bool], optional): Ask the Koboldcpp server for the
+            timings of each query, with one more request per query. The server
+            only reports its last generation: with concurrent queries the
+            numbers may belong to another query. Defaults to `None`: the timings
+            are measured on the client side
 
     Example:
         >>> lm_params = LmParams(models_dir="/path/to/models", api_key="my_api_key")
@@ -107,6 +232,89 @@ class LmParams(BaseModel):
     embedding: Optional[bool] = None
     on_token: Optional[OnTokenType] = None
     on_start_emit: Optional[OnStartEmitType] = None
+    pool_size: Optional[int] = None
+    keep_alive: Optional[bool] = None
+    connect_timeout: Optional[float] = None
+    read_timeout: Optional[float] = None
+    cache: Optional[Any] = None
+    cache_policy: Optional[CachePolicyType] = None
+    prefix_cache_bytes: Optional[int] = None
+    prefix_cache_dir: Optional[str] = None
+    prefix_cache_disk_bytes: Optional[int] = None
+    max_models: Optional[int] = None
+    models_memory: Optional[int] = None
+    preload_models: Optional[List[str]] = None
+    token_batch_size: Optional[int] = None
+    token_batch_ms: Optional[float] = None
+    endpoints: Optional[List[LmEndpoint]] = None
+    balance_strategy: Optional[BalanceStrategyType] = None
+    health_interval: Optional[float] = None
+    eject_time: Optional[float] = None
+    embedding_batch_size: Optional[int] = None
+    embedding_cache_items: Optional[int] = None
+    draft_model: Optional[str] = None
+    draft_tokens: Optional[int] = None
+    workers: Optional[int] = None
+    n_batch: Optional[int] = None
+    threads_batch: Optional[int] = None
+    use_mmap: Optional[bool] = None
+    use_mlock: Optional[bool] = None
+    type_k: Optional[str] = None
+    type_v: Optional[str] = None
+    profiles_file: Optional[str] = None
+    server_stats: Optional[bool] = None
+
+
+class InferenceStats(TypedDict, total=False):
+    """
+    The timing and token metrics of an inference query. The providers use the
+    numbers reported by the server when available and measure the others on the
+    client side. The times are in seconds.
+
+    Args:
+        prompt_tokens (int): The number of tokens in the prompt.
+        skipped_prompt_tokens (int): The number of prompt tokens that were not
+            evaluated because they were cached.
+        generated_tokens (int): The number of generated tokens.
+        time_to_first_token (float): The time between the query and the first
+            generated token.
+        total_time (float): The total time of the query.
+        prompt_tokens_per_second (float): The prompt evaluation speed.
+        generation_tokens_per_second (float): The generation speed.
+        network_overhead (float): The time spent outside of the server for the
+            http providers.
+        draft_tokens (int): The number of drafted tokens checked by the model
+            with the speculative decoding.
+        accepted_draft_tokens (int): The number of drafted tokens accepted.
+        draft_acceptance_rate (float): The share of the drafted tokens accepted.
+        timed_out (bool): Set when the `max_time` limit has cut the generation
+            off.
+
+    Example:
+        >>> print(result["stats"])
+        {
+            'prompt_tokens': 25,
+            'generated_tokens': 12,
+            'time_to_first_token': 0.21,
+            'total_time': 0.85,
+            'prompt_tokens_per_second': 119.04,
+            'generation_tokens_per_second': 18.75,
+            'network_overhead': 0.003
+        }
+    """
+
+    prompt_tokens: int
+    skipped_prompt_tokens: int
+    generated_tokens: int
+    time_to_first_token: float
+    total_time: float
+    prompt_tokens_per_second: float
+    generation_tokens_per_second: float
+    network_overhead: float
+    draft_tokens: int
+    accepted_draft_tokens: int
+    draft_acceptance_rate: float
+    timed_out: bool
 
 
 class InferenceResult(TypedDict):
@@ -116,21 +324,20 @@ class InferenceResult(TypedDict):
 
     Args:
         text (str): The input text used for the inference.
-        stats (Dict[str, Any]): A dictionary containing any statistics generated
-            during the inference. These can include things like time taken or total
-            tokens. Note that it depends on the backend used
+        stats (InferenceStats): The timing and token metrics of the inference.
+            The cached results keep the stats of the original query
 
     Example:
         >>> result = InferenceResult(
             text="The quick brown fox jumps over the lazy dog",
-            stats={"total_tokens": 31}
+            stats={"generated_tokens": 11}
         )
         >>> print(result)
         {
             'text': 'The quick brown fox jumps over the lazy dog',
-            'stats': {"total_tokens": 31}
+            'stats': {"generated_tokens": 11}
         }
     """
 
     text: str
-    stats: Dict[str, Any]
+    stats: InferenceStats
@@ -0,0 +1,457 @@
+import asyncio
+import json
+import time
+import uuid
+from typing import Any, Callable, Dict, Optional
+
+from .connection import aclose_sessions
+from .provider import LmProvider
+from .scheduler import DeadlineExceeded, Scheduler
+from .schemas import InferenceParams
+from .templates import ChatFormatType, render_chat
+
+try:
+    import orjson
+
+    def json_dumps(data: Any) -> bytes:
+        return orjson.dumps(data)
+
+except ImportError:
+
+    def json_dumps(data: Any) -> bytes:
+        return json.dumps(data, separators=(",", ":")).encode("utf-8")
+
+
+# the OpenAI request fields passed to the inference params as is
+_PARAMS = (
+    "max_tokens",
+    "temperature",
+    "top_p",
+    "top_k",
+    "min_p",
+    "frequency_penalty",
+    "presence_penalty",
+    "repeat_penalty",
+    "grammar",
+)
+
+
+class ServerMetrics:
+    """
+    The counters of the server, exposed in the Prometheus text format.
+
+    Attributes:
+        requests (Dict[str, int]): The number of requests per endpoint.
+        errors (int): The number of failed requests.
+        rejected (int): The number of requests rejected because the queue was
+            full or the server was shutting down.
+        active (int): The number of requests being served or queued.
+        generated_tokens (int): The number of generated tokens.
+        duration_sum (float): The total duration of the requests in seconds.
+        duration_count (int): The number of served requests.
+        ttft_sum (float): The total time to first token of the streamed
+            requests in seconds.
+        ttft_count (int): The number of streamed requests with a first token.
+    """
+
+    def __init__(self) -> None:
+        self.requests: Dict[str, int] = {}
+        self.errors = 0
+        self.rejected = 0
+        self.active = 0
+        self.generated_tokens = 0
+        self.duration_sum = 0.0
+        self.duration_count = 0
+        self.ttft_sum = 0.0
+        self.ttft_count = 0
+
+    def render(self, scheduler: Scheduler) -> str:
+        """
+        Render the metrics
+
+        Args:
+            scheduler (Scheduler): The scheduler of the server.
+
+        Returns:
+            str: The metrics in the Prometheus text format.
+        """
+        in_flight = scheduler.in_flight
+        lines = ["# TYPE locallm_requests_total counter"]
+        for endpoint, count in sorted(self.requests.items()):
+            lines.append(f'locallm_requests_total{{endpoint="{endpoint}"}} {count}')
+        lines += [
+            "# TYPE locallm_request_errors_total counter",
+            f"locallm_request_errors_total {self.errors}",
+            "# TYPE locallm_requests_rejected_total counter",
+            f"locallm_requests_rejected_total {self.rejected}",
+            "# TYPE locallm_requests_in_flight gauge",
+            f"locallm_requests_in_flight {in_flight}",
+            "# TYPE locallm_requests_queued gauge",
+            f"locallm_requests_queued {max(self.active - in_flight, 0)}",
+            "# TYPE locallm_generated_tokens_total counter",
+            f"locallm_generated_tokens_total {self.generated_tokens}",
+            "# TYPE locallm_request_duration_seconds summary",
+            f"locallm_request_duration_seconds_sum {self.duration_sum}",
+            f"locallm_request_duration_seconds_count {self.duration_count}",
+            "# TYPE locallm_time_to_first_token_seconds summary",
+            f"locallm_time_to_first_token_seconds_sum {self.ttft_sum}",
+            f"locallm_time_to_first_token_seconds_count {self.ttft_count}",
+        ]
+        return "\n".join(lines) + "\n"
+
+
+class ApiError(Exception):
+    """An error returned to the client with its http status"""
+
+    def __init__(self, status: int, message: str, etype: str) -> None:
+        super().__init__(message)
+        self.status = status
+        self.etype = etype
+
+
+class LmServer:
+    """
+    An OpenAI compatible http server on top of a provider, with the
+    `/v1/completions`, `/v1/chat/completions`, `/v1/models` and `/metrics`
+    endpoints. The queries go through a scheduler that limits the number of
+    queries running on the backend: the others wait in its queue. Requires the
+    `aiohttp` package: `pip install locallm[async]`
+
+    Args:
+        lm (LmProvider): The provider, with its model loaded.
+        chat_format (ChatFormatType, optional): The turn format of the model for
+            the chat messages. Defaults to "chatml".
+        max_in_flight (Optional[int], optional): The maximum number of queries
+            running at once on the backend. Defaults to None: the provider's batch
+            concurrency or 1.
+        max_queue (Optional[int], optional): The maximum number of waiting
+            queries: the next ones are rejected with a 429 status. Defaults to
+            None: no limit.
+        model_name (Optional[str], optional): The model name in the responses.
+            Defaults to None: the loaded model.
+
+    Example:
+        >>> lm = OllamaLm(LmParams())
+        >>> lm.load_model("mistral", 4096)
+        >>> LmServer(lm, chat_format="mistral", max_in_flight=2).run(port=8000)
+    """
+
+    lm: LmProvider
+    scheduler: Scheduler
+    metrics: ServerMetrics
+    draining: bool = False
+
+    def __init__(
+        self,
+        lm: LmProvider,
+        chat_format: ChatFormatType = "chatml",
+        max_in_flight: Optional[int] = None,
+        max_queue: Optional[int] = None,
+        model_name: Optional[str] = None,
+    ) -> None:
+        self.lm = lm
+        self.chat_format = chat_format
+        self.scheduler = Scheduler(lm, max_in_flight)
+        self.max_queue = max_queue
+        self.model_name = model_name
+        self.metrics = ServerMetrics()
+
+    def app(self) -> Any:
+        """
+        Build the aiohttp application
+
+        Returns:
+            aiohttp.web.Application: The application.
+        """
+        try:
+            from aiohttp import web
+        except ImportError:
+            raise ImportError(
+                "The server requires the aiohttp package: pip install locallm[async]"
+            )
+        app = web.Application()
+        app.router.add_post("/v1/completions", self._completions)
+        app.router.add_post("/v1/chat/completions", self._chat_completions)
+        app.router.add_get("/v1/models", self._models)
+        app.router.add_get("/metrics", self._metrics)
+        app.on_shutdown.append(self._on_shutdown)
+        app.on_cleanup.append(self._on_cleanup)
+        return app
+
+    def run(
+        self, host: str = "127.0.0.1", port: int = 8000, shutdown_timeout: float = 30
+    ):
+        """
+        Serve until interrupted. On SIGINT or SIGTERM the server stops accepting
+        connections and lets the running queries finish
+
+        Args:
+            host (str, optional): The interface to listen on. Defaults to
+                "127.0.0.1".
+            port (int, optional): The port. Defaults to 8000.
+            shutdown_timeout (float, optional): The time left to the running
+                queries to finish on shutdown, in seconds. Defaults to 30.
+        """
+        from aiohttp import web
+
+        web.run_app(
+            self.app(), host=host, port=port, shutdown_timeout=shutdown_timeout
+        )
+
+    @property
+    def model(self) -> str:
+        return self.model_name or self.lm.loaded_model
+
+    async def _on_shutdown(self, app: Any):
+        # reject the new queries, the running ones are left to finish
+        self.draining = True
+
+    async def _on_cleanup(self, app: Any):
+        await aclose_sessions()
+
+    async def _models(self, request: Any) -> Any:
+        from aiohttp import web
+
+        data = {
+            "object": "list",
+            "data": [{"id": self.model, "object": "model", "owned_by": "locallm"}],
+        }
+        return web.Response(body=json_dumps(data), content_type="application/json")
+
+    async def _metrics(self, request: Any) -> Any:
+        from aiohttp import web
+
+        return web.Response(
+            text=self.metrics.render(self.scheduler),
+            content_type="text/plain",
+            charset="utf-8",
+        )
+
+    async def _completions(self, request: Any) -> Any:
+        def prompt(body: Dict[str, Any]) -> str:
+            value = body.get("prompt", "")
+            if isinstance(value, list):
+                if len(value) != 1:
+                    raise ApiError(400, "Only one prompt is supported", "invalid")
+                value = value[0]
+            if not isinstance(value, str):
+                raise ApiError(400, "The prompt must be a string", "invalid")
+            return value
+
+        return await self._serve(request, "completions", prompt)
+
+    async def _chat_completions(self, request: Any) -> Any:
+        def prompt(body: Dict[str, Any]) -> str:
+            messages = body.get("messages")
+            if not isinstance(messages, list) or len(messages) == 0:
+                raise ApiError(400, "The messages are required", "invalid")
+            try:
+                turns = [
+                    {"role": m["role"], "content": _content(m.get("content"))}
+                    for m in messages
+                ]
+                return render_chat(turns, self.chat_format)
+            except (KeyError, TypeError, ValueError) as e:
+                raise ApiError(400, f"Invalid messages: {e}", "invalid")
+
+        return await self._serve(request, "chat_completions", prompt)
+
+    async def _serve(
+        self,
+        request: Any,
+        endpoint: str,
+        get_prompt: Callable[[Dict[str, Any]], str],
+    ) -> Any:
+        self.metrics.requests[endpoint] = self.metrics.requests.get(endpoint, 0) + 1
+        start = time.perf_counter()
+        self.metrics.active += 1
+        try:
+            if self.draining:
+                self.metrics.rejected += 1
+                raise ApiError(503, "The server is shutting down", "unavailable")
+            queued = self.metrics.active - 1 - self.scheduler.in_flight
+            if self.max_queue is not None and queued >= self.max_queue:
+                self.metrics.rejected += 1
+                raise ApiError(429, "Too many queued requests", "rate_limit")
+            try:
+                body = await request.json()
+            except ValueError:
+                raise ApiError(400, "The body is not valid JSON", "invalid")
+            if not isinstance(body, dict):
+                raise ApiError(400, "The body must be a JSON object", "invalid")
+            prompt = get_prompt(body)
+            params = _params(body)
+            if body.get("stream") is True:
+                return await self._stream(request, endpoint, prompt, params)
+            return await self._complete(endpoint, prompt, params)
+        except ApiError as e:
+            if e.status >= 500 and e.status != 503:
+                self.metrics.errors += 1
+            return _error_response(e.status, str(e), e.etype)
+        except DeadlineExceeded as e:
+            self.metrics.rejected += 1
+            return _error_response(503, str(e), "unavailable")
+        except (asyncio.CancelledError, ConnectionResetError):
+            raise
+        except Exception as e:
+            self.metrics.errors += 1
+            return _error_response(500, str(e), "server_error")
+        finally:
+            self.metrics.active -= 1
+            self.metrics.duration_sum += time.perf_counter() - start
+            self.metrics.duration_count += 1
+
+    async def _complete(
+        self, endpoint: str, prompt: str, params: InferenceParams
+    ) -> Any:
+        from aiohttp import web
+
+        res = await self.scheduler.ainfer(prompt, params)
+        stats = res["stats"]
+        tokens = stats.get("generated_tokens", 0)
+        self.metrics.generated_tokens += tokens
+        reason = _finish_reason(tokens, params)
+        if endpoint == "completions":
+            choice: Dict[str, Any] = {"text": res["text"]}
+        else:
+            choice = {"message": {"role": "assistant", "content": res["text"]}}
+        choice.update({"index": 0, "finish_reason": reason})
+        data = {
+            **self._head(endpoint, False),
+            "choices": [choice],
+            "usage": {
+                "prompt_tokens": stats.get("prompt_tokens", 0),
+                "completion_tokens": tokens,
+                "total_tokens": stats.get("prompt_tokens", 0) + tokens,
+            },
+        }
+        return web.Response(body=json_dumps(data), content_type="application/json")
+
+    async def _stream(
+        self, request: Any, endpoint: str, prompt: str, params: InferenceParams
+    ) -> Any:
+        from aiohttp import web
+
+        start = time.perf_counter()
+        head = self._head(endpoint, True)
+        tokens = self.scheduler.agenerate(prompt, params)
+        response = None
+        count = 0
+        try:
+            async for token in tokens:
+                if response is None:
+                    # the headers are sent with the first token: a queuing or
+                    # backend error can still be returned with its status
+                    response = web.StreamResponse(headers=_SSE_HEADERS)
+                    await response.prepare(request)
+                    await response.write(_role_chunk(head, endpoint))
+                    self.metrics.ttft_count += 1
+                    self.metrics.ttft_sum += time.perf_counter() - start
+                count += 1
+                await response.write(_chunk(head, endpoint, token, None))
+        except (asyncio.CancelledError, ConnectionResetError):
+            raise
+        except Exception as e:
+            if response is None:
+                raise
+            # the status is sent already: end the stream with an error event
+            self.metrics.errors += 1
+            data = {"error": {"message": str(e), "type": "server_error"}}
+            await response.write(b"data: " + json_dumps(data) + b"\n\n")
+            await response.write_eof()
+            return response
+        finally:
+            await tokens.aclose()  # type: ignore
+            self.metrics.generated_tokens += count
+        if response is None:
+            response = web.StreamResponse(headers=_SSE_HEADERS)
+            await response.prepare(request)
+            await response.write(_role_chunk(head, endpoint))
+        reason = _finish_reason(count, params)
+        await response.write(_chunk(head, endpoint, "", reason))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    def _head(self, endpoint: str, chunk: bool) -> Dict[str, Any]:
+        if endpoint == "completions":
+            prefix, obj = "cmpl", "text_completion"
+        else:
+            prefix = "chatcmpl"
+            obj = "chat.completion.chunk" if chunk else "chat.completion"
+        return {
+            "id": f"{prefix}-{uuid.uuid4().hex[:24]}",
+            "object": obj,
+            "created": int(time.time()),
+            "model": self.model,
+        }
+
+
+_SSE_HEADERS = {
+    "Content-Type": "text/event-stream",
+    "Cache-Control": "no-cache",
+}
+
+
+def _content(content: Any) -> str:
+    # a text or a list of parts
+    if content is None:
+        return ""
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "".join(p.get("text", "") for p in content if p.get("type") == "text")
+    raise ValueError("Unsupported message content")
+
+
+def _params(body: Dict[str, Any]) -> InferenceParams:
+    # map an OpenAI request to the inference params
+    values: Dict[str, Any] = {k: body[k] for k in _PARAMS if body.get(k) is not None}
+    stop = body.get("stop")
+    if isinstance(stop, str):
+        values["stop"] = [stop]
+    elif stop:
+        values["stop"] = stop
+    fmt = body.get("response_format") or {}
+    if fmt.get("type") == "json_schema":
+        values["json_schema"] = fmt.get("json_schema", {}).get("schema", {})
+    elif fmt.get("type") == "json_object":
+        values["json_schema"] = {"type": "object"}
+    try:
+        return InferenceParams(stream=body.get("stream") is True, **values)
+    except ValueError as e:
+        raise ApiError(400, f"Invalid parameters: {e}", "invalid")
+
+
+def _finish_reason(tokens: int, params: InferenceParams) -> str:
+    if params.max_tokens is not None and tokens >= params.max_tokens:
+        return "length"
+    return "stop"
+
+
+def _chunk(
+    head: Dict[str, Any], endpoint: str, token: str, reason: Optional[str]
+) -> bytes:
+    if endpoint == "completions":
+        choice: Dict[str, Any] = {"text": token}
+    else:
+        choice = {"delta": {"content": token} if token else {}}
+    choice.update({"index": 0, "finish_reason": reason})
+    return b"data: " + json_dumps({**head, "choices": [choice]}) + b"\n\n"
+
+
+def _role_chunk(head: Dict[str, Any], endpoint: str) -> bytes:
+    # the chat streams announce the role of the message in a first delta
+    if endpoint == "completions":
+        return b""
+    choice = {"delta": {"role": "assistant"}, "index": 0, "finish_reason": None}
+    return b"data: " + json_dumps({**head, "choices": [choice]}) + b"\n\n"
+
+
+def _error_response(status: int, message: str, etype: str) -> Any:
+    from aiohttp import web
+
+    data = {"error": {"message": message, "type": etype}}
+    return web.Response(
+        status=status, body=json_dumps(data), content_type="application/json"
+    )
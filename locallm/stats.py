@@ -0,0 +1,92 @@
+import time
+from typing import Optional
+
+from .schemas import InferenceStats
+
+
+class StatsRecorder:
+    """
+    Measure the timings of an inference query on the client side. The numbers
+    reported by the server replace the measured ones when available.
+
+    Example:
+        >>> recorder = StatsRecorder()
+        >>> for token in stream:
+        >>>     recorder.token()
+        >>> stats = recorder.stats(prompt_tokens=12)
+    """
+
+    start: float
+    first_token_time: Optional[float] = None
+    tokens: int = 0
+    # the time limit has cut the generation off
+    timed_out: bool = False
+
+    def __init__(self) -> None:
+        self.start = time.perf_counter()
+
+    def token(self):
+        """Record a received token"""
+        if self.first_token_time is None:
+            self.first_token_time = time.perf_counter()
+        self.tokens += 1
+
+    def stats(
+        self,
+        prompt_tokens: Optional[int] = None,
+        generated_tokens: Optional[int] = None,
+        prompt_time: Optional[float] = None,
+        generation_time: Optional[float] = None,
+        server_time: Optional[float] = None,
+        skipped_prompt_tokens: Optional[int] = None,
+    ) -> InferenceStats:
+        """
+        Build the stats of the query
+
+        Args:
+            prompt_tokens (Optional[int], optional): The number of prompt tokens.
+                Defaults to None: unknown.
+            generated_tokens (Optional[int], optional): The number of generated
+                tokens. Defaults to None: the number of recorded tokens.
+            prompt_time (Optional[float], optional): The prompt evaluation time in
+                seconds. Defaults to None: the time to first token.
+            generation_time (Optional[float], optional): The generation time in
+                seconds. Defaults to None: the time after the first token.
+            server_time (Optional[float], optional): The total time spent by the
+                server in seconds, to compute the network overhead. Defaults to
+                None.
+            skipped_prompt_tokens (Optional[int], optional): The number of prompt
+                tokens that the model did not evaluate. Defaults to None.
+
+        Returns:
+            InferenceStats: The stats.
+        """
+        end = time.perf_counter()
+        total_time = end - self.start
+        first = self.first_token_time if self.first_token_time is not None else end
+        time_to_first_token = first - self.start
+        if generated_tokens is None:
+            generated_tokens = self.tokens
+        if prompt_time is None:
+            prompt_time = time_to_first_token
+        if generation_time is None:
+            generation_time = end - first
+        res: InferenceStats = {
+            "generated_tokens": generated_tokens,
+            "time_to_first_token": time_to_first_token,
+            "total_time": total_time,
+        }
+        if generation_time > 0:
+            res["generation_tokens_per_second"] = generated_tokens / generation_time
+        if prompt_tokens is not None:
+            res["prompt_tokens"] = prompt_tokens
+            evaluated = prompt_tokens - (skipped_prompt_tokens or 0)
+            if prompt_time > 0:
+                res["prompt_tokens_per_second"] = evaluated / prompt_time
+        if skipped_prompt_tokens is not None:
+            res["skipped_prompt_tokens"] = skipped_prompt_tokens
+        if server_time is not None:
+            res["network_overhead"] = max(total_time - server_time, 0.0)
+        if self.timed_out:
+            res["timed_out"] = True
+        return res
@@ -0,0 +1,174 @@
+import re
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# the number of emitted characters kept to match the regex stops
+DEFAULT_REGEX_WINDOW = 256
+
+# the number of characters held back while a regex stop could match them
+DEFAULT_REGEX_HOLD = 32
+
+
+@lru_cache(maxsize=64)
+def _automaton(
+    stops: Tuple[str, ...]
+) -> Tuple[List[Dict[str, int]], List[int], List[int], List[int]]:
+    # an Aho-Corasick automaton: the transitions, the failure links, the depth of
+    # the states and the length of the longest stop string ending at each state
+    goto: List[Dict[str, int]] = [{}]
+    depth = [0]
+    out = [0]
+    for stop in stops:
+        state = 0
+        for ch in stop:
+            nxt = goto[state].get(ch)
+            if nxt is None:
+                nxt = len(goto)
+                goto[state][ch] = nxt
+                goto.append({})
+                depth.append(depth[state] + 1)
+                out.append(0)
+            state = nxt
+        out[state] = max(out[state], len(stop))
+    fail = [0] * len(goto)
+    queue = list(goto[0].values())
+    for state in queue:
+        for ch, nxt in goto[state].items():
+            f = fail[state]
+            while f and ch not in goto[f]:
+                f = fail[f]
+            fail[nxt] = goto[f].get(ch, 0)
+            # a stop string ending at the fallback state also ends here
+            out[nxt] = max(out[nxt], out[fail[nxt]])
+            queue.append(nxt)
+    return goto, fail, depth, out
+
+
+class StopMatcher:
+    """
+    Find the stop strings in a stream of tokens. The stop strings are matched
+    together by an automaton that keeps its state between the tokens, so a match
+    can span several tokens. The text that could be the start of a stop string
+    is held back until the next tokens tell if it is. The regex stops are
+    searched in the recent text: the last `hold` characters are held back, so
+    only the start of a longer regex match may have been emitted already, see
+    `retract`.
+
+    Args:
+        stops (Sequence[str], optional): The stop strings. Defaults to ().
+        patterns (Sequence[str], optional): The stop regular expressions.
+            Defaults to ().
+        window (int, optional): The number of emitted characters kept to match
+            the regex stops. Defaults to 256.
+        hold (int, optional): The number of characters held back when there are
+            regex stops. Defaults to 32.
+
+    Attributes:
+        stopped (bool): Whether a stop has matched.
+        retract (int): The number of emitted characters that belong to the
+            regex match, to remove from the generated text.
+
+    Example:
+        >>> matcher = StopMatcher(["</answer>"])
+        >>> matcher.feed("Paris</ans")
+        ('Paris', False)
+        >>> matcher.feed("wer> and")
+        ('', True)
+    """
+
+    stopped: bool = False
+    retract: int = 0
+
+    def __init__(
+        self,
+        stops: Sequence[str] = (),
+        patterns: Sequence[str] = (),
+        window: int = DEFAULT_REGEX_WINDOW,
+        hold: int = DEFAULT_REGEX_HOLD,
+    ) -> None:
+        stops = tuple(s for s in stops if s != "")
+        self._tables = _automaton(stops) if len(stops) > 0 else None
+        self._patterns = [re.compile(p) for p in patterns]
+        self._window = window
+        self._hold = hold
+        self._state = 0
+        self._held = ""
+        # the text cleared by the stop strings, held back for the regex stops
+        self._pending = ""
+        self._recent = ""
+
+    def feed(self, text: str) -> Tuple[str, bool]:
+        """
+        Add the text of a token
+
+        Args:
+            text (str): The token text.
+
+        Returns:
+            Tuple[str, bool]: The text that can be emitted and whether a stop has
+                matched.
+        """
+        if self.stopped:
+            return "", True
+        data = self._held + text
+        keep = 0
+        if self._tables is not None:
+            goto, fail, depth, out = self._tables
+            state = self._state
+            for i in range(len(self._held), len(data)):
+                ch = data[i]
+                while state and ch not in goto[state]:
+                    state = fail[state]
+                state = goto[state].get(ch, 0)
+                if out[state]:
+                    data = data[: i + 1 - out[state]]
+                    self.stopped = True
+                    break
+            self._state = state
+            keep = 0 if self.stopped else depth[state]
+        if self.stopped:
+            self._held = ""
+        else:
+            self._held = data[len(data) - keep:]
+            data = data[: len(data) - keep]
+        if len(self._patterns) > 0:
+            data = self._search(self._pending + data)
+            self._pending = ""
+            if not self.stopped:
+                # the end of the text could be the start of a match
+                cut = max(len(data) - self._hold, 0)
+                self._pending = data[cut:]
+                data = data[:cut]
+                self._recent = (self._recent + data)[-self._window:]
+        if self.stopped:
+            self._held = ""
+        return data, self.stopped
+
+    def flush(self) -> str:
+        """
+        Get the held back text at the end of the stream
+
+        Returns:
+            str: The text.
+        """
+        held = self._pending + self._held
+        self._held = ""
+        self._pending = ""
+        return "" if self.stopped else held
+
+    def _search(self, data: str) -> str:
+        # search the regex stops in the recent emitted text and the new text
+        text = self._recent + data
+        first: Optional[int] = None
+        for pattern in self._patterns:
+            match = pattern.search(text)
+            if match is not None and (first is None or match.start() < first):
+                first = match.start()
+        if first is None:
+            return data
+        self.stopped = True
+        cut = first - len(self._recent)
+        if cut < 0:
+            self.retract = -cut
+            return ""
+        return data[:cut]
@@ -0,0 +1,254 @@
+import json
+import sys
+import time
+from typing import Any, Callable, List, Optional, Tuple
+
+from .schemas import InferenceStats, OnStartEmitType, OnTokenType
+from .stats import StatsRecorder
+from .stop import StopMatcher
+from .structured import JsonValidator, StructuredOutputError
+
+try:
+    import orjson
+
+    json_loads: Callable[[str | bytes], Any] = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+
+class Token:
+    """
+    A token of a generation stream, parsed once by the provider.
+
+    Args:
+        text (str): The token text.
+        index (int): The position of the token in the generation.
+        time (float): The `time.perf_counter` time at which it was received.
+        stats (Optional[InferenceStats], optional): The stats of the query, set
+            on the last item of the stream only. Defaults to None.
+
+    Example:
+        >>> for token in lm.generate("List the planets in the solar system"):
+        >>>     print(token.text, end="")
+        >>>     if token.stats is not None:
+        >>>         print(token.stats["generated_tokens"])
+    """
+
+    __slots__ = ("text", "index", "time", "stats")
+
+    def __init__(
+        self,
+        text: str,
+        index: int,
+        time: float,
+        stats: Optional[InferenceStats] = None,
+    ) -> None:
+        self.text = text
+        self.index = index
+        self.time = time
+        self.stats = stats
+
+    def __repr__(self) -> str:
+        return f"Token({self.text!r}, {self.index}, stats={self.stats})"
+
+
+class TokenConsumer:
+    """
+    Accumulate the tokens of a generation and dispatch them to the callbacks. The
+    tokens can be passed to `on_token` in batches, every `batch_size` tokens or
+    every `batch_ms` milliseconds, to lower the cost of the callback per token.
+
+    Args:
+        on_token (Optional[OnTokenType], optional): The function to call with the
+            tokens. Defaults to None.
+        on_start_emit (Optional[OnStartEmitType], optional): The function to call
+            with the first token. Defaults to None.
+        emit (bool, optional): Whether to call the functions. Defaults to True.
+        batch_size (Optional[int], optional): Flush the tokens to `on_token` every
+            n tokens. Defaults to None: one call per token.
+        batch_ms (Optional[float], optional): Flush the tokens to `on_token` every
+            n milliseconds. Defaults to None.
+        matcher (Optional[StopMatcher], optional): The stop strings to end the
+            generation on. Defaults to None.
+        max_time (Optional[float], optional): End the generation after this
+            number of seconds. Defaults to None.
+        validator (Optional[JsonValidator], optional): Check the generated JSON
+            as it arrives and stop at the first error. Defaults to None.
+
+    Attributes:
+        recorder (StatsRecorder): The timings of the generation.
+        stopped (bool): Whether a stop string, the time limit or an invalid
+            output has ended the generation: the caller should stop reading the
+            backend.
+        error (Optional[StructuredOutputError]): The validation error.
+
+    Example:
+        >>> consumer = TokenConsumer(print, batch_size=16)
+        >>> for token in tokens:
+        >>>     if consumer.push(token):
+        >>>         break
+        >>> text = consumer.text()
+    """
+
+    recorder: StatsRecorder
+    stopped: bool = False
+    error: Optional[StructuredOutputError] = None
+
+    def __init__(
+        self,
+        on_token: Optional[OnTokenType] = None,
+        on_start_emit: Optional[OnStartEmitType] = None,
+        emit: bool = True,
+        batch_size: Optional[int] = None,
+        batch_ms: Optional[float] = None,
+        matcher: Optional[StopMatcher] = None,
+        max_time: Optional[float] = None,
+        validator: Optional[JsonValidator] = None,
+    ) -> None:
+        self.recorder = StatsRecorder()
+        self._matcher = matcher
+        self._validator = validator
+        self._deadline = None
+        if max_time is not None:
+            self._deadline = time.perf_counter() + max_time
+        self._buf: List[str] = []
+        self._on_token = on_token if emit else None
+        self._on_start_emit = on_start_emit if emit else None
+        self._started = False
+        self._batched = batch_size is not None or batch_ms is not None
+        self._batch_size = batch_size if batch_size is not None else sys.maxsize
+        self._batch_s = batch_ms / 1000 if batch_ms is not None else None
+        self._pending: List[str] = []
+        self._last_flush = time.perf_counter()
+        # the part of the text already returned by `feed`
+        self._fed = 0
+        self._fed_chars = 0
+
+    def push(self, token: str, count: bool = True) -> bool:
+        """
+        Add a token
+
+        Args:
+            token (str): The token text.
+            count (bool, optional): Whether to count it as a generated token in
+                the stats. Defaults to True.
+
+        Returns:
+            bool: Whether the generation is stopped.
+        """
+        if count:
+            self.recorder.token()
+        if self.stopped:
+            return True
+        if self._matcher is not None:
+            token, self.stopped = self._matcher.feed(token)
+        if (
+            not self.stopped
+            and self._deadline is not None
+            and time.perf_counter() >= self._deadline
+        ):
+            self.stopped = True
+            self.recorder.timed_out = True
+        if token != "":
+            self._emit(token)
+        return self.stopped
+
+    def _emit(self, token: str):
+        self._buf.append(token)
+        if self._validator is not None and self.error is None:
+            try:
+                self._validator.feed(token)
+            except StructuredOutputError as e:
+                # fail fast: there is no use generating the rest
+                self.error = e
+                self.stopped = True
+                return
+        if not self._started:
+            self._started = True
+            if self._on_start_emit is not None:
+                self._on_start_emit(None)
+        if self._on_token is None:
+            return
+        if not self._batched:
+            self._on_token(token)
+            return
+        self._pending.append(token)
+        if len(self._pending) >= self._batch_size:
+            self.flush()
+        elif (
+            self._batch_s is not None
+            and time.perf_counter() - self._last_flush >= self._batch_s
+        ):
+            self.flush()
+
+    def flush(self):
+        """Pass the pending tokens to `on_token`"""
+        if self._pending and self._on_token is not None:
+            self._on_token("".join(self._pending))
+            self._pending = []
+        if self._batch_s is not None:
+            self._last_flush = time.perf_counter()
+
+    def feed(self, token: str, count: bool = True) -> Tuple[str, bool]:
+        """
+        Add a token of a stream and get the text it clears: the text that could
+        be the start of a stop is held back until the next tokens
+
+        Args:
+            token (str): The token text.
+            count (bool, optional): Whether to count it as a generated token in
+                the stats. Defaults to True.
+
+        Returns:
+            Tuple[str, bool]: The text to stream and whether the generation is
+                stopped.
+        """
+        stopped = self.push(token, count)
+        text = "".join(self._buf[self._fed:])
+        self._fed = len(self._buf)
+        self._fed_chars += len(text)
+        return text, stopped
+
+    def rest(self) -> str:
+        """
+        Get the text held back at the end of a stream
+
+        Returns:
+            str: The text not returned by `feed` yet.
+
+        Raises:
+            StructuredOutputError: If the text is not valid for the validator.
+        """
+        text = self.text()[self._fed_chars:]
+        self._fed = len(self._buf)
+        self._fed_chars += len(text)
+        return text
+
+    def text(self) -> str:
+        """
+        Flush the pending tokens and get the generated text
+
+        Returns:
+            str: The generated text.
+
+        Raises:
+            StructuredOutputError: If the text is not valid for the validator.
+        """
+        if self._matcher is not None:
+            held = self._matcher.flush()
+            if held != "":
+                self._emit(held)
+        self.flush()
+        text = "".join(self._buf)
+        if self._matcher is not None and self._matcher.retract > 0:
+            # the start of a regex stop match has been emitted already
+            text = text[: len(text) - self._matcher.retract]
+        if self._validator is not None and self.error is None:
+            try:
+                self._validator.finish()
+            except StructuredOutputError as e:
+                self.error = e
+        if self.error is not None:
+            self.error.text = text
+            raise self.error
+        return text
@@ -0,0 +1,544 @@
+import hashlib
+import json
+import re
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Type, Union
+
+from pydantic import BaseModel, ValidationError
+
+if TYPE_CHECKING:
+    from llama_cpp import LlamaGrammar
+
+SchemaType = Union[Dict[str, Any], Type[BaseModel]]
+
+# the number of compiled grammars kept
+MAX_GRAMMARS = 128
+
+_NUMBER = re.compile(r"-?(0|[1-9][0-9]*)(\.[0-9]+)?([eE][+-]?[0-9]+)?")
+
+_LITERALS = ("true", "false", "null")
+
+
+class StructuredOutputError(Exception):
+    """
+    The generated text does not follow the requested structure.
+
+    Attributes:
+        text (str): The text generated until the error.
+    """
+
+    def __init__(self, message: str, text: str = "") -> None:
+        super().__init__(message)
+        self.text = text
+
+
+def schema_dict(schema: SchemaType) -> Dict[str, Any]:
+    """
+    Get the JSON Schema of a pydantic model, or the schema itself
+
+    Args:
+        schema (SchemaType): A JSON Schema or a pydantic model.
+
+    Returns:
+        Dict[str, Any]: The JSON Schema.
+    """
+    if isinstance(schema, type) and issubclass(schema, BaseModel):
+        return schema.model_json_schema()
+    return schema  # type: ignore
+
+
+def schema_hash(schema: Dict[str, Any]) -> str:
+    """
+    Get a stable hash of a JSON Schema
+
+    Args:
+        schema (Dict[str, Any]): The JSON Schema.
+
+    Returns:
+        str: The hash.
+    """
+    data = json.dumps(schema, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class _GrammarCache:
+    # the compiled grammars, by hash of their source
+    def __init__(self, max_items: int) -> None:
+        self.max_items = max_items
+        self._data: OrderedDict[str, Any] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str, compile: Any) -> Any:
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+                return value
+        value = compile()
+        with self._lock:
+            self._data[key] = value
+            if len(self._data) > self.max_items:
+                self._data.popitem(last=False)
+        return value
+
+
+_gbnf_cache = _GrammarCache(MAX_GRAMMARS)
+
+_grammar_cache = _GrammarCache(MAX_GRAMMARS)
+
+
+# the json primitives, as written by the converter of llama.cpp
+_GBNF_PRIMITIVES = {
+    "space": '| " " | "\\n"{1,2} [ \\t]{0,20}',
+    "char": '[^"\\\\\\x7F\\x00-\\x1F] | [\\\\] (["\\\\bfnrt] | "u" [0-9a-fA-F]{4})',
+    "integral-part": "[0] | [1-9] [0-9]{0,15}",
+    "decimal-part": "[0-9]{1,16}",
+    "string": '"\\"" char* "\\"" space',
+    "number": '("-"? integral-part) ("." decimal-part)? ([eE] [-+]? integral-part)? '
+    "space",
+    "integer": '("-"? integral-part) space',
+    "boolean": '("true" | "false") space',
+    "null": '"null" space',
+    "value": "object | array | string | number | boolean | null",
+    "object": '"{" space ( string ":" space value ("," space string ":" space '
+    'value)* )? "}" space',
+    "array": '"[" space ( value ("," space value)* )? "]" space',
+}
+
+# the primitives each primitive uses
+_GBNF_DEPENDENCIES = {
+    "char": [],
+    "string": ["char", "space"],
+    "number": ["integral-part", "decimal-part", "space"],
+    "integer": ["integral-part", "space"],
+    "boolean": ["space"],
+    "null": ["space"],
+    "value": ["object", "array", "string", "number", "boolean", "null"],
+    "object": ["string", "value", "space"],
+    "array": ["value", "space"],
+}
+
+
+def _gbnf_literal(text: str) -> str:
+    escaped = (
+        text.replace("\\", "\\\\")
+        .replace('"', '\\"')
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+        .replace("\t", "\\t")
+    )
+    return f'"{escaped}"'
+
+
+def _gbnf_count(min_count: int, max_count: Optional[int]) -> str:
+    # the repetition of an item
+    if max_count is None:
+        return "*" if min_count == 0 else f"{{{min_count},}}"
+    return f"{{{min_count},{max_count}}}"
+
+
+class _GbnfConverter:
+    # compile a JSON Schema to a gbnf grammar, one rule per sub-schema
+    def __init__(self, schema: Dict[str, Any]) -> None:
+        self.schema = schema
+        self.rules: Dict[str, str] = {}
+        self.refs: Dict[str, str] = {}
+
+    def convert(self) -> str:
+        root = self.visit(self.schema, "root")
+        rules = [f"root ::= {root}"]
+        rules += [f"{name} ::= {rule}" for name, rule in self.rules.items()]
+        return "\n".join(rules)
+
+    def add_rule(self, name: str, rule: str) -> str:
+        name = re.sub(r"[^a-zA-Z0-9-]+", "-", name)
+        key = name
+        i = 1
+        while key == "root" or key in self.rules or key in _GBNF_PRIMITIVES:
+            i += 1
+            key = f"{name}{i}"
+        self.rules[key] = rule
+        return key
+
+    def rule(self, schema: Dict[str, Any], name: str) -> str:
+        # get a rule name for a sub-schema
+        body = self.visit(schema, name)
+        if re.fullmatch(r"[a-zA-Z0-9-]+", body):
+            return body
+        return self.add_rule(name, body)
+
+    def primitive(self, name: str) -> str:
+        if name not in self.rules:
+            self.rules[name] = _GBNF_PRIMITIVES[name]
+            for dependency in _GBNF_DEPENDENCIES.get(name, []):
+                self.primitive(dependency)
+        return name
+
+    def resolve(self, ref: str) -> Dict[str, Any]:
+        if not ref.startswith("#/"):
+            raise ValueError(f"Only the local schema references are supported: {ref}")
+        target: Any = self.schema
+        for part in ref[2:].split("/"):
+            target = target[part.replace("~1", "/").replace("~0", "~")]
+        return target
+
+    def visit(self, schema: Dict[str, Any], name: str) -> str:
+        # get the rule body of a schema
+        if "$ref" in schema:
+            ref = schema["$ref"]
+            if ref not in self.refs:
+                # name the rule first for the recursive schemas
+                rule_name = self.add_rule(ref.split("/")[-1], "")
+                self.refs[ref] = rule_name
+                self.rules[rule_name] = self.visit(self.resolve(ref), rule_name)
+            return self.refs[ref]
+        if "const" in schema:
+            return _gbnf_literal(json.dumps(schema["const"])) + " " + self.primitive(
+                "space"
+            )
+        if "enum" in schema:
+            space = self.primitive("space")
+            values = " | ".join(_gbnf_literal(json.dumps(v)) for v in schema["enum"])
+            return f"({values}) {space}"
+        alternatives = schema.get("anyOf") or schema.get("oneOf")
+        if alternatives:
+            return " | ".join(
+                self.rule(s, f"{name}-{i}") for i, s in enumerate(alternatives)
+            )
+        if "allOf" in schema:
+            merged: Dict[str, Any] = {
+                "type": "object",
+                "properties": {},
+                "required": [],
+            }
+            for part in schema["allOf"]:
+                if "$ref" in part:
+                    part = self.resolve(part["$ref"])
+                if "properties" not in part:
+                    return self.visit(part, name)
+                merged["properties"].update(part["properties"])
+                merged["required"] += part.get("required", [])
+            return self.visit(merged, name)
+        schema_type = schema.get("type")
+        if isinstance(schema_type, list):
+            return " | ".join(
+                self.visit({**schema, "type": t}, name) for t in schema_type
+            )
+        if schema_type == "object" and "properties" in schema:
+            return self.visit_object(schema, name)
+        if schema_type == "array" and any(
+            k in schema for k in ("items", "minItems", "maxItems")
+        ):
+            return self.visit_array(schema, name)
+        if schema_type == "string" and any(
+            k in schema for k in ("minLength", "maxLength")
+        ):
+            char = self.primitive("char")
+            space = self.primitive("space")
+            count = _gbnf_count(schema.get("minLength", 0), schema.get("maxLength"))
+            return f'"\\"" {char}{count} "\\"" {space}'
+        if schema_type in ("string", "number", "integer", "boolean", "null"):
+            return self.primitive(schema_type)
+        if schema_type in ("object", "array"):
+            return self.primitive(schema_type)
+        return self.primitive("value")
+
+    def visit_array(self, schema: Dict[str, Any], name: str) -> str:
+        space = self.primitive("space")
+        min_items = schema.get("minItems", 0)
+        max_items = schema.get("maxItems")
+        if max_items == 0:
+            return f'"[" {space} "]" {space}'
+        item = self.rule(schema.get("items", {}), f"{name}-item")
+        more = max_items - 1 if max_items is not None else None
+        count = _gbnf_count(max(min_items - 1, 0), more)
+        body = f'{item} ("," {space} {item}){count}'
+        if min_items == 0:
+            body = f"( {body} )?"
+        return f'"[" {space} {body} "]" {space}'
+
+    def visit_object(self, schema: Dict[str, Any], name: str) -> str:
+        space = self.primitive("space")
+        required = set(schema.get("required", []))
+        pairs = {}
+        for key, value in schema["properties"].items():
+            rule = self.rule(value, f"{name}-{key}")
+            pairs[key] = f'{_gbnf_literal(json.dumps(key))} {space} ":" {space} {rule}'
+        # the required properties first, then the optional ones in their order
+        first = [pairs[k] for k in pairs if k in required]
+        optional = [pairs[k] for k in pairs if k not in required]
+
+        def tail(i: int) -> str:
+            return "".join(f' ( "," {space} {pair} )?' for pair in optional[i:])
+
+        if first:
+            body = f' "," {space} '.join(first) + tail(0)
+        elif optional:
+            body = (
+                "( "
+                + " | ".join(f"{pair}{tail(i + 1)}" for i, pair in enumerate(optional))
+                + " )?"
+            )
+        else:
+            body = ""
+        return f'"{{" {space} {body} "}}" {space}'
+
+
+def json_schema_gbnf(schema: Dict[str, Any]) -> str:
+    """
+    Compile a JSON Schema to a gbnf grammar, once per schema, for all the
+    providers and without llama-cpp-python. It constrains the types, the
+    properties, the enums and consts, the `anyOf`, `oneOf` and `allOf`
+    combinations, the local references, the string lengths and the array
+    sizes. The string formats and patterns and the number ranges are not
+    constrained: the output may still fail their validation
+
+    Args:
+        schema (Dict[str, Any]): The JSON Schema.
+
+    Raises:
+        ValueError: If the schema has a reference to another document.
+
+    Returns:
+        str: The gbnf grammar.
+    """
+    return _gbnf_cache.get(
+        schema_hash(schema), lambda: _GbnfConverter(schema).convert()
+    )
+
+
+def llama_grammar(
+    grammar: Optional[str] = None, schema: Optional[Dict[str, Any]] = None
+) -> "LlamaGrammar":
+    """
+    Get the llama.cpp grammar of a gbnf grammar or a JSON Schema. The grammars
+    are cached by hash of their source
+
+    Args:
+        grammar (Optional[str], optional): A gbnf grammar. Defaults to None.
+        schema (Optional[Dict[str, Any]], optional): A JSON Schema. Defaults to
+            None.
+
+    Returns:
+        LlamaGrammar: The grammar.
+    """
+    from llama_cpp import LlamaGrammar
+
+    if schema is not None:
+        grammar = json_schema_gbnf(schema)
+    key = hashlib.sha256((grammar or "").encode("utf-8")).hexdigest()
+    return _grammar_cache.get(
+        key, lambda: LlamaGrammar.from_string(grammar, verbose=False)
+    )
+
+
+def parse_output(text: str, schema: SchemaType) -> Any:
+    """
+    Parse a generated JSON text, as an instance of the pydantic model if the
+    schema is a model
+
+    Args:
+        text (str): The generated text.
+        schema (SchemaType): A JSON Schema or a pydantic model.
+
+    Raises:
+        StructuredOutputError: If the text is not valid.
+
+    Returns:
+        Any: The parsed data.
+    """
+    from .stream import json_loads
+
+    try:
+        if isinstance(schema, type) and issubclass(schema, BaseModel):
+            return schema.model_validate_json(text)
+        return json_loads(text)
+    except (ValidationError, ValueError) as e:
+        raise StructuredOutputError(str(e), text) from e
+
+
+class JsonValidator:
+    """
+    Check a JSON text as it is generated, to fail at the first character that
+    can not belong to a valid document rather than at the end of the
+    generation. It checks the syntax, the type of the document and the keys of
+    the top level object when the schema does not allow additional properties.
+
+    Args:
+        schema (Optional[Dict[str, Any]], optional): The JSON Schema. Defaults to
+            None.
+
+    Example:
+        >>> validator = JsonValidator({"type": "object"})
+        >>> validator.feed('{"name": ')
+        >>> validator.feed("Paris")
+        StructuredOutputError: Unexpected character 'P' at 9
+    """
+
+    def __init__(self, schema: Optional[Dict[str, Any]] = None) -> None:
+        schema = schema or {}
+        self._type = schema.get("type")
+        self._keys = None
+        if schema.get("additionalProperties") is False and "properties" in schema:
+            self._keys = set(schema["properties"])
+        # the containers: "{" or "["
+        self._stack: List[str] = []
+        # what is expected: value, key, colon, comma, string, number, literal, end
+        self._state = "value"
+        self._started = False
+        self._escape = 0
+        self._empty = False
+        self._token: List[str] = []
+        self._is_key = False
+        self._pos = 0
+
+    def feed(self, text: str):
+        """
+        Check the next part of the text
+
+        Args:
+            text (str): The text.
+
+        Raises:
+            StructuredOutputError: If the text can not be valid.
+        """
+        for ch in text:
+            self._char(ch)
+            self._pos += 1
+
+    def finish(self):
+        """
+        Check that the document is complete
+
+        Raises:
+            StructuredOutputError: If the document is not complete.
+        """
+        if self._state == "number":
+            self._end_number()
+        if self._state != "end":
+            raise StructuredOutputError("The JSON document is incomplete")
+
+    def _fail(self, ch: str):
+        raise StructuredOutputError(f"Unexpected character {ch!r} at {self._pos}")
+
+    def _char(self, ch: str):
+        state = self._state
+        if state == "string":
+            self._string_char(ch)
+            return
+        if state == "number":
+            if ch in "0123456789+-.eE":
+                self._token.append(ch)
+                return
+            self._end_number()
+            state = self._state
+        if state == "literal":
+            self._token.append(ch)
+            word = "".join(self._token)
+            if not any(lit.startswith(word) for lit in _LITERALS):
+                self._fail(ch)
+            if word in _LITERALS:
+                self._end_value()
+            return
+        if ch in " \t\n\r":
+            return
+        if state == "value":
+            self._value_char(ch)
+        elif state == "key":
+            if ch == '"':
+                self._state = "string"
+                self._is_key = True
+                self._token = []
+            elif ch == "}" and self._empty:
+                self._close()
+            else:
+                self._fail(ch)
+        elif state == "colon":
+            if ch != ":":
+                self._fail(ch)
+            self._state = "value"
+        elif state == "comma":
+            top = self._stack[-1]
+            if ch == ",":
+                self._state = "key" if top == "{" else "value"
+                self._empty = False
+            elif (ch == "}" and top == "{") or (ch == "]" and top == "["):
+                self._close()
+            else:
+                self._fail(ch)
+        else:
+            # only whitespace after the document
+            self._fail(ch)
+
+    def _value_char(self, ch: str):
+        if not self._started:
+            self._started = True
+            expected = {"object": "{", "array": "[", "string": '"'}.get(
+                self._type or ""
+            )
+            if expected is not None and ch != expected:
+                self._fail(ch)
+        if ch == "{" or ch == "[":
+            self._stack.append(ch)
+            self._state = "key" if ch == "{" else "value"
+            self._empty = True
+        elif ch == "]" and self._stack and self._stack[-1] == "[" and self._empty:
+            self._close()
+        elif ch == '"':
+            self._state = "string"
+            self._is_key = False
+            self._token = []
+        elif ch == "-" or ch.isdigit():
+            self._state = "number"
+            self._token = [ch]
+        elif ch in "tfn":
+            self._state = "literal"
+            self._token = [ch]
+        else:
+            self._fail(ch)
+
+    def _string_char(self, ch: str):
+        if self._escape == 1:
+            if ch == "u":
+                self._escape = 5
+            elif ch in '"\\/bfnrt':
+                self._escape = 0
+            else:
+                self._fail(ch)
+        elif self._escape > 1:
+            if ch not in "0123456789abcdefABCDEF":
+                self._fail(ch)
+            self._escape = self._escape - 1 if self._escape > 2 else 0
+        elif ch == "\\":
+            self._escape = 1
+        elif ch == '"':
+            if self._is_key:
+                self._end_key()
+            else:
+                self._end_value()
+            return
+        elif ord(ch) < 0x20:
+            self._fail(ch)
+        if self._is_key and self._keys is not None and len(self._stack) == 1:
+            self._token.append(ch)
+
+    def _end_key(self):
+        if self._keys is not None and len(self._stack) == 1:
+            key = json.loads('"' + "".join(self._token) + '"')
+            if key not in self._keys:
+                raise StructuredOutputError(f"Unexpected key {key!r}")
+        self._state = "colon"
+
+    def _end_number(self):
+        if _NUMBER.fullmatch("".join(self._token)) is None:
+            raise StructuredOutputError(f"Invalid number at {self._pos}")
+        self._end_value()
+
+    def _close(self):
+        self._stack.pop()
+        self._end_value()
+
+    def _end_value(self):
+        self._token = []
+        self._state = "comma" if self._stack else "end"
@@ -0,0 +1,281 @@
+import re
+from functools import lru_cache
+from typing import Dict, List, Literal, Mapping, Optional, Sequence, Tuple
+
+from .schemas import InferenceParams
+
+ChatFormatType = Literal["mistral", "chatml", "llama3"]
+
+# the number of compiled templates kept
+MAX_TEMPLATES = 256
+
+# the number of rendered prefixes kept per template
+MAX_PREFIXES = 64
+
+_SLOT = re.compile(r"\{([A-Za-z_][A-Za-z0-9_]*)\}")
+
+
+class CompiledTemplate:
+    """
+    A prompt template split once into its literal text and its named slots,
+    like `{prompt}` or `{system}`. The slots without a value are rendered as is,
+    so the braces of the code samples in the templates are kept.
+
+    Args:
+        text (str): The template.
+
+    Attributes:
+        text (str): The template.
+        slots (Tuple[str, ...]): The names of the slots, in order.
+        prefix (str): The static text before the first slot, that can be cached
+            once evaluated.
+
+    Example:
+        >>> tpl = compile_template("<s>[INST] {system}\\n\\n{prompt} [/INST]")
+        >>> tpl.render(prompt="List the planets", system="Be concise")
+        '<s>[INST] Be concise\\n\\nList the planets [/INST]'
+    """
+
+    text: str
+    slots: Tuple[str, ...]
+    prefix: str
+
+    def __init__(self, text: str) -> None:
+        self.text = text
+        parts = _SLOT.split(text)
+        # the literals are at the even indexes, the slot names at the odd ones
+        self._literals = parts[0::2]
+        self.slots = tuple(parts[1::2])
+        self.prefix = self._literals[0]
+        self._single = self.slots == ("prompt",)
+        self._split = lru_cache(maxsize=MAX_PREFIXES)(self._split_uncached)
+
+    def render(self, **values: str) -> str:
+        """
+        Render the template
+
+        Args:
+            **values (str): The values of the slots.
+
+        Returns:
+            str: The rendered text.
+        """
+        literals = self._literals
+        if self._single and "prompt" in values:
+            return "".join((literals[0], values["prompt"], literals[1]))
+        return _render(literals, self.slots, values)
+
+    def split(
+        self, slot: str = "prompt", values: Optional[Mapping[str, str]] = None
+    ) -> Tuple[str, str]:
+        """
+        Get the rendered text before and after a slot. The results are cached:
+        the text before the prompt of a long few shot template is rendered once
+
+        Args:
+            slot (str, optional): The slot name. Defaults to "prompt".
+            values (Optional[Mapping[str, str]], optional): The values of the
+                other slots. Defaults to None.
+
+        Returns:
+            Tuple[str, str]: The text before and after the first occurrence of the
+                slot, or the whole text and an empty text if it is absent.
+        """
+        items = tuple(sorted(values.items())) if values else ()
+        return self._split(slot, items)
+
+    def _split_uncached(
+        self, slot: str, items: Tuple[Tuple[str, str], ...]
+    ) -> Tuple[str, str]:
+        values = dict(items)
+        if slot not in self.slots:
+            return self.render(**values), ""
+        index = self.slots.index(slot)
+        literals = self._literals
+        return (
+            _render(literals[: index + 1], self.slots[:index], values),
+            _render(literals[index + 1:], self.slots[index + 1:], values),
+        )
+
+
+def _render(
+    literals: Sequence[str], slots: Sequence[str], values: Mapping[str, str]
+) -> str:
+    out: List[str] = [literals[0]]
+    for name, literal in zip(slots, literals[1:]):
+        value = values.get(name)
+        out.append("{" + name + "}" if value is None else value)
+        out.append(literal)
+    return "".join(out)
+
+
+@lru_cache(maxsize=MAX_TEMPLATES)
+def compile_template(text: str) -> CompiledTemplate:
+    """
+    Compile a template, once per template text
+
+    Args:
+        text (str): The template.
+
+    Returns:
+        CompiledTemplate: The compiled template.
+    """
+    return CompiledTemplate(text)
+
+
+def render_prompt(prompt: str, params: InferenceParams) -> str:
+    """
+    Render the final prompt of a query: its template with the prompt and the
+    template variables of the params
+
+    Args:
+        prompt (str): The prompt.
+        params (InferenceParams): The inference parameters.
+
+    Returns:
+        str: The final prompt.
+    """
+    if params.template is None:
+        return prompt
+    tpl = compile_template(params.template)
+    if params.variables:
+        return tpl.render(**{**params.variables, "prompt": prompt})
+    return tpl.render(prompt=prompt)
+
+
+def prompt_prefix(params: InferenceParams) -> Tuple[str, str]:
+    """
+    Get the rendered text of the template of a query before and after the
+    prompt
+
+    Args:
+        params (InferenceParams): The inference parameters.
+
+    Returns:
+        Tuple[str, str]: The text before and after the prompt.
+    """
+    if params.template is None:
+        return "", ""
+    return compile_template(params.template).split("prompt", params.variables)
+
+
+class ChatFormat:
+    """
+    The turn format of a chat model.
+
+    Args:
+        begin (str): The text at the start of the conversation.
+        system (str): The format of the system message, with a `{content}` slot.
+            Empty if the model has no system role: the system message is then
+            put before the first user message.
+        user (str): The format of the user messages.
+        assistant (str): The format of the assistant messages.
+        generation (str): The text that starts the assistant answer.
+    """
+
+    def __init__(
+        self, begin: str, system: str, user: str, assistant: str, generation: str
+    ) -> None:
+        self.begin = begin
+        self.system = system
+        self.user = user
+        self.assistant = assistant
+        self.generation = generation
+
+
+CHAT_FORMATS: Dict[str, ChatFormat] = {
+    "mistral": ChatFormat(
+        begin="<s>",
+        system="",
+        user="[INST] {content} [/INST]",
+        assistant="{content}</s>",
+        generation="",
+    ),
+    "chatml": ChatFormat(
+        begin="",
+        system="<|im_start|>system\n{content}<|im_end|>\n",
+        user="<|im_start|>user\n{content}<|im_end|>\n",
+        assistant="<|im_start|>assistant\n{content}<|im_end|>\n",
+        generation="<|im_start|>assistant\n",
+    ),
+    "llama3": ChatFormat(
+        begin="<|begin_of_text|>",
+        system="<|start_header_id|>system<|end_header_id|>\n\n{content}<|eot_id|>",
+        user="<|start_header_id|>user<|end_header_id|>\n\n{content}<|eot_id|>",
+        assistant=(
+            "<|start_header_id|>assistant<|end_header_id|>\n\n{content}<|eot_id|>"
+        ),
+        generation="<|start_header_id|>assistant<|end_header_id|>\n\n",
+    ),
+}
+
+
+def render_chat(
+    messages: Sequence[Mapping[str, str]],
+    chat_format: ChatFormatType,
+    add_generation: bool = True,
+) -> str:
+    """
+    Render a conversation in the turn format of a model
+
+    Args:
+        messages (Sequence[Mapping[str, str]]): The messages, with their `role`:
+            `system`, `user` or `assistant`, and their `content`.
+        chat_format (ChatFormatType): The format: `mistral`, `chatml` or
+            `llama3`.
+        add_generation (bool, optional): Start the assistant answer at the end.
+            Defaults to True.
+
+    Returns:
+        str: The prompt.
+
+    Example:
+        >>> render_chat([{"role": "user", "content": "Hello"}], "chatml")
+        '<|im_start|>user\\nHello<|im_end|>\\n<|im_start|>assistant\\n'
+    """
+    fmt = CHAT_FORMATS[chat_format]
+    out = [fmt.begin]
+    system: Optional[str] = None
+    for message in messages:
+        role = message["role"]
+        content = message["content"]
+        if role == "system":
+            if fmt.system == "":
+                system = content
+                continue
+            out.append(fmt.system.replace("{content}", content))
+        elif role == "user":
+            if system is not None:
+                content = system + "\n\n" + content
+                system = None
+            out.append(fmt.user.replace("{content}", content))
+        elif role == "assistant":
+            out.append(fmt.assistant.replace("{content}", content))
+        else:
+            raise ValueError(f"Unknown message role {role}")
+    if add_generation:
+        out.append(fmt.generation)
+    return "".join(out)
+
+
+def chat_template(chat_format: ChatFormatType, system: Optional[str] = None) -> str:
+    """
+    Get a template for a single turn in the format of a model, with a `{prompt}`
+    slot for the user message
+
+    Args:
+        chat_format (ChatFormatType): The format: `mistral`, `chatml` or
+            `llama3`.
+        system (Optional[str], optional): The system message. Defaults to None.
+
+    Returns:
+        str: The template.
+
+    Example:
+        >>> lm.infer("List the planets", InferenceParams(
+        >>>     template=chat_template("chatml", system="Be concise")))
+    """
+    messages = [{"role": "user", "content": "{prompt}"}]
+    if system is not None:
+        messages.insert(0, {"role": "system", "content": system})
+    return render_chat(messages, chat_format)
@@ -0,0 +1,125 @@
+import hashlib
+import math
+import threading
+from collections import OrderedDict
+from typing import Callable, Optional
+
+from .schemas import TruncateType
+
+# a conservative number of characters per token for the estimates
+CHARS_PER_TOKEN = 3.5
+
+DEFAULT_MAX_ITEMS = 4096
+
+
+def estimate_tokens(text: str, chars_per_token: float = CHARS_PER_TOKEN) -> int:
+    """
+    Estimate the number of tokens of a text from its length
+
+    Args:
+        text (str): The text.
+        chars_per_token (float, optional): The average number of characters per
+            token. Defaults to 3.5.
+
+    Returns:
+        int: The estimated number of tokens.
+
+    Example:
+        >>> estimate_tokens("List the planets of the solar system")
+        11
+    """
+    return math.ceil(len(text) / chars_per_token)
+
+
+class TokenCounts:
+    """
+    A memo of the token counts of the texts, keyed by a hash of the text. The least
+    recently used counts are evicted.
+
+    Args:
+        max_items (int, optional): The maximum number of counts to keep. Defaults
+            to 4096.
+
+    Example:
+        >>> counts = TokenCounts()
+        >>> n = counts.get(prompt, lm._count_tokens)
+    """
+
+    def __init__(self, max_items: int = DEFAULT_MAX_ITEMS) -> None:
+        self.max_items = max_items
+        self._data: OrderedDict[bytes, int] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, text: str, count: Callable[[str], int]) -> int:
+        """
+        Get the token count of a text, counting it if unknown
+
+        Args:
+            text (str): The text.
+            count (Callable[[str], int]): The function to count the tokens.
+
+        Returns:
+            int: The number of tokens.
+        """
+        key = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+        with self._lock:
+            n = self._data.get(key)
+            if n is not None:
+                self._data.move_to_end(key)
+                return n
+        n = count(text)
+        with self._lock:
+            self._data[key] = n
+            if len(self._data) > self.max_items:
+                self._data.popitem(last=False)
+        return n
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+def trim_text(
+    text: str,
+    max_tokens: int,
+    strategy: TruncateType,
+    count: Callable[[str], int],
+    n_tokens: Optional[int] = None,
+) -> str:
+    """
+    Remove a part of a text to fit in a number of tokens
+
+    Args:
+        text (str): The text.
+        max_tokens (int): The maximum number of tokens.
+        strategy (TruncateType): The part to remove: `head` for the start, `tail`
+            for the end or `middle`.
+        count (Callable[[str], int]): The function to count the tokens.
+        n_tokens (Optional[int], optional): The token count of the text if known.
+            Defaults to None.
+
+    Returns:
+        str: The trimmed text.
+    """
+    if max_tokens <= 0:
+        return ""
+    if n_tokens is None:
+        n_tokens = count(text)
+    keep = len(text)
+    while n_tokens > max_tokens and keep > 0:
+        # cut in proportion of the extra tokens, a bit more on each round
+        keep = min(keep - 1, int(keep * max_tokens / n_tokens * 0.98))
+        keep = max(keep, 0)
+        trimmed = _cut(text, keep, strategy)
+        n_tokens = count(trimmed)
+    return _cut(text, keep, strategy)
+
+
+def _cut(text: str, keep: int, strategy: TruncateType) -> str:
+    if keep >= len(text):
+        return text
+    if strategy == "head":
+        return text[len(text) - keep:]
+    if strategy == "tail":
+        return text[:keep]
+    start = keep // 2
+    return text[:start] + text[len(text) - (keep - start):]
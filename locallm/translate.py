@@ -0,0 +1,142 @@
+import threading
+from operator import itemgetter
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    Union,
+    get_args,
+    get_origin,
+)
+
+from .schemas import InferenceParams
+
+# a rule: None drops the param, a name renames it, a name and a function
+# renames and converts it. A dotted name puts the value in a sub object, like
+# "options.temperature". The params without a rule are kept as is
+ParamRule = Union[None, str, Tuple[str, Callable[[Any], Any]]]
+
+# the number of translated params kept per translator
+MAX_TRANSLATIONS = 256
+
+
+def _is_container(annotation: Any) -> bool:
+    if get_origin(annotation) in (list, dict):
+        return True
+    return any(_is_container(arg) for arg in get_args(annotation))
+
+
+def _freeze(value: Any) -> Any:
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, dict):
+        return tuple((k, _freeze(v)) for k, v in value.items())
+    return value
+
+
+class ParamTranslator:
+    """
+    Convert the inference params to the format of a backend api, from a table
+    of rules compiled once. The translations are cached by value of the params,
+    so the queries that reuse the same params skip the conversion.
+
+    Args:
+        rules (Dict[str, ParamRule]): The rules, by param name.
+        constants (Optional[Dict[str, Any]], optional): The values always set
+            in the result. Defaults to None.
+        max_items (int, optional): The number of translations kept. Defaults to
+            MAX_TRANSLATIONS.
+
+    Example:
+        >>> translate = ParamTranslator(
+        >>>     {"max_tokens": "max_length", "threads": None, "stop": "stop_sequence"}
+        >>> )
+        >>> translate(InferenceParams(max_tokens=64, threads=4))
+        {'max_length': 64}
+    """
+
+    def __init__(
+        self,
+        rules: Dict[str, ParamRule],
+        constants: Optional[Dict[str, Any]] = None,
+        max_items: int = MAX_TRANSLATIONS,
+    ) -> None:
+        unknown = set(rules) - set(InferenceParams.model_fields)
+        if unknown:
+            raise ValueError(f"Unknown inference params {sorted(unknown)}")
+        self.constants = constants or {}
+        self.max_items = max_items
+        # the compiled rules in the params order: name, key, sub key, convert
+        self._rules: List[
+            Tuple[str, str, Optional[str], Optional[Callable[[Any], Any]]]
+        ] = []
+        for name in InferenceParams.model_fields:
+            rule = rules.get(name, name)
+            if rule is None:
+                continue
+            target, convert = (rule, None) if isinstance(rule, str) else rule
+            key, _, sub = target.partition(".")
+            self._rules.append((name, key, sub or None, convert))
+        # the cache key: the scalar values read at once, and the lists and dicts
+        # converted to tuples. The first scalar is read twice so that the getter
+        # always returns a tuple
+        names = [rule[0] for rule in self._rules]
+        fields = InferenceParams.model_fields
+        scalars = [n for n in names if not _is_container(fields[n].annotation)]
+        self._scalars = itemgetter(*scalars, *scalars[:1]) if scalars else None
+        self._containers = [n for n in names if _is_container(fields[n].annotation)]
+        self._cache: Dict[Any, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, params: InferenceParams) -> Dict[str, Any]:
+        """
+        Translate the params. The result is shared by the calls with the same
+        params: copy it before changing it
+
+        Args:
+            params (InferenceParams): The inference params.
+
+        Returns:
+            Dict[str, Any]: The backend params.
+        """
+        values = params.__dict__
+        key: List[Any] = [self._scalars(values) if self._scalars else None]
+        for name in self._containers:
+            value = values[name]
+            key.append(None if value is None else _freeze(value))
+        frozen = tuple(key)
+        try:
+            return self._cache[frozen]
+        except KeyError:
+            pass
+        except TypeError:
+            # an unhashable value
+            return self._translate(values)
+        res = self._translate(values)
+        with self._lock:
+            if len(self._cache) >= self.max_items:
+                self._cache.clear()
+            self._cache[frozen] = res
+        return res
+
+    def _translate(self, values: Dict[str, Any]) -> Dict[str, Any]:
+        res: Dict[str, Any] = {}
+        for name, key, sub, convert in self._rules:
+            value = values[name]
+            if value is None:
+                continue
+            if convert is not None:
+                value = convert(value)
+            if sub is None:
+                res[key] = value
+            else:
+                res.setdefault(key, {})[sub] = value
+        for key, value in self.constants.items():
+            if isinstance(value, dict):
+                res[key] = {**value, **res.get(key, {})}
+            else:
+                res[key] = value
+        return res
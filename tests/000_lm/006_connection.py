@@ -0,0 +1,17 @@
+from locallm.connection import close_sessions, get_session
+
+
+def test_shared_session():
+    session = get_session("http://localhost:5001", 4)
+    assert get_session("http://localhost:5001", 4) is session
+    assert get_session("http://localhost:11434", 4) is not session
+    adapter = session.get_adapter("http://localhost:5001")
+    assert adapter._pool_maxsize == 4  # type: ignore
+    close_sessions()
+    assert get_session("http://localhost:5001", 4) is not session
+
+
+def test_no_keep_alive_session():
+    session = get_session("http://localhost:5001", keep_alive=False)
+    assert session.headers["Connection"] == "close"
+    close_sessions()
@@ -0,0 +1,107 @@
+import asyncio
+
+import pytest
+
+from locallm import KoboldcppLm, OllamaLm
+from locallm.aio import iter_sse, iterate_in_executor
+from locallm.connection import aclose_sessions, get_async_session
+from locallm.schemas import InferenceParams, LmParams
+
+pytest.importorskip("aiohttp")
+
+
+def test_iterate_in_executor():
+    async def run():
+        return [item async for item in iterate_in_executor(lambda: iter(range(100)), 4)]
+
+    assert asyncio.run(run()) == list(range(100))
+
+
+def test_iterate_in_executor_error():
+    def fail():
+        raise ValueError("boom")
+
+    async def run():
+        return [item async for item in iterate_in_executor(fail)]
+
+    with pytest.raises(ValueError):
+        asyncio.run(run())
+
+
+def test_iterate_in_executor_stop():
+    closed = []
+
+    def produce():
+        try:
+            while True:
+                yield 1
+        finally:
+            closed.append(True)
+
+    async def run():
+        items = []
+        async for item in iterate_in_executor(produce, 1):
+            items.append(item)
+            if len(items) == 3:
+                break
+        return items
+
+    assert asyncio.run(run()) == [1, 1, 1]
+    assert closed == [True]
+
+
+def test_iter_sse():
+    class Response:
+        async def _lines(self):
+            for line in [b"data:  two\n", b"data:one\n", b"\n", b"data: x\n"]:
+                yield line
+
+        @property
+        def content(self):
+            return self._lines()
+
+    async def run():
+        return [data async for data in iter_sse(Response())]
+
+    assert asyncio.run(run()) == [" two\none", "x"]
+
+
+def test_sessions_closed_with_the_loop(mock_server):
+    lm = OllamaLm(LmParams(server_url=mock_server.url, on_token=lambda t: None))
+    lm.load_model("mock", 2048)
+
+    async def run():
+        await lm.ainfer("hello", InferenceParams(max_tokens=8))
+        return get_async_session(lm.url, lm.pool_size, lm.keep_alive)
+
+    session = asyncio.run(run())
+    assert session.closed
+
+
+def test_ainfer_ollama(mock_server):
+    lm = OllamaLm(LmParams(server_url=mock_server.url, on_token=lambda t: None))
+    lm.load_model("mock", 2048)
+
+    async def run():
+        res = await lm.ainfer("hello", InferenceParams(max_tokens=8))
+        tokens = [t async for t in lm.agenerate("hello")]
+        await aclose_sessions()
+        return res, tokens
+
+    res, tokens = asyncio.run(run())
+    assert res["text"] == "Hello world"
+    assert res["stats"]["generated_tokens"] == 3
+    assert tokens == ["Hello", " ", "world"]
+    assert mock_server.payloads[0][1]["options"]["num_predict"] == 8
+
+
+def test_ainfer_koboldcpp_concurrent(mock_server):
+    lm = KoboldcppLm(LmParams(server_url=mock_server.url, on_token=lambda t: None))
+
+    async def run():
+        res = await asyncio.gather(*[lm.ainfer("hello") for _ in range(10)])
+        await aclose_sessions()
+        return res
+
+    for res in asyncio.run(run()):
+        assert res["text"] == "Hello world"
@@ -0,0 +1,13 @@
+import subprocess
+import sys
+
+
+def test_http_providers_do_not_load_llama_cpp():
+    code = (
+        "import sys\n"
+        "from locallm import OllamaLm, KoboldcppLm, LmParams\n"
+        "OllamaLm(LmParams(server_url='http://localhost:11434'))\n"
+        "assert 'llama_cpp' not in sys.modules\n"
+    )
+    res = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True)
+    assert res.returncode == 0, res.stderr
@@ -0,0 +1,87 @@
+import asyncio
+import threading
+
+import pytest
+
+from locallm import CancelHandle, KoboldcppLm, OllamaLm
+from locallm.schemas import InferenceParams, LmParams
+
+
+def test_cancel_handle():
+    calls = []
+    handle = CancelHandle()
+    handle.on_cancel(lambda: calls.append(1))
+    handle.cancel()
+    handle.cancel()
+    assert handle.cancelled is True
+    assert calls == [1]
+    finished = CancelHandle()
+    finished.on_cancel(lambda: calls.append(2))
+    finished.finish()
+    finished.cancel()
+    assert calls == [1]
+
+
+def test_abort_koboldcpp(mock_server):
+    mock_server.tokens = ["a"] * 50
+    mock_server.token_delay = 0.01
+    handle = CancelHandle()
+    tokens = []
+
+    def on_token(t: str):
+        tokens.append(t)
+        if len(tokens) == 3:
+            handle.cancel()
+
+    lm = KoboldcppLm(LmParams(server_url=mock_server.url, on_token=on_token))
+    res = lm.infer("hello", handle=handle)
+    assert len(res["text"]) == 3
+    assert handle.genkey in mock_server.aborted
+    assert mock_server.payloads[0][1]["genkey"] == handle.genkey
+    assert len(lm.handles) == 0
+
+
+def test_abort_all_ollama(mock_server):
+    mock_server.tokens = ["a"] * 50
+    mock_server.token_delay = 0.01
+    lm = OllamaLm(LmParams(server_url=mock_server.url, on_token=lambda t: None))
+    lm.load_model("mock", 2048)
+    stream = lm.generate("hello")
+    threading.Timer(0.1, lm.abort).start()
+    lines = list(stream)
+    assert 0 < len(lines) < 50
+    assert stream.handle.cancelled is True
+    assert len(lm.handles) == 0
+
+
+def test_handles_released_on_errors(mock_server):
+    # a prompt that does not fit, a failed connection or an error body do not
+    # leave a running query behind
+    long_prompt = "word " * 5000
+    params = InferenceParams(truncate="error", max_tokens=10)
+    for lm in [
+        KoboldcppLm(LmParams(server_url=mock_server.url, on_token=lambda t: None)),
+        OllamaLm(LmParams(server_url=mock_server.url, on_token=lambda t: None)),
+    ]:
+        lm.load_model("mock", 2048)
+        with pytest.raises(ValueError):
+            lm.infer(long_prompt, params)
+
+        async def consume():
+            async for _ in lm.agenerate(long_prompt, params):
+                pass
+
+        with pytest.raises(ValueError):
+            asyncio.run(consume())
+        assert len(lm.handles) == 0
+    closed = OllamaLm(LmParams(server_url="http://127.0.0.1:1", on_token=lambda t: None))
+    closed.load_model("mock", 2048)
+    with pytest.raises(OSError):
+        closed.infer("hello")
+    assert len(closed.handles) == 0
+    mock_server.error = "model crashed"
+    lm = OllamaLm(LmParams(server_url=mock_server.url, on_token=lambda t: None))
+    lm.load_model("mock", 2048)
+    with pytest.raises(Exception, match="model crashed"):
+        lm.infer("hello")
+    assert len(lm.handles) == 0
@@ -0,0 +1,42 @@
+import time
+
+from locallm import OllamaLm
+from locallm.schemas import InferenceParams, LmParams
+
+
+def test_infer_many_order(mock_server):
+    mock_server.echo = True
+    lm = OllamaLm(LmParams(server_url=mock_server.url, on_token=lambda t: None))
+    lm.load_model("mock", 2048)
+    prompts = [str(i) for i in range(20)]
+    done = []
+    results = lm.infer_many(
+        prompts,
+        max_concurrency=4,
+        on_result=lambda index, res: done.append(index),
+    )
+    assert [res["text"] for res in results] == prompts
+    assert sorted(done) == list(range(20))
+
+
+def test_infer_many_params(mock_server):
+    mock_server.echo = True
+    lm = OllamaLm(LmParams(server_url=mock_server.url, on_token=lambda t: None))
+    lm.load_model("mock", 2048)
+    results = lm.infer_many(
+        ["a", ("b", InferenceParams(template="T {prompt}"))],
+        InferenceParams(max_tokens=5),
+    )
+    assert [res["text"] for res in results] == ["a", "T b"]
+
+
+def test_infer_many_concurrency(mock_server):
+    mock_server.tokens = ["a"] * 5
+    mock_server.token_delay = 0.02
+    lm = OllamaLm(LmParams(server_url=mock_server.url, on_token=lambda t: None))
+    lm.load_model("mock", 2048)
+    start = time.perf_counter()
+    lm.infer_many(["x"] * 8, max_concurrency=8)
+    elapsed = time.perf_counter() - start
+    # sequential would take at least 8 * 6 * 0.02s
+    assert elapsed < 0.6
@@ -0,0 +1,90 @@
+from locallm import DiskCache, LruCache, OllamaLm
+from locallm.cache import cache_key
+from locallm.schemas import InferenceParams, LmParams
+
+
+def result(text: str):
+    return {"text": text, "stats": {}}
+
+
+def test_lru_cache_eviction():
+    cache = LruCache(max_items=2)
+    cache.set("a", result("a"))
+    cache.set("b", result("b"))
+    assert cache.get("a") == result("a")
+    cache.set("c", result("c"))
+    assert cache.get("b") is None
+    assert cache.get("a") == result("a")
+    assert cache.stats == {"hits": 2, "misses": 1, "evictions": 1}
+
+
+def test_lru_cache_bytes_eviction():
+    cache = LruCache(max_items=None, max_bytes=100)
+    for i in range(10):
+        cache.set(str(i), result("x" * 20))
+    assert cache.size <= 100
+    assert cache.get("9") is not None
+    assert cache.get("0") is None
+
+
+def test_disk_cache(tmp_path):
+    path = tmp_path / "cache.db"
+    cache = DiskCache(path, max_items=2)
+    cache.set("a", result("a"))
+    cache.set("b", result("b"))
+    cache.get("a")
+    cache.set("c", result("c"))
+    cache.close()
+    cache = DiskCache(path)
+    assert cache.get("a") == result("a")
+    assert cache.get("b") is None
+    assert cache.get("c") == result("c")
+
+
+def test_cache_key_normalization():
+    params = InferenceParams(temperature=0, stream=True, threads=4)
+    same = InferenceParams(temperature=0)
+    other = InferenceParams(temperature=0, max_tokens=12)
+    key = cache_key("ollama", "m", 2048, "p", params)
+    assert key == cache_key("ollama", "m", 2048, "p", same)
+    assert key != cache_key("ollama", "m", 2048, "p", other)
+    assert key != cache_key("ollama", "m", 4096, "p", same)
+
+
+def test_provider_cache(mock_server):
+    tokens = []
+    lm = OllamaLm(LmParams(server_url=mock_server.url, on_token=tokens.append))
+    lm.load_model("mock", 2048)
+    first = lm.infer("hello", InferenceParams(temperature=0))
+    second = lm.infer("hello", InferenceParams(temperature=0))
+    assert first == second
+    assert len(mock_server.payloads) == 1
+    assert [t for t in tokens if t] == ["Hello", " ", "world", "Hello world"]
+    lm.infer("hello", InferenceParams(temperature=0.8))
+    lm.infer("hello", InferenceParams(temperature=0.8))
+    assert len(mock_server.payloads) == 3
+    assert lm.cache.stats["hits"] == 1  # type: ignore
+
+
+def test_provider_cache_never(mock_server):
+    lm = OllamaLm(
+        LmParams(
+            server_url=mock_server.url, on_token=lambda t: None, cache_policy="never"
+        )
+    )
+    lm.load_model("mock", 2048)
+    lm.infer("hello", InferenceParams(temperature=0))
+    lm.infer("hello", InferenceParams(temperature=0))
+    assert len(mock_server.payloads) == 2
+
+
+def test_provider_keeps_empty_cache(tmp_path):
+    # an empty cache has a zero length: the provider must keep it anyway
+    cache = LruCache(max_bytes=1000)
+    lm = OllamaLm(LmParams(server_url="http://localhost:11434", cache=cache))
+    assert lm.cache is cache
+    assert lm.cache.max_bytes == 1000
+    disk = DiskCache(tmp_path / "cache.db")
+    lm = OllamaLm(LmParams(server_url="http://localhost:11434", cache=disk))
+    assert lm.cache is disk
+    disk.close()
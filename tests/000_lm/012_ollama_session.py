@@ -0,0 +1,73 @@
+import asyncio
+import time
+
+import pytest
+
+from locallm import OllamaLm
+from locallm.connection import aclose_sessions
+from locallm.schemas import InferenceParams, LmParams
+
+
+def test_ollama_session_context(mock_server):
+    lm = OllamaLm(LmParams(server_url=mock_server.url, on_token=lambda t: None))
+    lm.load_model("mock", 2048)
+    chat = lm.session()
+    chat.infer("hello")
+    assert chat.context == [1, 2, 3]
+    assert "context" not in mock_server.payloads[0][1]
+    res = chat.infer("again")
+    assert res["text"] == "Hello world"
+    assert mock_server.payloads[1][1]["context"] == [1, 2, 3]
+    assert chat.context == [1, 2, 3, 1, 2, 3]
+    assert chat.stats == {"turns": 2, "prompt_eval_count": 10, "reused_tokens": 3}
+    chat.reset()
+    chat.infer("new")
+    assert "context" not in mock_server.payloads[2][1]
+
+
+def test_ollama_session_async(mock_server):
+    pytest.importorskip("aiohttp")
+    lm = OllamaLm(LmParams(server_url=mock_server.url, on_token=lambda t: None))
+    lm.load_model("mock", 2048)
+    chat = lm.session()
+
+    async def run():
+        await chat.ainfer("hello")
+        await chat.ainfer("again")
+        await aclose_sessions()
+
+    asyncio.run(run())
+    assert mock_server.payloads[1][1]["context"] == [1, 2, 3]
+    assert chat.turns == 2
+
+
+def test_ollama_session_stop(mock_server):
+    emitted = []
+    lm = OllamaLm(LmParams(server_url=mock_server.url, on_token=emitted.append))
+    lm.load_model("mock", 2048)
+    chat = lm.session()
+    chat.infer("hello")
+    mock_server.tokens = ["1. Mercury", "\n2", ". Venus"] + [" and more"] * 100
+    mock_server.token_delay = 0.01
+    emitted.clear()
+    params = InferenceParams(stop=["###"], stop_regex=[r"\n\d+\."])
+    start = time.perf_counter()
+    res = chat.infer("the planets", params)
+    # the generation stops at the match, without reading on to the context
+    assert time.perf_counter() - start < 0.5
+    assert res["text"] == "1. Mercury"
+    assert "".join(emitted) == "1. Mercury"
+    assert mock_server.payloads[-1][1]["options"]["stop"] == ["###"]
+    # the stopped turn is left out of the conversation
+    assert chat.context == [1, 2, 3]
+    assert chat.turns == 1
+
+    async def run():
+        res = await chat.ainfer("the planets", params)
+        await aclose_sessions()
+        return res
+
+    start = time.perf_counter()
+    assert asyncio.run(run())["text"] == "1. Mercury"
+    assert time.perf_counter() - start < 0.5
+    assert chat.turns == 1
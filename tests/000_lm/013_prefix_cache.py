@@ -0,0 +1,66 @@
+import numpy as np
+
+from locallm import LocalLm
+from locallm.schemas import InferenceParams, LmParams
+from tests.localconf import MODELS_DIR, MODEL, CTX
+
+TEMPLATE = (
+    "Below is an instruction that describes a task. Write a response that "
+    "appropriately completes the request.\n### Instruction:\n{prompt}\n\n"
+    "### Response:"
+)
+
+
+def lm_params(**kwargs):
+    return LmParams(models_dir=MODELS_DIR, cache_policy="never", **kwargs)
+
+
+def params():
+    return InferenceParams(template=TEMPLATE, max_tokens=4, temperature=0)
+
+
+def test_prefix_cache_restores_state():
+    lm = LocalLm(lm_params(prefix_cache_bytes=256 * 1024**2))
+    lm.load_model(MODEL, CTX)
+    first = lm.infer("Hello", params())
+    assert first["stats"]["skipped_prompt_tokens"] == 0
+    assert lm.prefix_cache is not None
+    assert lm.prefix_cache.stats["misses"] == 1
+    # evaluate another prompt to drop the prefix from the model state
+    lm.infer("Something else", InferenceParams(max_tokens=2))
+    second = lm.infer("Hello", params())
+    assert second["stats"]["skipped_prompt_tokens"] > 0
+    assert lm.prefix_cache.stats["hits"] == 1
+    assert second["text"] == first["text"]
+
+
+def test_prefix_cache_on_disk(tmp_path):
+    lm = LocalLm(lm_params(prefix_cache_dir=str(tmp_path)))
+    lm.load_model(MODEL, CTX)
+    lm.infer("Hello", params())
+    assert len(list(tmp_path.glob("*.state"))) == 1
+    # a new provider finds the state on disk
+    other = LocalLm(lm_params(prefix_cache_dir=str(tmp_path)))
+    other.load_model(MODEL, CTX)
+    res = other.infer("Hi", params())
+    assert res["stats"]["skipped_prompt_tokens"] > 0
+    assert other.prefix_cache is not None
+    assert other.prefix_cache.stats["hits"] == 1
+
+
+def test_prefix_cache_keyed_by_context(tmp_path):
+    lm = LocalLm(lm_params(prefix_cache_dir=str(tmp_path)))
+    lm.load_model(MODEL, CTX)
+    lm.infer("Hello", params())
+    # the states are numpy archives, loaded without pickle
+    (path,) = tmp_path.glob("*.state")
+    with np.load(path, allow_pickle=False) as data:
+        assert data["llama_state"].dtype == np.uint8
+    # a state saved with another context size is not restored
+    other = LocalLm(lm_params(prefix_cache_dir=str(tmp_path)))
+    other.load_model(MODEL, CTX * 2)
+    res = other.infer("Hello", params())
+    assert res["stats"]["skipped_prompt_tokens"] == 0
+    assert other.prefix_cache is not None
+    assert other.prefix_cache.stats == {"hits": 0, "misses": 1, "evictions": 0}
+    assert len(list(tmp_path.glob("*.state"))) == 2
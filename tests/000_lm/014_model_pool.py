@@ -0,0 +1,50 @@
+import pytest
+
+from locallm import LocalLm
+from locallm.schemas import InferenceParams, LmParams
+from tests.localconf import MODELS_DIR, MODEL, CTX
+
+DRAFT_MODEL = "tiny-draft.gguf"
+
+
+def test_model_pool_routing():
+    lm = LocalLm(LmParams(models_dir=MODELS_DIR, max_models=2))
+    lm.preload([MODEL, DRAFT_MODEL], CTX)
+    assert lm.pool.models == [MODEL, DRAFT_MODEL]
+    lm.infer("Hello", InferenceParams(model=MODEL, max_tokens=2))
+    assert lm.loaded_model == MODEL
+    lm.infer("Hello", InferenceParams(model=DRAFT_MODEL, max_tokens=2))
+    assert lm.loaded_model == DRAFT_MODEL
+    stats = lm.pool.stats
+    assert stats["loads"] == 2
+    assert stats["hits"] == 2
+    assert stats["evictions"] == 0
+    assert set(stats["load_times"]) == {MODEL, DRAFT_MODEL}
+
+
+def test_model_pool_eviction():
+    lm = LocalLm(LmParams(models_dir=MODELS_DIR))
+    lm.load_model(MODEL, CTX)
+    lm.load_model(DRAFT_MODEL, CTX)
+    assert lm.pool.models == [DRAFT_MODEL]
+    assert lm.pool.stats["evictions"] == 1
+    lm.load_model(DRAFT_MODEL, CTX)
+    assert lm.pool.stats["loads"] == 2
+    assert lm.pool.stats["hits"] == 1
+
+
+def test_model_pool_evicted_active_model():
+    lm = LocalLm(LmParams(models_dir=MODELS_DIR))
+    lm.preload([MODEL, DRAFT_MODEL], CTX)
+    assert lm.loaded_model == DRAFT_MODEL
+    lm._use_model(MODEL)
+    assert lm.pool.models == [MODEL]
+    assert lm.llm is lm.pool.peek(MODEL)[0]  # type: ignore
+    # the pool evicts the active model before it fails to load the next one
+    with pytest.raises(ValueError):
+        lm.load_model("missing.gguf", CTX)
+    assert lm.llm is None
+    assert lm.loaded_model == ""
+    lm.infer("Hello", InferenceParams(model=MODEL, max_tokens=2))
+    assert lm.loaded_model == MODEL
+    assert lm.llm is lm.pool.peek(MODEL)[0]  # type: ignore
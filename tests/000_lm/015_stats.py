@@ -0,0 +1,59 @@
+import asyncio
+
+from locallm import KoboldcppLm, LocalLm, OllamaLm
+from locallm.schemas import InferenceParams, LmParams
+from tests.localconf import MODELS_DIR, MODEL, CTX
+
+
+def test_stats_ollama(mock_server):
+    lm = OllamaLm(LmParams(server_url=mock_server.url, on_token=lambda t: None))
+    lm.load_model("mock", 2048)
+    stats = lm.infer("hello")["stats"]
+    assert stats["prompt_tokens"] == 5
+    assert stats["generated_tokens"] == 3
+    assert stats["generation_tokens_per_second"] == 3 / 0.004
+    assert stats["prompt_tokens_per_second"] == 5 / 0.002
+    assert stats["network_overhead"] >= 0
+    assert stats["total_time"] >= stats["time_to_first_token"]
+
+
+def test_stats_koboldcpp(mock_server):
+    lm = KoboldcppLm(LmParams(server_url=mock_server.url, on_token=lambda t: None))
+    lm.load_model("", 0)
+    # the timings are measured on the client side by default
+    stats = lm.infer("hello")["stats"]
+    assert "prompt_tokens" not in stats
+    assert stats["generated_tokens"] == 3
+    lm = KoboldcppLm(
+        LmParams(server_url=mock_server.url, server_stats=True, on_token=lambda t: None)
+    )
+    lm.load_model("", 0)
+    stats = lm.infer("hello")["stats"]
+    assert stats["prompt_tokens"] == 5
+    assert stats["generated_tokens"] == 3
+    assert stats["generation_tokens_per_second"] == 3 / 0.004
+    assert "network_overhead" in stats
+
+
+def test_stats_local():
+    lm = LocalLm(LmParams(models_dir=MODELS_DIR, on_token=lambda t: None))
+    lm.load_model(MODEL, CTX)
+    stats = lm.infer("Hello", InferenceParams(max_tokens=4, temperature=0))["stats"]
+    assert stats["prompt_tokens"] > 0
+    assert 0 < stats["generated_tokens"] <= 4
+    assert stats["prompt_tokens_per_second"] > 0
+    assert "network_overhead" not in stats
+
+
+def test_stats_local_async():
+    lm = LocalLm(
+        LmParams(models_dir=MODELS_DIR, cache_policy="never", on_token=lambda t: None)
+    )
+    lm.load_model(MODEL, CTX)
+    params = InferenceParams(max_tokens=4, temperature=0)
+    expected = lm.infer("Hello", params)
+    res = asyncio.run(lm.ainfer("Hello", params))
+    assert res["text"] == expected["text"]
+    assert res["stats"]["prompt_tokens"] == expected["stats"]["prompt_tokens"]
+    assert "skipped_prompt_tokens" in res["stats"]
+    assert res["stats"]["generated_tokens"] == expected["stats"]["generated_tokens"]
@@ -0,0 +1,56 @@
+from locallm import OllamaLm
+from locallm.schemas import LmParams
+from locallm.stream import TokenConsumer
+
+
+def test_consumer_per_token():
+    calls = []
+    started = []
+    consumer = TokenConsumer(calls.append, started.append)
+    for token in ["a", "b", "c"]:
+        consumer.push(token)
+    assert consumer.text() == "abc"
+    assert calls == ["a", "b", "c"]
+    assert started == [None]
+    assert consumer.recorder.tokens == 3
+
+
+def test_consumer_batch_size():
+    calls = []
+    consumer = TokenConsumer(calls.append, batch_size=2)
+    for token in ["a", "b", "c", "d", "e"]:
+        consumer.push(token)
+    assert calls == ["ab", "cd"]
+    assert consumer.text() == "abcde"
+    assert calls == ["ab", "cd", "e"]
+
+
+def test_consumer_batch_ms():
+    calls = []
+    consumer = TokenConsumer(calls.append, batch_ms=60000)
+    for token in ["a", "b", "c"]:
+        consumer.push(token)
+    assert calls == []
+    consumer.text()
+    assert calls == ["abc"]
+
+
+def test_consumer_no_emit():
+    calls = []
+    consumer = TokenConsumer(calls.append, emit=False)
+    consumer.push("a")
+    consumer.push("", count=False)
+    assert consumer.text() == "a"
+    assert calls == []
+    assert consumer.recorder.tokens == 1
+
+
+def test_provider_batched_tokens(mock_server):
+    calls = []
+    lm = OllamaLm(
+        LmParams(server_url=mock_server.url, on_token=calls.append, token_batch_size=2)
+    )
+    lm.load_model("mock", 2048)
+    res = lm.infer("hello")
+    assert res["text"] == "Hello world"
+    assert calls == ["Hello ", "world"]
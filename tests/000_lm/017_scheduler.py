@@ -0,0 +1,107 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from locallm import DeadlineExceeded, KoboldcppLm, Scheduler
+from locallm.schemas import LmParams
+
+
+def make_scheduler(mock_server, **kwargs) -> Scheduler:
+    lm = KoboldcppLm(
+        LmParams(
+            server_url=mock_server.url, on_token=lambda t: None, cache_policy="never"
+        )
+    )
+    return Scheduler(lm, **kwargs)
+
+
+def wait_depth(scheduler: Scheduler, depth: int):
+    for _ in range(200):
+        classes = scheduler.stats["classes"].values()
+        if sum(c["queue_depth"] for c in classes) == depth:
+            return
+        time.sleep(0.01)
+    raise Exception("The queries were not queued")
+
+
+def run_queued(scheduler: Scheduler, queries):
+    # hold the slot with a stream, queue the queries, then release the slot
+    stream = scheduler.generate("hold")
+    threads = []
+    for prompt, priority, tenant in queries:
+        thread = threading.Thread(
+            target=scheduler.infer,
+            args=(prompt,),
+            kwargs={"priority": priority, "tenant": tenant},
+        )
+        thread.start()
+        threads.append(thread)
+        wait_depth(scheduler, len(threads))
+    stream.close()
+    for thread in threads:
+        thread.join()
+
+
+def prompts(mock_server):
+    return [p["prompt"] for path, p in mock_server.payloads if "prompt" in p]
+
+
+def test_scheduler_priorities(mock_server):
+    scheduler = make_scheduler(mock_server)
+    run_queued(
+        scheduler,
+        [("batch1", "batch", "a"), ("batch2", "batch", "a"), ("chat", None, "b")],
+    )
+    assert prompts(mock_server) == ["hold", "chat", "batch1", "batch2"]
+    stats = scheduler.stats
+    assert stats["in_flight"] == 0
+    assert stats["classes"]["batch"]["dispatched"] == 2
+    assert stats["classes"]["batch"]["max_depth"] == 2
+    assert stats["classes"]["interactive"]["dispatched"] == 2
+    assert stats["classes"]["batch"]["wait_max"] > 0
+
+
+def test_scheduler_tenants_round_robin(mock_server):
+    scheduler = make_scheduler(mock_server)
+    run_queued(
+        scheduler,
+        [("a1", "batch", "a"), ("a2", "batch", "a"), ("b1", "batch", "b")],
+    )
+    assert prompts(mock_server) == ["hold", "a1", "b1", "a2"]
+
+
+def test_scheduler_deadline(mock_server):
+    scheduler = make_scheduler(mock_server)
+    stream = scheduler.generate("hold")
+    with pytest.raises(DeadlineExceeded):
+        scheduler.infer("late", deadline=0.05)
+    stream.close()
+    assert scheduler.stats["classes"]["interactive"]["dropped"] == 1
+    assert scheduler.stats["classes"]["interactive"]["queue_depth"] == 0
+    assert scheduler.infer("in time", deadline=1)["text"] == "Hello world"
+
+
+def test_scheduler_limits(mock_server):
+    mock_server.token_delay = 0.02
+    scheduler = make_scheduler(mock_server, max_in_flight=2, limits={"batch": 1})
+    results = scheduler.infer_many(["a", "b", "c"])
+    assert [r["text"] for r in results] == ["Hello world"] * 3
+    assert scheduler.stats["classes"]["batch"]["dispatched"] == 3
+
+
+def test_scheduler_ainfer(mock_server):
+    pytest.importorskip("aiohttp")
+    from locallm.connection import aclose_sessions
+
+    scheduler = make_scheduler(mock_server, max_in_flight=2)
+
+    async def run():
+        res = await asyncio.gather(*[scheduler.ainfer(str(i)) for i in range(4)])
+        await aclose_sessions()
+        return res
+
+    results = asyncio.run(run())
+    assert [r["text"] for r in results] == ["Hello world"] * 4
+    assert scheduler.stats["classes"]["interactive"]["dispatched"] == 4
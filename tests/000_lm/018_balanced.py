@@ -0,0 +1,156 @@
+import asyncio
+import socket
+
+import pytest
+
+from locallm import BalancedLm, LmEndpoint
+from locallm.connection import aclose_sessions
+from locallm.schemas import LmParams
+
+
+def free_url() -> str:
+    # an url where no server listens
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    return "http://127.0.0.1:%s" % port
+
+
+def make_lm(urls, **kwargs) -> BalancedLm:
+    endpoints = [LmEndpoint(url=url) for url in urls]
+    return BalancedLm(
+        LmParams(
+            endpoints=endpoints,
+            on_token=lambda t: None,
+            cache_policy="never",
+            **kwargs,
+        )
+    )
+
+
+def generations(server) -> int:
+    return len([p for p in server.payloads if p[0] == "/api/extra/generate/stream"])
+
+
+def test_balanced_spreads_queries(mock_server, mock_server_b):
+    mock_server_b.ctx = 4096
+    lm = make_lm([mock_server.url, mock_server_b.url])
+    lm.load_model("", 0)
+    assert lm.ctx == 2048
+    assert [s["ctx"] for s in lm.stats] == [2048, 4096]
+    # the context size is discovered once
+    node_lm = lm.nodes[0].lm
+    lm.load_model("", 0)
+    assert lm.nodes[0].lm is node_lm
+    streams = [lm.generate("hello") for _ in range(4)]
+    assert [s["outstanding"] for s in lm.stats] == [2, 2]
+    for stream in streams:
+        list(stream)
+    assert [s["outstanding"] for s in lm.stats] == [0, 0]
+    assert generations(mock_server) == 2
+    assert generations(mock_server_b) == 2
+
+
+def test_balanced_failover(mock_server):
+    lm = make_lm([free_url(), mock_server.url], balance_strategy="ewma")
+    lm.load_model("", 0)
+    assert [s["healthy"] for s in lm.stats] == [False, True]
+    for _ in range(3):
+        assert lm.infer("hello")["text"] == "Hello world"
+    assert generations(mock_server) == 3
+    assert lm.stats[1]["ewma"] > 0
+
+
+def test_balanced_failover_on_query(mock_server, mock_server_b):
+    lm = make_lm([mock_server.url, mock_server_b.url])
+    lm.load_model("", 0)
+    mock_server_b.shutdown()
+    mock_server_b.server_close()
+    # drop the kept alive connection to the stopped server
+    lm.nodes[1].http.close()
+    for _ in range(4):
+        assert lm.infer("hello")["text"] == "Hello world"
+    assert generations(mock_server) == 4
+    assert lm.stats[1]["failures"] <= 1
+    lm.check_health()
+    assert lm.stats[1]["healthy"] is False
+    assert lm.stats[0]["healthy"] is True
+
+
+def test_balanced_ollama(mock_server):
+    lm = BalancedLm(
+        LmParams(
+            endpoints=[LmEndpoint(url=mock_server.url, ptype="ollama")],
+            on_token=lambda t: None,
+        )
+    )
+    lm.load_model("mock", 2048)
+    lm.check_health()
+    assert lm.stats[0]["healthy"] is True
+    assert lm.infer("hello")["text"] == "Hello world"
+
+
+def test_balanced_no_failover_after_tokens(mock_server, mock_server_b):
+    emitted = []
+    lm = BalancedLm(
+        LmParams(
+            endpoints=[
+                LmEndpoint(url=mock_server.url, weight=2),
+                LmEndpoint(url=mock_server_b.url),
+            ],
+            on_token=emitted.append,
+            cache_policy="never",
+        )
+    )
+    lm.load_model("", 0)
+    # the first server crashes in the middle of the generation
+    mock_server.drop_after = 2
+    with pytest.raises(OSError):
+        lm.infer("hello")
+    assert emitted == ["Hello", " "]
+    assert generations(mock_server_b) == 0
+    # nothing was emitted: the query goes to the next server
+    lm.nodes[0].ejected_until = 0
+    results = lm.infer_many(["hello"], max_concurrency=1)
+    assert results[0]["text"] == "Hello world"
+    assert generations(mock_server_b) == 1
+    lm.nodes[0].ejected_until = 0
+    emitted.clear()
+
+    async def run():
+        try:
+            return await lm.ainfer("hello")
+        finally:
+            await aclose_sessions()
+
+    with pytest.raises(Exception):
+        asyncio.run(run())
+    assert emitted == ["Hello", " "]
+    assert generations(mock_server_b) == 1
+
+
+def test_balanced_ewma_burst(mock_server, mock_server_b):
+    lm = make_lm([mock_server.url, mock_server_b.url], balance_strategy="ewma")
+    lm.load_model("", 0)
+    # no latency samples: the burst is spread by outstanding queries
+    streams = [lm.generate("hello") for _ in range(4)]
+    assert [s["outstanding"] for s in lm.stats] == [2, 2]
+    for stream in streams:
+        list(stream)
+    assert all(s["ewma"] > 0 for s in lm.stats)
+    # a server back without samples does not take the whole burst
+    lm.nodes[1].ewma = 0
+    streams = [lm.generate("hello") for _ in range(4)]
+    assert [s["outstanding"] for s in lm.stats] == [2, 2]
+    for stream in streams:
+        list(stream)
+    # the embeddings record a latency too
+    lm = BalancedLm(
+        LmParams(
+            endpoints=[LmEndpoint(url=mock_server.url, ptype="ollama")],
+            balance_strategy="ewma",
+        )
+    )
+    lm.load_model("mock", 2048)
+    lm.embed(["a"])
+    assert lm.stats[0]["ewma"] > 0
@@ -0,0 +1,89 @@
+import pytest
+
+from locallm import KoboldcppLm, LocalLm, OllamaLm
+from locallm.schemas import InferenceParams, LmParams
+from locallm.tokens import TokenCounts, estimate_tokens, trim_text
+from tests.localconf import MODELS_DIR, MODEL, CTX
+
+
+def count_words(text):
+    return len(text.split())
+
+
+def test_trim_text():
+    text = " ".join(str(i) for i in range(20))
+    assert trim_text(text, 30, "head", count_words) == text
+    head = trim_text(text, 5, "head", count_words)
+    assert count_words(head) <= 5 and text.endswith(head)
+    tail = trim_text(text, 5, "tail", count_words)
+    assert count_words(tail) <= 5 and text.startswith(tail)
+    middle = trim_text(text, 6, "middle", count_words)
+    assert count_words(middle) <= 6
+    assert middle.startswith("0 ") and middle.endswith(" 19")
+    assert trim_text(text, 0, "tail", count_words) == ""
+
+
+def test_token_counts():
+    calls = []
+
+    def count(text):
+        calls.append(text)
+        return count_words(text)
+
+    counts = TokenCounts(max_items=2)
+    assert counts.get("a b", count) == 2
+    assert counts.get("a b", count) == 2
+    assert calls == ["a b"]
+    counts.get("c", count)
+    counts.get("d", count)
+    assert len(counts) == 2
+    counts.get("a b", count)
+    assert len(calls) == 4
+
+
+def test_fit_prompt_ollama(mock_server):
+    lm = OllamaLm(LmParams(server_url=mock_server.url, on_token=lambda t: None))
+    lm.load_model("mock", 64)
+    prompt = "word " * 100
+    assert lm.count_tokens(prompt) == estimate_tokens(prompt)
+    with pytest.raises(ValueError):
+        lm.infer(prompt, InferenceParams(max_tokens=10, truncate="error"))
+    lm.infer(prompt, InferenceParams(max_tokens=10, truncate="head"))
+    _, payload = mock_server.payloads[-1]
+    assert "truncate" not in payload
+    assert estimate_tokens(payload["prompt"]) <= 54
+    with pytest.raises(ValueError):
+        lm.infer(prompt, InferenceParams(max_tokens=64, truncate="head"))
+    # no check without the param
+    lm.infer(prompt)
+    assert mock_server.payloads[-1][1]["prompt"] == prompt
+
+
+def test_fit_prompt_koboldcpp(mock_server):
+    lm = KoboldcppLm(LmParams(server_url=mock_server.url, on_token=lambda t: None))
+    lm.load_model("", 0)
+    assert lm.count_tokens("one two three") == 3
+    prompt = " ".join(str(i) for i in range(lm.ctx + 10))
+    tpl = "Question: {prompt} Answer:"
+    params = InferenceParams(max_tokens=10, template=tpl, truncate="tail")
+    lm.infer(prompt, params)
+    _, payload = mock_server.payloads[-1]
+    assert "truncate" not in payload
+    assert count_words(payload["prompt"]) <= lm.ctx - 10
+    assert payload["prompt"].startswith("Question: 0 1")
+
+
+def test_fit_prompt_local():
+    lm = LocalLm(LmParams(models_dir=MODELS_DIR, on_token=lambda t: None))
+    lm.load_model(MODEL, CTX)
+    prompt = "The planets of the solar system " * 100
+    n = lm.count_tokens(prompt)
+    assert n > CTX
+    params = InferenceParams(max_tokens=4, temperature=0, truncate="middle")
+    fitted = lm.fit_prompt(prompt, params)
+    assert lm.count_tokens(fitted) <= CTX - 4
+    res = lm.infer(prompt, params)
+    assert res["stats"]["prompt_tokens"] <= CTX
+    # the max tokens fill the context: no room is left for the prompt
+    with pytest.raises(ValueError):
+        lm.infer(prompt, InferenceParams(max_tokens=CTX + 10, truncate="head"))
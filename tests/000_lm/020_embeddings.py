@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+
+from locallm import KoboldcppLm, LocalLm, OllamaLm
+from locallm.embeddings import EmbeddingCache, l2_normalize, to_matrix
+from locallm.schemas import LmParams
+from tests.localconf import MODELS_DIR, MODEL, CTX
+
+
+def test_to_matrix():
+    matrix = to_matrix([[1, 2], [3, 4]])
+    assert matrix.dtype == np.float32 and matrix.flags["C_CONTIGUOUS"]
+    assert matrix.shape == (2, 2)
+    # the token embeddings are mean pooled
+    pooled = to_matrix([[[1, 2], [3, 4]], [[0, 0]]])
+    assert pooled.tolist() == [[2, 3], [0, 0]]
+    normalized = l2_normalize(to_matrix([[3, 4], [0, 0]]))
+    assert np.allclose(normalized, [[0.6, 0.8], [0, 0]])
+
+
+def test_embedding_cache():
+    cache = EmbeddingCache(max_items=2)
+    key = cache.key("model", "text")
+    assert key != cache.key("other", "text")
+    assert cache.get(key) is None
+    cache.set(key, np.zeros(3, dtype=np.float32))
+    assert cache.get(key) is not None
+    cache.set(cache.key("model", "a"), np.zeros(3, dtype=np.float32))
+    cache.set(cache.key("model", "b"), np.zeros(3, dtype=np.float32))
+    assert len(cache) == 2
+    assert cache.stats == {"hits": 1, "misses": 1, "evictions": 1}
+
+
+def test_embed_ollama(mock_server):
+    params = LmParams(server_url=mock_server.url, embedding_batch_size=2)
+    lm = OllamaLm(params)
+    lm.load_model("mock", 2048)
+    texts = ["a", "bb", "ccc", "a", "dddd"]
+    vectors = lm.embed(texts, max_concurrency=2)
+    assert vectors.dtype == np.float32 and vectors.shape == (5, 3)
+    assert vectors[:, 0].tolist() == [1, 2, 3, 1, 4]
+    # the duplicates are sent once, by batches of two
+    calls = [p for path, p in mock_server.payloads if path == "/api/embed"]
+    assert [len(p["input"]) for p in calls] == [2, 2]
+    # the second call is served by the cache
+    normalized = lm.embed(texts, normalize=True)
+    assert len(mock_server.payloads) == 2
+    assert np.allclose(np.linalg.norm(normalized, axis=1), 1)
+    assert lm.embedding_cache.stats["hits"] == 4  # type: ignore
+    assert lm.embed([]).shape == (0, 0)
+
+
+def test_embed_ollama_legacy(mock_server):
+    mock_server.legacy_embeddings = True
+    lm = OllamaLm(LmParams(server_url=mock_server.url, embedding_cache_items=0))
+    lm.load_model("mock", 2048)
+    vectors = lm.embed(["a", "bb"], model="embedder")
+    assert vectors[:, 0].tolist() == [1, 2]
+    assert lm.legacy_embeddings is True
+    assert lm.embedding_cache is None
+    _, payload = mock_server.payloads[-1]
+    assert payload == {"model": "embedder", "prompt": "bb"}
+
+
+def test_embed_unsupported(mock_server):
+    lm = KoboldcppLm(LmParams(server_url=mock_server.url))
+    lm.load_model("", 0)
+    with pytest.raises(Exception):
+        lm.embed(["a"])
+
+
+def test_embed_local():
+    lm = LocalLm(LmParams(models_dir=MODELS_DIR, embedding=True))
+    lm.load_model(MODEL, CTX)
+    vectors = lm.embed(["Hello", "The planets", "Hello"], normalize=True)
+    assert vectors.dtype == np.float32 and vectors.shape[0] == 3
+    assert vectors.flags["C_CONTIGUOUS"]
+    assert np.allclose(vectors[0], vectors[2])
+    assert np.allclose(np.linalg.norm(vectors, axis=1), 1, atol=1e-5)
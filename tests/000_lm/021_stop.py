@@ -0,0 +1,207 @@
+import asyncio
+import re
+import time
+
+from locallm import KoboldcppLm, LocalLm, OllamaLm
+from locallm.connection import aclose_sessions
+from locallm.schemas import InferenceParams, LmParams
+from locallm.stop import StopMatcher
+from locallm.stream import TokenConsumer
+from tests.localconf import MODELS_DIR, MODEL, CTX
+
+
+def feed_all(matcher, tokens):
+    out = []
+    for token in tokens:
+        text, stopped = matcher.feed(token)
+        out.append(text)
+        if stopped:
+            return "".join(out), True
+    return "".join(out) + matcher.flush(), False
+
+
+def test_stop_matcher():
+    # a match spanning the tokens
+    assert feed_all(StopMatcher(["</s>"]), ["Paris<", "/", "s>", "more"]) == (
+        "Paris",
+        True,
+    )
+    # a partial match is held back, then released
+    matcher = StopMatcher(["###"])
+    assert matcher.feed("a#") == ("a", False)
+    assert matcher.feed("#b") == ("##b", False)
+    assert feed_all(StopMatcher(["###"]), ["a#", "#"]) == ("a##", False)
+    # several stop strings sharing prefixes
+    stops = ["abcd", "bce", "\n\n"]
+    assert feed_all(StopMatcher(stops), ["xab", "c", "e"]) == ("xa", True)
+    assert feed_all(StopMatcher(stops), ["xab", "c", "d"]) == ("x", True)
+    assert feed_all(StopMatcher(stops), ["1.\n", "\n2."]) == ("1.", True)
+    assert feed_all(StopMatcher(stops), ["abc", "x"]) == ("abcx", False)
+
+
+def test_stop_regex():
+    tokens = ["1. Mercury", "\n2", ". Venus"]
+    # the text that could start a match is held back
+    matcher = StopMatcher(patterns=[r"\n\d+\."], hold=4)
+    assert matcher.feed("1. Mercury") == ("1. Mer", False)
+    assert matcher.feed("\n2") == ("cu", False)
+    assert matcher.feed(". Venus") == ("ry", True)
+    assert matcher.retract == 0
+    assert feed_all(StopMatcher(patterns=[r"\d{3}"], hold=4), ["a1", "2b"]) == (
+        "a12b",
+        False,
+    )
+    # a match longer than the held text is retracted
+    matcher = StopMatcher(patterns=[r"\n\d+\."], hold=0)
+    assert feed_all(matcher, tokens) == ("1. Mercury\n2", True)
+    assert matcher.retract == 2
+    emitted = []
+    consumer = TokenConsumer(
+        emitted.append, matcher=StopMatcher(patterns=[r"\n\d+\."], hold=0)
+    )
+    for token in tokens:
+        if consumer.push(token):
+            break
+    assert consumer.text() == "1. Mercury"
+    assert "".join(emitted) == "1. Mercury\n2"
+    emitted = []
+    consumer = TokenConsumer(emitted.append, matcher=StopMatcher(patterns=[r"\n\d+\."]))
+    for token in tokens:
+        if consumer.push(token):
+            break
+    assert consumer.text() == "1. Mercury"
+    assert "".join(emitted) == "1. Mercury"
+
+
+def test_consumer_stop():
+    emitted = []
+    consumer = TokenConsumer(emitted.append, matcher=StopMatcher(["END"]))
+    stopped = [consumer.push(t) for t in ["The", " E", "arth", " E", "ND", "!"]]
+    assert stopped == [False, False, False, False, True, True]
+    assert consumer.text() == "The Earth "
+    assert "".join(emitted) == "The Earth "
+    assert consumer.recorder.tokens == 6
+
+
+def test_consumer_max_time():
+    consumer = TokenConsumer(max_time=0.05)
+    assert consumer.push("a") is False
+    time.sleep(0.06)
+    assert consumer.push("b") is True
+    assert consumer.text() == "ab"
+    assert consumer.recorder.stats()["timed_out"] is True
+
+
+def test_max_time_not_cached(mock_server):
+    mock_server.tokens = ["The", " planets", " are", " eight"] * 100
+    mock_server.token_delay = 0.01
+    lm = OllamaLm(LmParams(server_url=mock_server.url, on_token=lambda t: None))
+    lm.load_model("mock", 2048)
+    params = InferenceParams(temperature=0, max_time=0.1)
+    res = lm.infer("List", params)
+    assert res["stats"]["timed_out"] is True
+    lm.infer("List", params)
+    assert len(mock_server.payloads) == 2
+    # a query that ends before the time limit is cached
+    mock_server.tokens = ["The", " planets"]
+    res = lm.infer("Name", InferenceParams(temperature=0, max_time=10))
+    assert "timed_out" not in res["stats"]
+    assert lm.infer("Name", InferenceParams(temperature=0, max_time=10)) == res
+    assert len(mock_server.payloads) == 3
+
+
+def test_stop_koboldcpp(mock_server):
+    mock_server.tokens = ["The", " planets", "\n", "\n", "Q:", " more"] * 20
+    lm = KoboldcppLm(LmParams(server_url=mock_server.url, on_token=lambda t: None))
+    lm.load_model("", 0)
+    res = lm.infer("List the planets", InferenceParams(stop=["\n\n"]))
+    assert res["text"] == "The planets"
+    assert "stop_regex" not in mock_server.payloads[0][1]
+    # the generation is aborted on the server
+    assert ("/api/extra/abort", {"genkey": mock_server.payloads[0][1]["genkey"]}) in (
+        mock_server.payloads
+    )
+    res = asyncio.run(lm.ainfer("List", InferenceParams(stop_regex=[r"Q:\s"])))
+    assert res["text"] == "The planets\n\n"
+
+
+def test_stop_ollama(mock_server):
+    mock_server.tokens = ["The", " planets", " are", " eight"] * 100
+    mock_server.token_delay = 0.01
+    lm = OllamaLm(LmParams(server_url=mock_server.url, on_token=lambda t: None))
+    lm.load_model("mock", 2048)
+    start = time.perf_counter()
+    res = lm.infer("List", InferenceParams(stop=["are"]))
+    assert time.perf_counter() - start < 1
+    assert res["text"] == "The planets "
+    assert res["stats"]["generated_tokens"] == 3
+    payload = mock_server.payloads[0][1]
+    assert payload["options"]["stop"] == ["are"]
+    assert "stop_sequence" not in payload
+    res = lm.infer("List", InferenceParams(max_time=0.1))
+    assert 0 < res["stats"]["generated_tokens"] < 100
+    start = time.perf_counter()
+    res = asyncio.run(lm.ainfer("List", InferenceParams(stop=[" eight"])))
+    assert time.perf_counter() - start < 1
+    assert res["text"] == "The planets are"
+
+
+def test_stop_local():
+    lm = LocalLm(LmParams(models_dir=MODELS_DIR, on_token=lambda t: None))
+    lm.load_model(MODEL, CTX)
+    params = InferenceParams(max_tokens=16, temperature=0)
+    text = lm.infer("Hello", params)["text"]
+    assert len(text) > 2
+    stop = text[1:3]
+    params = InferenceParams(max_tokens=16, temperature=0, stop_regex=[re.escape(stop)])
+    res = lm.infer("Hello", params)
+    assert res["text"] == text[: text.index(stop)]
+
+
+def test_stop_streams(mock_server):
+    mock_server.tokens = ["The", " planets", " Q", ":"] + [" more"] * 100
+    mock_server.token_delay = 0.005
+    params = InferenceParams(stop_regex=["Q:"])
+    for lm in [
+        OllamaLm(LmParams(server_url=mock_server.url, on_token=lambda t: None)),
+        KoboldcppLm(LmParams(server_url=mock_server.url, on_token=lambda t: None)),
+    ]:
+        lm.load_model("mock", 2048)
+        start = time.perf_counter()
+        assert "".join(lm.generate("List", params, raw=True)) == "The planets "
+        records = list(lm.generate("List", params))
+        assert "".join(r.text for r in records) == "The planets "
+        assert records[-1].stats["generated_tokens"] == 4
+        assert "".join(lm.generate("List", InferenceParams(stop=[" Q"]), raw=True)) == (
+            "The planets"
+        )
+
+        async def run():
+            try:
+                return [t async for t in lm.agenerate("List", params)]
+            finally:
+                await aclose_sessions()
+
+        assert "".join(asyncio.run(run())) == "The planets "
+        # the streams stop at the match
+        assert time.perf_counter() - start < 1.5
+
+
+def test_stop_local_stream():
+    lm = LocalLm(LmParams(models_dir=MODELS_DIR, on_token=lambda t: None))
+    lm.load_model(MODEL, CTX)
+    params = InferenceParams(max_tokens=16, temperature=0)
+    text = lm.infer("Hello", params)["text"]
+    stop = text[1:3]
+    params = InferenceParams(max_tokens=16, temperature=0, stop_regex=[re.escape(stop)])
+    assert "".join(lm.generate("Hello", params, raw=True)) == text[: text.index(stop)]
+    records = list(lm.generate("Hello", params))
+    assert "".join(r.text for r in records) == text[: text.index(stop)]
+    assert records[-1].stats["prompt_tokens"] > 0
+
+    async def run():
+        return [t async for t in lm.agenerate("Hello", params)]
+
+    assert "".join(asyncio.run(run())) == text[: text.index(stop)]
+    res = asyncio.run(lm.ainfer("Hello", params))
+    assert res["text"] == text[: text.index(stop)]
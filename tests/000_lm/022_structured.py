@@ -0,0 +1,168 @@
+import asyncio
+import json
+import subprocess
+import sys
+
+import pytest
+from pydantic import BaseModel
+
+from locallm import KoboldcppLm, LocalLm, OllamaLm, StructuredOutputError
+from locallm.schemas import InferenceParams, LmParams
+from locallm.structured import (
+    JsonValidator,
+    json_schema_gbnf,
+    llama_grammar,
+)
+from tests.localconf import MODELS_DIR, MODEL, CTX
+
+
+class Planet(BaseModel):
+    name: str
+    moons: int
+
+
+def validate(text, schema=None):
+    validator = JsonValidator(schema)
+    validator.feed(text)
+    validator.finish()
+
+
+def test_json_validator():
+    validate('{"name": "Mars", "moons": 2, "rings": [], "x": {"a": [1.5e3, -0]}}')
+    validate('[true, false, null, "a\\"\\u00e9"]')
+    validate(' "text" ')
+    for text in ['{"a" 1}', "[1,]", '{"a": tru}', "[01]", '{"a": 1} x', "{'a': 1}"]:
+        with pytest.raises(StructuredOutputError):
+            validate(text)
+    with pytest.raises(StructuredOutputError):
+        validate('{"a": [1, 2]')
+    with pytest.raises(StructuredOutputError):
+        validate("[1]", {"type": "object"})
+    schema = {"type": "object", "properties": {"a": {}}, "additionalProperties": False}
+    validate('{"a": {"b": 1}}', schema)
+    with pytest.raises(StructuredOutputError):
+        validate('{"b": 1}', schema)
+
+
+def test_json_validator_fails_fast():
+    validator = JsonValidator({"type": "object"})
+    validator.feed('{"name": ')
+    with pytest.raises(StructuredOutputError):
+        validator.feed("Paris")
+
+
+def test_grammar_cache():
+    schema = Planet.model_json_schema()
+    gbnf = json_schema_gbnf(schema)
+    assert "root" in gbnf
+    assert json_schema_gbnf(dict(schema)) is gbnf
+    assert llama_grammar(schema=schema) is llama_grammar(gbnf)
+
+
+def test_same_grammar(mock_server):
+    lm = KoboldcppLm(LmParams(server_url=mock_server.url, on_token=lambda t: None))
+    lm.load_model("mock", 2048)
+    schemas = [
+        (Planet.model_json_schema(), '{"name": "Mars", "moons": 2}'),
+        ({"type": "array", "items": {"type": "boolean"}, "maxItems": 3}, "[true]"),
+        ({"type": "array", "items": {"type": "integer"}, "minItems": 2}, "[1, 2]"),
+        ({"type": "string", "minLength": 1, "maxLength": 8}, '"yes"'),
+        ({"enum": ["a", "b"]}, '"a"'),
+    ]
+    for schema, output in schemas:
+        gbnf = json_schema_gbnf(schema)
+        # the local provider compiles the grammar of the Koboldcpp provider
+        assert llama_grammar(schema=schema) is llama_grammar(gbnf)
+        mock_server.tokens = [output]
+        assert lm.infer_json("Answer", schema) == json.loads(output)
+        assert mock_server.payloads[-1][1]["grammar"] == gbnf
+    assert json_schema_gbnf(schemas[1][0]).startswith(
+        'root ::= "[" space ( boolean ("," space boolean){0,2} )? "]" space'
+    )
+
+
+def test_structured_ollama(mock_server):
+    mock_server.tokens = ['{"name": ', '"Mars", ', '"moons": 2}']
+    lm = OllamaLm(LmParams(server_url=mock_server.url, on_token=lambda t: None))
+    lm.load_model("mock", 2048)
+    planet = lm.infer_json("Describe Mars", Planet)
+    assert planet == Planet(name="Mars", moons=2)
+    payload = mock_server.payloads[-1][1]
+    assert payload["format"] == Planet.model_json_schema()
+    assert "json_schema" not in payload
+    data = asyncio.run(lm.ainfer_json("Describe Mars", {"type": "object"}))
+    assert data == {"name": "Mars", "moons": 2}
+
+
+def test_structured_fail_fast(mock_server):
+    mock_server.tokens = ["Sure", "! Here", " is"] + ["..."] * 100
+    mock_server.token_delay = 0.01
+    lm = OllamaLm(LmParams(server_url=mock_server.url, on_token=lambda t: None))
+    lm.load_model("mock", 2048)
+    with pytest.raises(StructuredOutputError) as e:
+        lm.infer("Describe Mars", InferenceParams(json_schema={"type": "object"}))
+    assert e.value.text == "Sure"
+    # the validation of the parsed output
+    mock_server.tokens = ['{"name": "Mars"}']
+    mock_server.token_delay = 0
+    with pytest.raises(StructuredOutputError):
+        lm.infer_json("Describe Mars", Planet)
+
+
+def test_structured_koboldcpp(mock_server):
+    mock_server.tokens = ['{"name": "Mars", ', '"moons": 2}']
+    lm = KoboldcppLm(LmParams(server_url=mock_server.url, on_token=lambda t: None))
+    lm.load_model("", 0)
+    assert lm.infer_json("Describe Mars", Planet).moons == 2
+    payload = mock_server.payloads[-1][1]
+    assert payload["grammar"] == json_schema_gbnf(Planet.model_json_schema())
+
+
+def test_json_schema_gbnf_without_llama_cpp():
+    code = (
+        "import sys\n"
+        "from locallm.structured import json_schema_gbnf\n"
+        "gbnf = json_schema_gbnf({'type': 'object', 'properties': {'a': {}}})\n"
+        "assert gbnf.startswith('root ::= ')\n"
+        "assert 'llama_cpp' not in sys.modules\n"
+    )
+    res = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True)
+    assert res.returncode == 0, res.stderr
+
+
+def test_json_schema_gbnf():
+    schema = {
+        "type": "object",
+        "properties": {
+            "kind": {"enum": ["rocky", "gas"]},
+            "ringed": {"type": "boolean"},
+            "moon": {"anyOf": [{"$ref": "#/$defs/Moon"}, {"type": "null"}]},
+        },
+        "required": ["kind", "ringed"],
+        "$defs": {"Moon": {"type": "object", "properties": {"big": {"const": True}}}},
+    }
+    gbnf = json_schema_gbnf(schema)
+    assert json_schema_gbnf(dict(schema)) is gbnf
+    assert '"\\"kind\\""' in gbnf
+    assert "Moon ::= " in gbnf
+    # the grammar is valid for llama.cpp and constrains the output
+    lm = LocalLm(LmParams(models_dir=MODELS_DIR, on_token=lambda t: None))
+    lm.load_model(MODEL, CTX)
+    params = InferenceParams(max_tokens=200, temperature=0, grammar=gbnf)
+    data = json.loads(lm.infer("A planet", params)["text"])
+    assert data["kind"] in ("rocky", "gas")
+    assert isinstance(data["ringed"], bool)
+    with pytest.raises(ValueError):
+        json_schema_gbnf({"$ref": "other.json#/a"})
+
+
+def test_structured_local():
+    lm = LocalLm(LmParams(models_dir=MODELS_DIR, on_token=lambda t: None))
+    lm.load_model(MODEL, CTX)
+    schema = {"type": "array", "items": {"type": "boolean"}, "maxItems": 3}
+    params = InferenceParams(max_tokens=64, temperature=0)
+    data = lm.infer_json("Some booleans", schema, params)
+    assert isinstance(data, list)
+    # a raw gbnf grammar
+    params = InferenceParams(max_tokens=8, temperature=0, grammar='root ::= "yes"')
+    assert lm.infer("Hello", params)["text"] == "yes"
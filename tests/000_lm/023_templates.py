@@ -0,0 +1,73 @@
+from locallm import OllamaLm
+from locallm.schemas import InferenceParams, LmParams
+from locallm.templates import (
+    chat_template,
+    compile_template,
+    prompt_prefix,
+    render_chat,
+    render_prompt,
+)
+
+
+def test_compile_template():
+    tpl = compile_template("<s>[INST] {system}\n\n{prompt} [/INST]")
+    assert compile_template("<s>[INST] {system}\n\n{prompt} [/INST]") is tpl
+    assert tpl.slots == ("system", "prompt")
+    assert tpl.prefix == "<s>[INST] "
+    text = tpl.render(prompt="Hi", system="Be brief")
+    assert text == "<s>[INST] Be brief\n\nHi [/INST]"
+    # the slots without a value and the other braces are kept
+    assert tpl.render(prompt="Hi") == "<s>[INST] {system}\n\nHi [/INST]"
+    code = compile_template("def f():\n    return {a: 1}\n{prompt}")
+    assert code.render(prompt="x") == "def f():\n    return {a: 1}\nx"
+
+
+def test_template_split():
+    tpl = compile_template("{system}\n\nQ: {prompt}\nA:")
+    before, after = tpl.split("prompt", {"system": "Be brief"})
+    assert (before, after) == ("Be brief\n\nQ: ", "\nA:")
+    assert tpl.split("prompt", {"system": "Be brief"})[0] is before
+    assert tpl.split("missing") == ("{system}\n\nQ: {prompt}\nA:", "")
+
+
+def test_render_prompt():
+    assert render_prompt("Hi", InferenceParams()) == "Hi"
+    params = InferenceParams(template="{system} {prompt}", variables={"system": "S"})
+    assert render_prompt("Hi", params) == "S Hi"
+    assert prompt_prefix(params) == ("S ", "")
+    params = InferenceParams(template="{prompt} and {prompt}")
+    assert render_prompt("a", params) == "a and a"
+
+
+def test_chat_formats():
+    messages = [
+        {"role": "system", "content": "Be brief"},
+        {"role": "user", "content": "Hi"},
+        {"role": "assistant", "content": "Hello"},
+        {"role": "user", "content": "Planets?"},
+    ]
+    assert render_chat(messages, "mistral") == (
+        "<s>[INST] Be brief\n\nHi [/INST]Hello</s>[INST] Planets? [/INST]"
+    )
+    assert render_chat(messages, "chatml").endswith(
+        "<|im_start|>user\nPlanets?<|im_end|>\n<|im_start|>assistant\n"
+    )
+    llama3 = render_chat(messages[:2], "llama3", add_generation=False)
+    assert llama3 == (
+        "<|begin_of_text|><|start_header_id|>system<|end_header_id|>\n\nBe brief"
+        "<|eot_id|><|start_header_id|>user<|end_header_id|>\n\nHi<|eot_id|>"
+    )
+    tpl = chat_template("chatml", system="Be brief")
+    assert compile_template(tpl).slots == ("prompt",)
+
+
+def test_template_variables_payload(mock_server):
+    lm = OllamaLm(LmParams(server_url=mock_server.url, on_token=lambda t: None))
+    lm.load_model("mock", 2048)
+    params = InferenceParams(
+        template="{system}\n{prompt}", variables={"system": "Be brief"}
+    )
+    lm.infer("Hi", params)
+    payload = mock_server.payloads[-1][1]
+    assert payload["prompt"] == "Be brief\nHi"
+    assert "variables" not in payload and "template" not in payload
@@ -0,0 +1,71 @@
+import pytest
+
+from locallm import KoboldcppLm, OllamaLm
+from locallm.schemas import InferenceParams, LmParams
+from locallm.translate import ParamTranslator
+
+
+def test_translator():
+    translate = ParamTranslator(
+        {
+            "threads": None,
+            "max_tokens": "max_length",
+            "temperature": "options.temperature",
+            "stop": ("options.stop", lambda stop: stop[:1]),
+        },
+        constants={"stream": True, "options": {"seed": 1}},
+    )
+    params = InferenceParams(threads=4, max_tokens=8, temperature=0, stop=["a", "b"])
+    res = translate(params)
+    assert res == {
+        "max_length": 8,
+        "options": {"seed": 1, "temperature": 0, "stop": ["a"]},
+        "stream": True,
+    }
+    # the translations are cached by value
+    same = InferenceParams(threads=4, max_tokens=8, temperature=0, stop=["a", "b"])
+    assert translate(same) is res
+    assert translate(InferenceParams(max_tokens=9))["max_length"] == 9
+    with pytest.raises(ValueError):
+        ParamTranslator({"max_length": None})
+
+
+def test_translator_max_items():
+    translate = ParamTranslator({}, max_items=2)
+    for i in range(5):
+        assert translate(InferenceParams(max_tokens=i)) == {"max_tokens": i}
+    assert len(translate._cache) <= 2
+
+
+def test_ollama_payload(mock_server):
+    lm = OllamaLm(LmParams(server_url=mock_server.url, on_token=lambda t: None))
+    lm.load_model("mock", 2048)
+    params = InferenceParams(
+        template="<s>{prompt}", max_tokens=8, temperature=0.2, tfs=1, threads=2
+    )
+    lm.infer("Hi", params)
+    payload = mock_server.payloads[-1][1]
+    assert payload["model"] == "mock"
+    assert payload["options"] == {
+        "num_thread": 2,
+        "num_predict": 8,
+        "temperature": 0.2,
+        "tfs_z": 1,
+        "num_ctx": 2048,
+    }
+    assert "template" not in payload and "max_tokens" not in payload
+
+
+def test_koboldcpp_payload(mock_server):
+    lm = KoboldcppLm(LmParams(server_url=mock_server.url, on_token=lambda t: None))
+    lm.load_model("", 0)
+    params = InferenceParams(
+        template="<s>{prompt}", max_tokens=8, repeat_penalty=1.1, stop=["</s>"]
+    )
+    lm.infer("Hi", params)
+    payload = mock_server.payloads[-1][1]
+    assert payload["prompt"] == "<s>Hi"
+    assert payload["max_length"] == 8
+    assert payload["rep_pen"] == 1.1
+    assert payload["stop_sequence"] == ["</s>"]
+    assert "template" not in payload and "stop" not in payload
@@ -0,0 +1,58 @@
+from locallm import KoboldcppLm, LocalLm, OllamaLm, Token
+from locallm.schemas import InferenceParams, LmParams
+from tests.localconf import MODELS_DIR, MODEL, CTX
+
+
+def check_tokens(tokens):
+    assert all(isinstance(t, Token) for t in tokens)
+    assert "".join(t.text for t in tokens) == "Hello world"
+    # the last record holds the stats
+    assert all(t.stats is None for t in tokens[:-1])
+    assert tokens[-1].stats is not None
+    assert [t.index for t in tokens[:-1]] == list(range(len(tokens) - 1))
+    times = [t.time for t in tokens]
+    assert times == sorted(times)
+
+
+def test_generate_ollama(mock_server):
+    lm = OllamaLm(LmParams(server_url=mock_server.url, on_token=lambda t: None))
+    lm.load_model("mock", 2048)
+    tokens = list(lm.generate("hello"))
+    check_tokens(tokens)
+    assert tokens[-1].stats["generated_tokens"] == 3
+    assert list(lm.generate("hello", raw=True)) == ["Hello", " ", "world"]
+    assert len(lm.handles) == 0
+
+
+def test_generate_koboldcpp(mock_server):
+    lm = KoboldcppLm(LmParams(server_url=mock_server.url, on_token=lambda t: None))
+    lm.load_model("", 0)
+    tokens = list(lm.generate("hello"))
+    check_tokens(tokens)
+    assert list(lm.generate("hello", raw=True)) == ["Hello", " ", "world"]
+
+
+def test_generate_cancel(mock_server):
+    mock_server.tokens = ["a"] * 50
+    mock_server.token_delay = 0.01
+    lm = OllamaLm(LmParams(server_url=mock_server.url, on_token=lambda t: None))
+    lm.load_model("mock", 2048)
+    stream = lm.generate("hello")
+    tokens = []
+    for token in stream:
+        tokens.append(token)
+        if token.index == 2:
+            stream.cancel()
+    assert len(tokens) == 3
+    assert tokens[-1].stats is None
+
+
+def test_generate_local():
+    lm = LocalLm(LmParams(models_dir=MODELS_DIR, on_token=lambda t: None))
+    lm.load_model(MODEL, CTX)
+    params = InferenceParams(max_tokens=8, temperature=0)
+    tokens = list(lm.generate("The planets", params))
+    assert tokens[-1].stats["generated_tokens"] == len(tokens) - 1
+    assert tokens[-1].stats["prompt_tokens"] > 0
+    text = "".join(lm.generate("The planets", params, raw=True))
+    assert text == "".join(t.text for t in tokens)
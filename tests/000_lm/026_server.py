@@ -0,0 +1,144 @@
+import asyncio
+import json
+
+from aiohttp.test_utils import TestClient, TestServer
+
+from locallm import OllamaLm
+from locallm.__main__ import parser
+from locallm.connection import aclose_sessions
+from locallm.schemas import LmParams
+from locallm.server import LmServer
+
+
+def make_server(mock_server, **kwargs) -> LmServer:
+    lm = OllamaLm(LmParams(server_url=mock_server.url, on_token=lambda t: None))
+    lm.load_model("mock", 2048)
+    return LmServer(lm, **kwargs)
+
+
+def run(server: LmServer, fn):
+    async def main():
+        client = TestClient(TestServer(server.app()))
+        await client.start_server()
+        try:
+            return await fn(client)
+        finally:
+            await client.close()
+            await aclose_sessions()
+
+    return asyncio.run(main())
+
+
+def events(text: str):
+    return [line[6:] for line in text.split("\n\n") if line.startswith("data: ")]
+
+
+def test_server_completions(mock_server):
+    server = make_server(mock_server)
+
+    async def fn(client):
+        res = await client.post(
+            "/v1/completions",
+            json={"prompt": "hello", "max_tokens": 2, "stop": "</s>"},
+        )
+        return res.status, await res.json()
+
+    status, data = run(server, fn)
+    assert status == 200
+    assert data["object"] == "text_completion"
+    assert data["model"] == "mock"
+    assert data["choices"][0]["text"] == "Hello world"
+    assert data["choices"][0]["finish_reason"] == "length"
+    assert data["usage"]["completion_tokens"] == 3
+    payload = mock_server.payloads[-1][1]
+    assert payload["options"]["num_predict"] == 2
+    assert payload["options"]["stop"] == ["</s>"]
+
+
+def test_server_chat_stream(mock_server):
+    server = make_server(mock_server, chat_format="mistral")
+
+    async def fn(client):
+        res = await client.post(
+            "/v1/chat/completions",
+            json={
+                "messages": [{"role": "user", "content": "hello"}],
+                "stream": True,
+            },
+        )
+        return res.status, res.headers["Content-Type"], await res.text()
+
+    status, ctype, text = run(server, fn)
+    assert status == 200
+    assert ctype.startswith("text/event-stream")
+    items = events(text)
+    assert items[-1] == "[DONE]"
+    chunks = [json.loads(item) for item in items[:-1]]
+    assert chunks[0]["object"] == "chat.completion.chunk"
+    # the role comes first, alone
+    assert chunks[0]["choices"][0]["delta"] == {"role": "assistant"}
+    assert all("role" not in c["choices"][0]["delta"] for c in chunks[1:])
+    content = "".join(c["choices"][0]["delta"].get("content", "") for c in chunks)
+    assert content == "Hello world"
+    assert chunks[-1]["choices"][0]["finish_reason"] == "stop"
+    assert mock_server.payloads[-1][1]["prompt"] == "<s>[INST] hello [/INST]"
+
+
+def test_server_stream_stop(mock_server):
+    # the mock server does not apply the stop strings
+    server = make_server(mock_server)
+
+    async def fn(client):
+        res = await client.post(
+            "/v1/completions",
+            json={"prompt": "hello", "stream": True, "stop": ["wor"]},
+        )
+        return await res.text()
+
+    chunks = [json.loads(item) for item in events(run(server, fn))[:-1]]
+    assert "".join(c["choices"][0]["text"] for c in chunks) == "Hello "
+
+
+def test_server_errors_and_metrics(mock_server):
+    server = make_server(mock_server)
+
+    async def fn(client):
+        bad = await client.post("/v1/chat/completions", json={"messages": []})
+        invalid = await client.post("/v1/completions", data=b"{")
+        await client.post("/v1/completions", json={"prompt": "hello"})
+        metrics = await client.get("/metrics")
+        return bad.status, invalid.status, await metrics.text()
+
+    bad, invalid, metrics = run(server, fn)
+    assert bad == 400 and invalid == 400
+    assert 'locallm_requests_total{endpoint="completions"} 2' in metrics
+    assert "locallm_generated_tokens_total 3" in metrics
+    assert "locallm_requests_in_flight 0" in metrics
+
+
+def test_server_queue_limit(mock_server):
+    mock_server.token_delay = 0.05
+    server = make_server(mock_server, max_in_flight=1, max_queue=1)
+
+    async def fn(client):
+        async def post():
+            res = await client.post("/v1/completions", json={"prompt": "hello"})
+            return res.status
+
+        return await asyncio.gather(*[post() for _ in range(4)])
+
+    statuses = run(server, fn)
+    # one query runs, one waits and the others are rejected
+    assert set(statuses) == {200, 429}
+    assert statuses.count(429) >= 2
+    assert server.metrics.rejected == statuses.count(429)
+
+
+def test_serve_args():
+    args = parser().parse_args(
+        ["serve", "--provider", "koboldcpp", "--port", "9000", "--max-queue", "8"]
+    )
+    assert args.provider == "koboldcpp"
+    assert args.port == 9000
+    assert args.max_queue == 8
+    assert args.chat_format == "chatml"
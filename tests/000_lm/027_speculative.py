@@ -0,0 +1,84 @@
+import numpy as np
+
+from locallm import LocalLm
+from locallm.providers.speculative import PROMPT_LOOKUP, SpeculativeDraft
+from locallm.schemas import InferenceParams, LmParams
+from tests.localconf import MODELS_DIR, MODEL, CTX
+
+DRAFT_MODEL = "tiny-draft.gguf"
+
+
+class FixedDraft:
+    def __init__(self, draft):
+        self.draft = np.array(draft, dtype=np.intc)
+
+    def __call__(self, input_ids, **kwargs):
+        return self.draft
+
+
+def test_draft_counters():
+    draft = SpeculativeDraft(FixedDraft([5, 6, 7]))
+    draft(np.array([1, 2], dtype=np.intc))
+    # the model kept the first two drafted tokens and sampled 9
+    draft(np.array([1, 2, 5, 6, 9], dtype=np.intc))
+    assert draft.stats() == {
+        "draft_tokens": 3,
+        "accepted_draft_tokens": 2,
+        "draft_acceptance_rate": 2 / 3,
+    }
+    draft.reset()
+    assert draft.stats()["draft_tokens"] == 0
+    assert draft.stats()["draft_acceptance_rate"] == 0.0
+
+
+def run(**kwargs):
+    lm = LocalLm(
+        LmParams(
+            models_dir=MODELS_DIR, cache_policy="never", on_token=lambda t: None, **kwargs
+        )
+    )
+    lm.load_model(MODEL, CTX)
+    params = InferenceParams(max_tokens=32, temperature=0, stream=False)
+    return lm, lm.infer("Once upon a time", params)
+
+
+def test_speculative_greedy_output():
+    _, plain = run()
+    assert "draft_tokens" not in plain["stats"]
+    # the model drafts exactly what it generates
+    lm, res = run(draft_model=MODEL, draft_tokens=4)
+    assert res["text"] == plain["text"]
+    assert res["stats"]["draft_tokens"] > 0
+    assert res["stats"]["draft_acceptance_rate"] == 1.0
+    params = InferenceParams(max_tokens=32, temperature=0)
+    tokens = list(lm.generate("Once upon a time", params))
+    assert tokens[-1].stats["draft_acceptance_rate"] == 1.0
+    _, res = run(draft_model=PROMPT_LOOKUP)
+    assert res["text"] == plain["text"]
+    assert 0 <= res["stats"]["draft_acceptance_rate"] <= 1
+
+
+def test_speculative_draft_per_model():
+    lm = LocalLm(
+        LmParams(
+            models_dir=MODELS_DIR,
+            cache_policy="never",
+            on_token=lambda t: None,
+            max_models=2,
+            draft_model=MODEL,
+        )
+    )
+    lm.load_model(MODEL, CTX)
+    lm.load_model(DRAFT_MODEL, CTX * 2)
+    # each model has a draft sized to its own context
+    assert lm.draft is lm._drafts[DRAFT_MODEL]
+    assert lm.draft.draft.llm.n_ctx() == CTX * 2  # type: ignore
+    lm._use_model(MODEL)
+    assert lm.draft is lm._drafts[MODEL]
+    assert lm.draft.draft.llm.n_ctx() == CTX  # type: ignore
+    res = lm.infer("Once upon a time", InferenceParams(max_tokens=32, temperature=0))
+    assert res["stats"]["draft_tokens"] > 0
+    # the draft goes away with its model
+    lm.pool.clear()
+    assert lm._drafts == {}
+    assert lm.draft is None
@@ -0,0 +1,84 @@
+import os
+import signal
+import time
+
+import pytest
+
+from locallm import LocalLm, LocalPoolLm
+from locallm.schemas import InferenceParams, LmParams
+from tests.localconf import MODELS_DIR, MODEL, CTX
+
+
+def make_pool(**kwargs) -> LocalPoolLm:
+    return LocalPoolLm(
+        LmParams(
+            models_dir=MODELS_DIR,
+            workers=2,
+            threads=2,
+            cache_policy="never",
+            on_token=lambda t: None,
+            **kwargs,
+        )
+    )
+
+
+@pytest.fixture(scope="module")
+def pool():
+    lm = make_pool()
+    lm.load_model(MODEL, CTX)
+    yield lm
+    lm.close()
+
+
+def test_pool_infer(pool):
+    params = InferenceParams(max_tokens=16, temperature=0, stream=False)
+    local = LocalLm(LmParams(models_dir=MODELS_DIR, on_token=lambda t: None))
+    local.load_model(MODEL, CTX)
+    expected = local.infer("Once upon a time", params)
+    res = pool.infer("Once upon a time", params)
+    assert res["text"] == expected["text"]
+    assert res["stats"]["generated_tokens"] == expected["stats"]["generated_tokens"]
+    assert res["stats"]["prompt_tokens"] == expected["stats"]["prompt_tokens"]
+    tokens = list(pool.generate("Once upon a time", params))
+    assert "".join(t.text for t in tokens) == expected["text"]
+    assert tokens[-1].stats["prompt_tokens"] == expected["stats"]["prompt_tokens"]
+    assert list(pool.generate("hello", params, raw=True)) != []
+    results = pool.infer_many(["a", "b", "c", "d"], params, max_concurrency=2)
+    assert all(r["stats"]["generated_tokens"] > 0 for r in results)
+    stats = pool.stats
+    assert len(stats) == 2
+    assert all(s["requests"] > 0 and s["alive"] for s in stats)
+    assert all(0 <= s["utilization"] <= 1 for s in stats)
+
+
+def test_pool_cancel(pool):
+    stream = pool.generate("hello", InferenceParams(max_tokens=200))
+    next(stream)
+    stream.cancel()
+    assert list(stream) == []
+    assert len(pool.handles) == 0
+    assert not any(s["busy"] for s in pool.stats)
+    # the worker is ready for the next query
+    res = pool.infer("hello", InferenceParams(max_tokens=4))
+    assert res["stats"]["generated_tokens"] > 0
+
+
+def test_pool_restart(pool):
+    os.kill(pool.workers[0].pid, signal.SIGKILL)
+    time.sleep(0.1)
+    for _ in range(3):
+        assert pool.infer("x", InferenceParams(max_tokens=2))["text"] is not None
+    deadline = time.monotonic() + 30
+    while not all(s["alive"] for s in pool.stats) and time.monotonic() < deadline:
+        time.sleep(0.1)
+    stats = pool.stats
+    assert stats[0]["restarts"] == 1
+    assert stats[0]["alive"] is True
+
+
+def test_pool_load_error():
+    lm = make_pool()
+    with pytest.raises(Exception):
+        lm.load_model("missing.gguf", CTX)
+    with pytest.raises(Exception):
+        lm.infer("hello")
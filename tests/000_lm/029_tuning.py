@@ -0,0 +1,78 @@
+import pytest
+
+from locallm import LocalLm
+from locallm.__main__ import parser
+from locallm.providers.tuning import autotune, load_profile, save_profile
+from locallm.schemas import InferenceParams, LmParams
+from tests.localconf import MODELS_DIR, MODEL, CTX
+
+
+def make_lm(**kwargs) -> LocalLm:
+    lm = LocalLm(LmParams(models_dir=MODELS_DIR, on_token=lambda t: None, **kwargs))
+    lm.load_model(MODEL, CTX)
+    return lm
+
+
+def test_model_knobs(tmp_path):
+    lm = make_lm(
+        n_batch=64,
+        threads=1,
+        threads_batch=1,
+        use_mmap=False,
+        use_mlock=False,
+        type_k="q8_0",
+        type_v="f16",
+        profiles_file=str(tmp_path / "none.json"),
+    )
+    assert lm.llm.n_batch == 64
+    assert lm.llm.context_params.n_threads_batch == 1
+    res = lm.infer("hello", InferenceParams(max_tokens=4))
+    assert res["stats"]["generated_tokens"] > 0
+    with pytest.raises(ValueError):
+        LocalLm(LmParams(models_dir=MODELS_DIR, type_k="q3"))
+
+
+def test_profiles(tmp_path):
+    file = str(tmp_path / "profiles.json")
+    assert load_profile(MODEL, file) == {}
+    profile = autotune(
+        f"{MODELS_DIR}/{MODEL}",
+        CTX,
+        threads=[1, 2],
+        batches=[32, 64],
+        prompt_tokens=64,
+        generated_tokens=8,
+        runs=1,
+    )
+    assert profile["threads"] in (1, 2)
+    assert profile["n_batch"] in (32, 64)
+    assert profile["generation_tokens_per_second"] > 0
+    save_profile(MODEL, {**profile, "n_batch": 32, "threads_batch": 2}, file)
+    assert load_profile(MODEL, file)["n_batch"] == 32
+    assert load_profile("other.gguf", file) == {}
+    # the profile fills the settings not set in the params
+    lm = make_lm(profiles_file=file)
+    assert lm.llm.n_batch == 32
+    assert lm.llm.context_params.n_threads_batch == 2
+    lm = make_lm(profiles_file=file, n_batch=64)
+    assert lm.llm.n_batch == 64
+
+
+def test_autotune_small_context():
+    model = f"{MODELS_DIR}/{MODEL}"
+    # the default batch sizes do not fit: the context size is used
+    profile = autotune(model, 64, threads=[1], generated_tokens=8, runs=1)
+    assert profile["n_batch"] == 64
+    with pytest.raises(ValueError):
+        autotune(model, 64, threads=[1], batches=[128], generated_tokens=8, runs=1)
+    with pytest.raises(ValueError):
+        autotune(model, 64, threads=[1], runs=1)
+
+
+def test_autotune_args():
+    args = parser().parse_args(
+        ["autotune", "--models-dir", "/models", "--model", "m.gguf", "--threads", "4,8"]
+    )
+    assert args.threads == "4,8"
+    assert args.ctx == 2048
+    assert args.dry_run is False
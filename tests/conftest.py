@@ -1,6 +1,10 @@
 """
 Pytest fixtures
 """
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
 
 import pytest
@@ -77,3 +81,165 @@ def settings():
                 print(settings.format("Application version: {VERSION}"))
     """
     return FixturesSettingsTestMixin()
+
+
+def mock_embedding(text):
+    # a vector that depends on the text, to check the order of the results
+    return [float(len(text)), 1.0, 0.0]
+
+
+class MockLmHandler(BaseHTTPRequestHandler):
+    """
+    A minimal stand-in for the Koboldcpp and Ollama http apis. It replays the
+    server's `tokens`, or echoes the prompt for Ollama when `server.echo` is set,
+    and records the received payloads in `server.payloads`
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_chunk(self, data: bytes):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+        if self.server.token_delay:
+            time.sleep(self.server.token_delay)
+
+    def _end_chunks(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path == "/api/extra/true_max_context_length":
+            self._send_json({"value": self.server.ctx})
+        elif self.path == "/api/v1/model":
+            self._send_json({"result": "koboldcpp/mock"})
+        elif self.path == "/api/tags":
+            self._send_json({"models": [{"name": "mock"}]})
+        elif self.path == "/api/extra/perf":
+            self._send_json(
+                {
+                    "last_process": 0.002,
+                    "last_eval": 0.004,
+                    "last_token_count": len(self.server.tokens),
+                    "last_input_count": 5,
+                }
+            )
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        self.server.payloads.append((self.path, payload))
+        if self.path == "/api/extra/generate/stream":
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for i, token in enumerate(self.server.tokens):
+                if payload.get("genkey") in self.server.aborted:
+                    break
+                if i == self.server.drop_after:
+                    # a crash: close the connection without ending the response
+                    self.close_connection = True
+                    return
+                data = json.dumps({"token": token})
+                self._send_chunk(f"event: message\ndata: {data}\n\n".encode("utf-8"))
+            self._end_chunks()
+        elif self.path == "/api/extra/tokencount":
+            # one token per word
+            self._send_json({"value": len(payload["prompt"].split())})
+        elif self.path == "/api/embed" and not self.server.legacy_embeddings:
+            self._send_json({"embeddings": [mock_embedding(t) for t in payload["input"]]})
+        elif self.path == "/api/embeddings":
+            self._send_json({"embedding": mock_embedding(payload["prompt"])})
+        elif self.path == "/api/extra/abort":
+            self.server.aborted.add(payload["genkey"])
+            self._send_json({"success": True})
+        elif self.path == "/api/generate":
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            tokens = [payload["prompt"]] if self.server.echo else self.server.tokens
+            for token in tokens:
+                line = {"model": payload["model"], "response": token, "done": False}
+                self._send_chunk(json.dumps(line).encode("utf-8") + b"\n")
+            if self.server.error is not None:
+                line = {"error": self.server.error}
+                self._send_chunk(json.dumps(line).encode("utf-8") + b"\n")
+                self._end_chunks()
+                return
+            final = {
+                "model": payload["model"],
+                "created_at": "2023-12-12T14:13:43.416799Z",
+                "response": "",
+                "done": True,
+                "context": payload.get("context", []) + [1, 2, 3],
+                "prompt_eval_count": len(payload["prompt"]),
+                "eval_count": len(tokens),
+                "prompt_eval_duration": 2000000,
+                "eval_duration": 4000000,
+                "total_duration": 6000000,
+            }
+            self._send_chunk(json.dumps(final).encode("utf-8") + b"\n")
+            self._end_chunks()
+        else:
+            self.send_error(404)
+
+
+@pytest.fixture(scope="function")
+def mock_server():
+    """
+    Run a local mock server for the Koboldcpp and Ollama apis.
+
+    Example:
+        You may use it like: ::
+
+            def test_foo(mock_server):
+                lm = OllamaLm(LmParams(server_url=mock_server.url))
+                mock_server.tokens = ["Hello", " world"]
+    """
+    server = start_mock_server()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(scope="function")
+def mock_server_b():
+    """
+    Run a second mock server, for the tests with several servers.
+    """
+    server = start_mock_server()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def start_mock_server() -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockLmHandler)
+    server.daemon_threads = True
+    server.tokens = ["Hello", " ", "world"]
+    server.token_delay = 0
+    server.echo = False
+    server.error = None
+    server.drop_after = None
+    server.legacy_embeddings = False
+    server.ctx = 2048
+    server.payloads = []
+    server.aborted = set()
+    server.url = "http://127.0.0.1:%s" % server.server_port
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server